@@ -1,9 +1,14 @@
 from django.contrib.auth.models import Group
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.forms import UserChangeForm
+from django.db import transaction
 from django.utils.translation import gettext_lazy as _
 from django import forms
-from .models import User, DublinCore, Setting
+from .models import User, DIP, DublinCore, Setting
+from .settings_cache import bump_settings_version
+from .tasks import find_mets_file
+
+import zipfile
 
 
 class DeleteByDublinCoreForm(forms.ModelForm):
@@ -20,6 +25,28 @@ class DeleteByDublinCoreForm(forms.ModelForm):
         return self.cleaned_data['identifier']
 
 
+class DIPForm(forms.ModelForm):
+    class Meta:
+        model = DIP
+        fields = ['collection', 'objectszip']
+
+    def clean_objectszip(self):
+        """
+        Find the METS file in the uploaded zip file and store its location
+        in the DIP, to be read by the import tasks.
+        """
+        objectszip = self.cleaned_data['objectszip']
+        try:
+            with zipfile.ZipFile(objectszip) as zip_:
+                metsinfo = find_mets_file(zip_)
+        except zipfile.BadZipFile:
+            raise forms.ValidationError(_('The file is not a valid zip file'))
+        if not metsinfo:
+            raise forms.ValidationError(_('METS file not found in zip file'))
+        self.instance.mets_path = metsinfo.filename
+        return objectszip
+
+
 class UserCreationForm(UserCreationForm):
     is_superuser = forms.BooleanField(required=False, label=_('Administrator'))
 
@@ -111,19 +138,26 @@ class SettingsForm(forms.Form):
       capabilities); the initial value of the form fields will be populated
       with the decoded setting value and the encoded form field value will be
       saved on form submission.
+    - The settings are obtained in a single query and the cached settings
+      values are invalidated when the changes are committed.
     """
-    settings = {}
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.settings = Setting.objects.in_bulk(
+            list(self.fields), field_name='name')
         for name, field in self.fields.items():
-            self.settings[name] = Setting.objects.get(name=name)
+            if name not in self.settings:
+                raise Setting.DoesNotExist(
+                    'Setting matching query does not exist: %s.' % name)
             field.initial = self.settings[name].value
 
     def save(self):
-        for name, field in self.fields.items():
-            self.settings[name].value = self.cleaned_data[name]
-            self.settings[name].save()
+        with transaction.atomic():
+            for name, field in self.fields.items():
+                self.settings[name].value = self.cleaned_data[name]
+                self.settings[name].save()
+            transaction.on_commit(bump_settings_version)
 
 
 class DublinCoreSettingsForm(SettingsForm):
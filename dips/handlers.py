@@ -1,7 +1,8 @@
-from django.db.models.signals import pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 
-from .models import Collection, DIP
+from .models import Collection, DIP, Setting
+from .settings_cache import clear_settings_cache
 
 
 @receiver(pre_delete, sender=Collection, dispatch_uid='collection_pre_delete')
@@ -15,3 +16,11 @@ def delete_related_dc(instance, **kwargs):
     # model and use on delete cascade for that one to one relation.
     if instance.dc:
         instance.dc.delete()
+
+
+@receiver(post_save, sender=Setting, dispatch_uid='setting_post_save')
+@receiver(post_delete, sender=Setting, dispatch_uid='setting_post_delete')
+def clear_settings(**kwargs):
+    # Use the changes in this process without waiting for the cache timeout.
+    # Other processes get them when `bump_settings_version` is called.
+    clear_settings_cache()
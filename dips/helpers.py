@@ -1,6 +1,14 @@
-from django.db.models import FieldDoesNotExist
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, FieldDoesNotExist, Value, When
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+from elasticsearch.exceptions import RequestError
+from search.cache import execute_search
 
+import base64
+import binascii
+import itertools
+import json
 import math
 
 
@@ -10,6 +18,15 @@ def add_if_not_empty(data_dict, key, value):
         data_dict[key] = value
 
 
+def chunks(iterable, size):
+    """Generator with lists of up to `size` items from an iterable."""
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
 def convert_size(size):
     """
     Convert size to human-readable form using base 2. Should this be using
@@ -39,6 +56,32 @@ def update_instance_from_dict(instance, dict):
     return instance
 
 
+def bulk_update(instances, fields, batch_size=None):
+    """
+    Update the given fields of existing model instances with an UPDATE
+    query per batch, which sets the value of each row with a CASE over the
+    primary keys. Django 2.1 doesn't include `QuerySet.bulk_update`. The
+    batches are limited to the query parameters allowed by the database.
+    """
+    if not instances:
+        return
+    model = instances[0]._meta.model
+    max_batch_size = connection.ops.bulk_batch_size(
+        ['pk', 'pk'] + fields, instances)
+    batch_size = min(batch_size or max_batch_size, max_batch_size)
+    for batch in chunks(instances, batch_size):
+        updates = {}
+        for name in fields:
+            field = model._meta.get_field(name)
+            updates[field.attname] = Case(*[
+                When(pk=instance.pk, then=Value(
+                    getattr(instance, field.attname), output_field=field))
+                for instance in batch
+            ], output_field=field)
+        model.objects.filter(
+            pk__in=[instance.pk for instance in batch]).update(**updates)
+
+
 def get_sort_params(params, options, default):
     """
     Get sort option and direction from params. Check options dict. for
@@ -56,20 +99,25 @@ def get_sort_params(params, options, default):
     return (option, direction)
 
 
-def get_page_from_search(search, params):
-    """
-    Create paginator and return current page based on the current search
-    and the page and limit parameters. Limit defaults to 10 and
-    can't be set over 100. The search parameter can be an Elasticsearch
-    search or a Django model QuerySet.
-    """
+def get_limit(params):
+    """Get page limit from params. Defaults to 10 and can't be over 100."""
     try:
         limit = int(params.get('limit', 10))
         if limit <= 0 or limit > 100:
             raise ValueError
     except ValueError:
         limit = 10
+    return limit
+
 
+def get_page_from_search(search, params):
+    """
+    Create paginator and return current page based on the current search
+    and the page and limit parameters. Limit defaults to 10 and
+    can't be set over 100. The search parameter can be an Elasticsearch
+    search or a Django model QuerySet.
+    """
+    limit = get_limit(params)
     paginator = Paginator(search, limit)
     page_no = params.get('page')
     try:
@@ -80,3 +128,174 @@ def get_page_from_search(search, params):
         page = paginator.page(paginator.num_pages)
 
     return page
+
+
+def execute_page_from_search(search, params):
+    """
+    Execute an Elasticsearch search for the page in the page and limit
+    parameters and return the page and the ES response. The paginator count
+    is taken from the total hits of the response, instead of requesting it
+    with a separate count request, so the hits, total and aggregations are
+    obtained in a single request. Only when the page is out of range, the
+    last page is requested again.
+    """
+    limit = get_limit(params)
+    try:
+        number = max(int(params.get('page', 1)), 1)
+    except (TypeError, ValueError):
+        number = 1
+
+    def execute(number):
+        return execute_search(search[(number - 1) * limit:number * limit])
+
+    try:
+        response = execute(number)
+    except RequestError:
+        # Pages over the max result window are rejected by ES, fall back
+        # to the count request to get the last page when they are out of
+        # range.
+        page = get_page_from_search(search, params)
+        return page, execute_search(page.object_list)
+    paginator = Paginator(search, limit)
+    paginator.count = int(response.hits.total)
+    try:
+        page = paginator.page(number)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+        response = execute(page.number)
+
+    return page, response
+
+
+class CursorPage(object):
+    """
+    Page of an Elasticsearch search paginated with `search_after`, which
+    implements the parts of Django's Page used in the templates. The page
+    numbers are not available, only the previous and next page cursors.
+    """
+    is_cursor_page = True
+
+    class Paginator(object):
+        def __init__(self, count):
+            self.count = count
+
+    def __init__(self, response, hits, start, previous_cursor, next_cursor):
+        self.response = response
+        self.object_list = hits
+        self.paginator = self.Paginator(response.hits.total)
+        self.start = start
+        self.previous_cursor = previous_cursor
+        self.next_cursor = next_cursor
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def start_index(self):
+        return self.start + 1 if self.object_list else 0
+
+    def end_index(self):
+        return self.start + len(self.object_list)
+
+
+def encode_cursor(data):
+    """Encode cursor data to an opaque URL safe string."""
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a cursor string. Return `None` if it's not valid."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    return data
+
+
+def get_cursor_page_from_search(search, params, sort_field, sort_dir):
+    """
+    Execute an Elasticsearch search for the page of the cursor parameter,
+    using `search_after` with the sort field and `_id` as tiebreaker, and
+    return it in a CursorPage. The total is taken from the same response,
+    so each page needs a single request, and deep pages are not limited by
+    the `index.max_result_window` setting. Previous pages are requested
+    with the reversed sort and their hits reversed. Cursors from a different
+    sort are ignored.
+    """
+    limit = get_limit(params)
+    sort = [sort_field, sort_dir]
+    cursor = decode_cursor(params.get('cursor', ''))
+    if not cursor or cursor.get('sort') != sort:
+        cursor = {'sort': sort, 'after': None, 'start': 0, 'prev': False}
+    try:
+        start = max(int(cursor.get('start', 0)), 0)
+    except (TypeError, ValueError):
+        start = 0
+    reverse = bool(cursor.get('prev'))
+
+    # Sort the missing values first in the reversed order,
+    # to keep them last once the hits are reversed.
+    order = sort_dir
+    if reverse:
+        order = 'desc' if sort_dir == 'asc' else 'asc'
+    search = search.sort(
+        {sort_field: {'order': order, 'missing': '_first' if reverse else '_last'}},
+        {'_id': {'order': order}},
+    )
+    if cursor.get('after'):
+        search = search.extra(search_after=cursor['after'])
+    # Get an extra hit to know if there are more pages
+    response = execute_search(search[:limit + 1])
+    hits = list(response.hits)
+    more = len(hits) > limit
+    hits = hits[:limit]
+    if reverse:
+        # There are more pages before the first one and always after it
+        hits.reverse()
+        start = max(start - len(hits), 0) if more else 0
+        has_previous, has_next = more, True
+    else:
+        has_previous, has_next = start > 0, more
+
+    previous_cursor = None
+    next_cursor = None
+    if hits:
+        if has_previous:
+            previous_cursor = encode_cursor({
+                'sort': sort,
+                'after': list(hits[0].meta.sort),
+                'start': start,
+                'prev': True,
+            })
+        if has_next:
+            next_cursor = encode_cursor({
+                'sort': sort,
+                'after': list(hits[-1].meta.sort),
+                'start': start + len(hits),
+                'prev': False,
+            })
+    return CursorPage(response, hits, start, previous_cursor, next_cursor)
+
+
+def paginate_search(search, params, sort_field, sort_dir):
+    """
+    Paginate a sorted Elasticsearch search and return the current page,
+    the ES response and its hits. The `search_after` cursor pagination is
+    used when the `SEARCH_CURSOR_PAGINATION` setting is enabled, otherwise
+    the search is paginated with `from` and `size`.
+    """
+    if settings.SEARCH_CURSOR_PAGINATION:
+        page = get_cursor_page_from_search(search, params, sort_field, sort_dir)
+        return page, page.response, page.object_list
+    page, response = execute_page_from_search(search, params)
+    return page, response, response.hits
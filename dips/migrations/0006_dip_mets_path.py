@@ -0,0 +1,18 @@
+# Generated by Django 2.1.7 on 2026-10-17 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dips', '0005_alter_dublincore_language'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dip',
+            name='mets_path',
+            field=models.CharField(blank=True, max_length=500),
+        ),
+    ]
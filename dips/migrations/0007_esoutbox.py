@@ -0,0 +1,23 @@
+# Generated by Django 2.1.7 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dips', '0006_dip_mets_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EsOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=50)),
+                ('object_id', models.CharField(max_length=36)),
+                ('op', models.CharField(max_length=6)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.1.7 on 2026-10-17 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dips', '0007_esoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EsDescendantsUpdate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=50)),
+                ('object_id', models.IntegerField()),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('done_version', models.PositiveIntegerField(default=0)),
+                ('skipped', models.PositiveIntegerField(default=0)),
+                ('requested', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='esdescendantsupdate',
+            unique_together={('model', 'object_id')},
+        ),
+    ]
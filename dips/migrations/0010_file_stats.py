@@ -0,0 +1,65 @@
+# Generated by Django 2.1.7 on 2026-10-17 15:00
+
+from django.db import migrations, models
+import jsonfield.encoder
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dips', '0009_esindexingcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='earliest_datemodified',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='collection',
+            name='file_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='collection',
+            name='format_counts',
+            field=jsonfield.fields.JSONField(default=dict, dump_kwargs={'cls': jsonfield.encoder.JSONEncoder, 'separators': (',', ':')}, load_kwargs={}),
+        ),
+        migrations.AddField(
+            model_name='collection',
+            name='latest_datemodified',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='collection',
+            name='total_size_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='dip',
+            name='earliest_datemodified',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='dip',
+            name='file_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='dip',
+            name='format_counts',
+            field=jsonfield.fields.JSONField(default=dict, dump_kwargs={'cls': jsonfield.encoder.JSONEncoder, 'separators': (',', ':')}, load_kwargs={}),
+        ),
+        migrations.AddField(
+            model_name='dip',
+            name='latest_datemodified',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='dip',
+            name='total_size_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.1.7 on 2026-10-17 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dips', '0010_file_stats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='digitalfile',
+            index=models.Index(fields=['dip', 'fileformat'], name='dips_file_dip_format_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='digitalfile',
+            index=models.Index(fields=['dip', 'datemodified'], name='dips_file_dip_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='premisevent',
+            index=models.Index(fields=['digitalfile', 'datetime'], name='dips_premis_file_date_idx'),
+        ),
+    ]
@@ -9,17 +9,25 @@ and a `get_es_data` method to transform to a dictionary representation of
 the ES document.
 """
 from abc import ABCMeta, abstractmethod
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from django.conf import settings
 from django.contrib.auth.models import Group, AbstractUser
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Max, Min, Sum
 from django.utils.translation import gettext, gettext_lazy as _
 from django_celery_results.models import TaskResult as CeleryTaskResult
 from jsonfield import JSONField
 
 from search.documents import CollectionDoc, DIPDoc, DigitalFileDoc
-from search.helpers import delete_document
+from search.cache import bump_search_generation
+from search.helpers import (defer_indexing, deferred_indexing,
+                            delete_document, discard_deferred_indexing,
+                            is_indexing_deferred)
 from scope.celery import app as celery_app
 from .helpers import add_if_not_empty
+from .settings_cache import get_settings_values
+
+import copy
 
 
 class TaskResult(CeleryTaskResult):
@@ -34,20 +42,32 @@ class TaskResult(CeleryTaskResult):
 
 
 class User(AbstractUser):
+    # Cached group names, see `get_group_names`
+    _group_names = None
+
     def group_names(self):
         return ', '.join(list(self.groups.values_list('name', flat=True)))
 
+    def get_group_names(self):
+        """
+        Returns a set with the user group names, obtained in a single query
+        and cached in the instance, so the role checks are resolved once per
+        request for `request.user`. The cache must be cleared with
+        `clear_group_names` when the user groups are changed.
+        """
+        if self._group_names is None:
+            self._group_names = set(
+                self.groups.values_list('name', flat=True))
+        return self._group_names
+
+    def clear_group_names(self):
+        self._group_names = None
+
     def is_editor(self):
-        return (
-            self.is_superuser or
-            self.groups.filter(name='Editors').exists()
-        )
+        return self.is_superuser or 'Editors' in self.get_group_names()
 
     def is_manager(self):
-        return (
-            self.is_superuser or
-            self.groups.filter(name='Managers').exists()
-        )
+        return self.is_superuser or 'Managers' in self.get_group_names()
 
     @classmethod
     def get_users(cls, query=None, sort_field='username'):
@@ -84,35 +104,81 @@ class AbstractModelMeta(ABCMeta, type(models.Model)):
 
 class AbstractEsModel(models.Model, metaclass=AbstractModelMeta):
     """Abstract base model for models related to ES DocTypes."""
+    # Last change, used to index only the modified objects in ES
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    # Whether the model has descendant documents in ES, which are updated
+    # with the EsDescendantsUpdate requests.
+    has_es_descendants = False
+
+    # Whether the last save or delete launched the descendants update
+    # or delete in ES.
+    es_descendants_updated = False
+    es_descendants_deleted = False
+
     class Meta:
         abstract = True
 
-    def save(self, update_es=True, *args, **kwargs):
-        """Extended save to optionally update related documents in ES."""
-        super(AbstractEsModel, self).save(*args, **kwargs)
+    def save(self, update_es=True, *args, update_es_descendants=True,
+             **kwargs):
+        """
+        Extended save to optionally update related documents in ES. When the
+        `ES_OUTBOX` setting is enabled, the update is recorded in the outbox
+        in the same transaction. Within `search.helpers.deferred_indexing`,
+        the document is indexed in bulk with the other saved instances,
+        otherwise it's indexed immediately. The descendant documents are
+        not updated when `update_es_descendants` is `False`, for changes
+        in fields not included in them.
+        """
         if not update_es:
+            super(AbstractEsModel, self).save(*args, **kwargs)
             return
-        # Use refresh to reflect the changes in the index in the same request
-        self.to_es_doc().save(refresh=True)
-        # Update descendant DigitalFiles if needed
-        if self.requires_es_descendants_update():
-            # Launch async. task by name to avoid circular imports
-            # or to import the task within this function.
-            celery_app.send_task(
-                'dips.tasks.update_es_descendants',
-                args=(self.__class__.__name__, self.pk))
+        if settings.ES_OUTBOX:
+            with transaction.atomic():
+                super(AbstractEsModel, self).save(*args, **kwargs)
+                EsOutbox.add(self, EsOutbox.OP_INDEX)
+        elif is_indexing_deferred():
+            super(AbstractEsModel, self).save(*args, **kwargs)
+            defer_indexing(self)
+        else:
+            super(AbstractEsModel, self).save(*args, **kwargs)
+            # Use refresh to reflect the changes in the index in the same
+            # request, required by the interactive edits.
+            self.to_es_doc().save(refresh=True)
+            bump_search_generation(self.es_doc._index._name, refreshed=True)
+        # Update descendant DigitalFiles if needed, keeping the check
+        # result to avoid repeating it after the save.
+        self.es_descendants_updated = (
+            update_es_descendants and self.requires_es_descendants_update())
+        if self.es_descendants_updated:
+            EsDescendantsUpdate.schedule(self)
 
     def delete(self, *args, **kwargs):
-        """Extended delete to remove related documents in ES."""
-        self.delete_es_doc()
-        # Delete descendants if needed
-        if self.requires_es_descendants_delete():
-            # Launch async. task by name to avoid circular imports
-            # or to import the task within this function.
-            celery_app.send_task(
-                'dips.tasks.delete_es_descendants',
-                args=(self.__class__.__name__, self.pk))
-        super(AbstractEsModel, self).delete(*args, **kwargs)
+        """
+        Extended delete to remove related documents in ES. When the
+        `ES_OUTBOX` setting is enabled, the removal is recorded in the
+        outbox in the same transaction.
+        """
+        discard_deferred_indexing(self)
+        with transaction.atomic():
+            if settings.ES_OUTBOX:
+                EsOutbox.add(self, EsOutbox.OP_DELETE)
+            else:
+                self.delete_es_doc()
+            # Discard pending descendants updates
+            if self.has_es_descendants:
+                EsDescendantsUpdate.objects.filter(
+                    model=self.__class__.__name__, object_id=self.pk).delete()
+            # Delete descendants if needed, keeping the check
+            # result to avoid repeating it after the delete.
+            self.es_descendants_deleted = self.requires_es_descendants_delete()
+            if self.es_descendants_deleted:
+                # Launch async. task by name to avoid circular imports
+                # or to import the task within this function.
+                celery_app.send_task(
+                    'dips.tasks.delete_es_descendants',
+                    args=(self.__class__.__name__, self.pk))
+            super(AbstractEsModel, self).delete(*args, **kwargs)
 
     # Declaration in abstract class must be as property to allow decorators.
     # Implementation in descendats must be as attribute to avoid setter/getter.
@@ -133,9 +199,31 @@ class AbstractEsModel(models.Model, metaclass=AbstractModelMeta):
     def requires_es_descendants_delete(self):
         """Checks if descendants need to be updated in ES."""
 
-    def to_es_doc(self):
-        """Model transformation to related DocType."""
-        data = self.get_es_data()
+    # Related fields selected to build the ES data in bulk
+    es_related_fields = []
+
+    @classmethod
+    def get_es_queryset(cls):
+        """
+        Get a QuerySet selecting the related fields used in `get_es_data`,
+        to use with `get_es_data_in_bulk`.
+        """
+        return cls.objects.select_related(*cls.es_related_fields)
+
+    @classmethod
+    def get_es_data_in_bulk(cls, instances):
+        """
+        Get the ES data of a list of instances. Instances obtained with
+        `get_es_queryset` don't require extra queries per instance.
+        """
+        return [instance.get_es_data() for instance in instances]
+
+    def to_es_doc(self, data=None):
+        """
+        Model transformation to related DocType, optionally from
+        precomputed ES data.
+        """
+        data = dict(data) if data is not None else self.get_es_data()
         return self.es_doc(meta={'id': data.pop('_id')}, **data)
 
     def delete_es_doc(self):
@@ -147,6 +235,147 @@ class AbstractEsModel(models.Model, metaclass=AbstractModelMeta):
         )
 
 
+def _send_drain_es_outbox():
+    """Launch the task to process the ES outbox by name."""
+    celery_app.send_task('dips.tasks.drain_es_outbox')
+
+
+class EsOutbox(models.Model):
+    """
+    ES operations pending for AbstractEsModel instances. They are recorded
+    in the same transaction as the database changes, when the `ES_OUTBOX`
+    setting is enabled, and processed in bulk by `drain_es_outbox`.
+    """
+    model = models.CharField(max_length=50)
+    object_id = models.CharField(max_length=36)
+    op = models.CharField(max_length=6)
+    created = models.DateTimeField(auto_now_add=True)
+
+    # Operations
+    OP_INDEX = 'index'
+    OP_DELETE = 'delete'
+
+    def __str__(self):
+        return '%s %s [%s]' % (self.op, self.model, self.object_id)
+
+    @classmethod
+    def add(cls, instance, op):
+        """
+        Record an operation for an instance and launch the task to process
+        the outbox once the transaction is committed, only once for all the
+        operations recorded in the same transaction.
+        """
+        cls.objects.create(
+            model=instance.__class__.__name__,
+            object_id=str(instance.pk),
+            op=op,
+        )
+        cls._drain_on_commit()
+
+    @classmethod
+    def add_in_bulk(cls, model, object_ids, op, batch_size=None):
+        """
+        Record an operation for the instances of a model with the given
+        primary keys, without getting them, like `add`.
+        """
+        cls.objects.bulk_create([
+            cls(model=model.__name__, object_id=str(object_id), op=op)
+            for object_id in object_ids
+        ], batch_size=batch_size)
+        cls._drain_on_commit()
+
+    @staticmethod
+    def _drain_on_commit():
+        if not any(func is _send_drain_es_outbox
+                   for _, func in connection.run_on_commit):
+            transaction.on_commit(_send_drain_es_outbox)
+
+
+class EsDescendantsUpdate(models.Model):
+    """
+    Descendant DigitalFiles updates in ES requested for a Collection or DIP.
+    Each request increases the `version` and launches the update task after
+    the `ES_DESCENDANTS_UPDATE_DELAY` debounce window. Only the task with
+    the latest version runs, with the ancestor state at that moment, and
+    the superseded ones are skipped and counted.
+    """
+    model = models.CharField(max_length=50)
+    object_id = models.IntegerField()
+    version = models.PositiveIntegerField(default=0)
+    done_version = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    requested = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('model', 'object_id')
+
+    def __str__(self):
+        return '%s [%s]' % (self.model, self.object_id)
+
+    @classmethod
+    def schedule(cls, instance):
+        """
+        Request an update of the descendants of an instance, launching the
+        update task by name to avoid circular imports.
+        """
+        model = instance.__class__.__name__
+        with transaction.atomic():
+            update, _ = cls.objects.get_or_create(
+                model=model, object_id=instance.pk)
+            update.version = F('version') + 1
+            update.save()
+            update.refresh_from_db(fields=['version'])
+        celery_app.send_task(
+            'dips.tasks.update_es_descendants',
+            args=(model, instance.pk),
+            kwargs={'version': update.version},
+            countdown=settings.ES_DESCENDANTS_UPDATE_DELAY,
+        )
+
+    @classmethod
+    def start(cls, model, object_id, version):
+        """
+        Mark a requested update as started and return `True` if it's the
+        latest one. Otherwise, count it as skipped and return `False`.
+        """
+        updates = cls.objects.filter(model=model, object_id=object_id)
+        if updates.filter(version=version).update(done_version=version):
+            return True
+        updates.update(skipped=F('skipped') + 1)
+        return False
+
+    @classmethod
+    def get_stats(cls):
+        """
+        Return the amount of ancestors with pending descendants updates
+        and the amount of skipped updates.
+        """
+        return {
+            'pending': cls.objects.filter(
+                version__gt=F('done_version')).count(),
+            'skipped': cls.objects.aggregate(
+                skipped=Sum('skipped'))['skipped'] or 0,
+        }
+
+
+class EsIndexingCheckpoint(models.Model):
+    """
+    Progress of the `index_data` command per model, with the new index being
+    filled and the primary key of the last object indexed in it, to resume
+    an interrupted run. The run start is kept to catch up with the changes
+    made since then.
+    """
+    model = models.CharField(max_length=50, unique=True)
+    index = models.CharField(max_length=255)
+    last_pk = models.CharField(max_length=50, null=True)
+    done = models.BooleanField(default=False)
+    started = models.DateTimeField()
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s [%s]' % (self.model, self.index)
+
+
 class DublinCore(models.Model):
     identifier = models.CharField(_('identifier'), max_length=50)
     title = models.CharField(_('title'), max_length=200, blank=True)
@@ -221,19 +450,138 @@ class DublinCore(models.Model):
         Returns a list with enabled field names based on
         `enabled_dc_fields` setting.
         """
-        setting = Setting.objects.get(name='enabled_optional_dc_fields')
-        return cls.REQUIRED_FIELDS + setting.value
+        return cls.REQUIRED_FIELDS + Setting.get_value(
+            'enabled_optional_dc_fields')
 
     @classmethod
     def hide_empty_fields(cls):
         """
         Returns a boolean based on `hide_empty_dc_fields` setting.
         """
-        setting = Setting.objects.get(name='hide_empty_dc_fields')
-        return setting.value
+        return Setting.get_value('hide_empty_dc_fields')
+
+
+class FileStatsDelta(object):
+    """
+    Changes in the DigitalFiles statistics of a DIP from the values of the
+    added and removed DigitalFiles, applied with `DIP.update_file_stats`.
+    """
 
+    def __init__(self):
+        self.file_count = 0
+        self.total_size_bytes = 0
+        self.format_counts = Counter()
+        # Range of the added and removed `datemodified` values
+        self.added_dates = None
+        self.removed_dates = None
+
+    def __bool__(self):
+        return bool(self.file_count or self.total_size_bytes or any(
+            self.format_counts.values()) or self.added_dates or
+            self.removed_dates)
+
+    @staticmethod
+    def _extend_range(dates, date):
+        if date is None:
+            return dates
+        if dates is None:
+            return (date, date)
+        return (min(dates[0], date), max(dates[1], date))
+
+    def add(self, size_bytes, fileformat, datemodified):
+        self.file_count += 1
+        self.total_size_bytes += size_bytes
+        self.format_counts[fileformat] += 1
+        self.added_dates = self._extend_range(self.added_dates, datemodified)
+
+    def remove(self, size_bytes, fileformat, datemodified):
+        self.file_count -= 1
+        self.total_size_bytes -= size_bytes
+        self.format_counts[fileformat] -= 1
+        self.removed_dates = self._extend_range(
+            self.removed_dates, datemodified)
+
+
+class FileStats(models.Model):
+    """
+    Abstract model with the statistics of the DigitalFiles contained in a
+    DIP or Collection, denormalized to display and index them without
+    aggregating the DigitalFiles. They are only saved with the
+    `update_file_stats` method of the extending models: regular saves of
+    existing rows leave the statistics fields out of the UPDATE, unless
+    they are included explicitly in `update_fields`.
+    """
+    file_count = models.PositiveIntegerField(default=0)
+    total_size_bytes = models.BigIntegerField(default=0)
+    earliest_datemodified = models.DateTimeField(blank=True, null=True)
+    latest_datemodified = models.DateTimeField(blank=True, null=True)
+    # Amount of DigitalFiles by format name
+    format_counts = JSONField(default=dict)
+
+    FILE_STATS_FIELDS = [
+        'file_count', 'total_size_bytes', 'earliest_datemodified',
+        'latest_datemodified', 'format_counts',
+    ]
+    # Amount of formats included in `top_formats`
+    TOP_FORMATS = 10
 
-class Collection(AbstractEsModel):
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        """
+        Extended save to not overwrite the statistics of existing rows, which
+        may have been changed by a parallel import since the instance was
+        obtained.
+        """
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.name not in self.FILE_STATS_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+    @property
+    def top_formats(self):
+        """List of the most common formats and their amount of files."""
+        return sorted(
+            self.format_counts.items(),
+            key=lambda item: (-item[1], item[0]),
+        )[:self.TOP_FORMATS]
+
+    def get_file_stats_data(self):
+        """Returns the statistics data for the ES documents."""
+        data = {
+            'file_count': self.file_count,
+            'total_size_bytes': self.total_size_bytes,
+            'top_formats': [
+                {'name': name, 'count': count}
+                for name, count in self.top_formats
+            ],
+        }
+        add_if_not_empty(
+            data, 'earliest_datemodified', self.earliest_datemodified)
+        add_if_not_empty(
+            data, 'latest_datemodified', self.latest_datemodified)
+        return data
+
+    def _save_file_stats(self, instance):
+        """
+        Save the statistics of an instance of the same object, locked for
+        update, and copy them to this one. Only the related document is
+        updated in ES, as the DigitalFiles documents don't include them.
+        """
+        with deferred_indexing():
+            instance.save(
+                update_fields=self.FILE_STATS_FIELDS + ['modified'],
+                update_es_descendants=False,
+            )
+        for field in self.FILE_STATS_FIELDS:
+            setattr(self, field, getattr(instance, field))
+
+
+class Collection(FileStats, AbstractEsModel):
     link = models.URLField(_('finding aid'), blank=True)
     dc = models.OneToOneField(DublinCore, null=True, on_delete=models.SET_NULL)
 
@@ -241,6 +589,8 @@ class Collection(AbstractEsModel):
         return str(self.dc) or str(self.pk)
 
     es_doc = CollectionDoc
+    has_es_descendants = True
+    es_related_fields = ['dc']
 
     def get_es_data(self):
         data = {
@@ -250,6 +600,8 @@ class Collection(AbstractEsModel):
         if self.dc:
             data['dc'] = self.dc.get_es_inner_data()
 
+        data['file_stats'] = self.get_file_stats_data()
+
         return data
 
     def get_es_data_for_files(self):
@@ -259,17 +611,42 @@ class Collection(AbstractEsModel):
             add_if_not_empty(data, 'title', self.dc.title)
         return data
 
+    def update_file_stats(self):
+        """
+        Update the DigitalFiles statistics from the ones of the DIPs in the
+        Collection. It should be called within the transaction changing them.
+        """
+        with transaction.atomic():
+            collection = Collection.objects.select_for_update().get(
+                pk=self.pk)
+            dips = DIP.objects.filter(collection_id=self.pk)
+            aggregates = dips.aggregate(
+                file_count=Sum('file_count'),
+                total_size_bytes=Sum('total_size_bytes'),
+                earliest_datemodified=Min('earliest_datemodified'),
+                latest_datemodified=Max('latest_datemodified'),
+            )
+            format_counts = Counter()
+            for counts in dips.values_list('format_counts', flat=True):
+                format_counts.update(counts)
+            collection.file_count = aggregates['file_count'] or 0
+            collection.total_size_bytes = aggregates['total_size_bytes'] or 0
+            collection.earliest_datemodified = aggregates[
+                'earliest_datemodified']
+            collection.latest_datemodified = aggregates['latest_datemodified']
+            collection.format_counts = dict(format_counts)
+            self._save_file_stats(collection)
+
     def requires_es_descendants_update(self):
         # No metadata needs to be updated in descandant DIPs
-        count = DigitalFile.objects.filter(dip__collection__pk=self.pk).count()
-        return count > 0
+        return DigitalFile.objects.filter(dip__collection__pk=self.pk).exists()
 
     def requires_es_descendants_delete(self):
         # There won't be DigitalFiles if there are no DIPs
-        return self.dips.count() > 0
+        return self.dips.exists()
 
 
-class DIP(AbstractEsModel):
+class DIP(FileStats, AbstractEsModel):
     objectszip = models.FileField(_('objects zip file'))
     uploaded = models.DateTimeField(auto_now_add=True)
     collection = models.ForeignKey(
@@ -292,6 +669,9 @@ class DIP(AbstractEsModel):
     # task is called from the `new_dip` view and to `SUCCESS` or `FAILURE` when
     # the task ends from within the task's `after_return` method.
     import_status = models.CharField(max_length=7, null=True)
+    # Location of the METS file in the objects zip file, used as a hint to
+    # avoid searching it over all the zip file entries on later imports.
+    mets_path = models.CharField(max_length=500, blank=True)
 
     # Import statuses
     IMPORT_PENDING = 'PENDING'
@@ -311,6 +691,8 @@ class DIP(AbstractEsModel):
         }
 
     es_doc = DIPDoc
+    has_es_descendants = True
+    es_related_fields = ['dc', 'collection']
 
     def get_es_data(self):
         data = {
@@ -325,8 +707,68 @@ class DIP(AbstractEsModel):
         if self.collection:
             data['collection'] = {'id': self.collection.pk}
 
+        data['file_stats'] = self.get_file_stats_data()
+
         return data
 
+    def update_file_stats(self, delta=None, update_collection=True):
+        """
+        Update the DigitalFiles statistics incrementally from a
+        `FileStatsDelta`, or from all the DIP DigitalFiles if it's not
+        given, and the Collection statistics if `update_collection` is
+        `True`. It should be called within the transaction changing the
+        DigitalFiles, after the changes. The DIP row is locked until the
+        transaction ends to apply the changes from parallel imports in order.
+        """
+        with transaction.atomic():
+            dip = DIP.objects.select_for_update().get(pk=self.pk)
+            files = DigitalFile.objects.filter(dip_id=self.pk)
+            if delta is None:
+                aggregates = files.aggregate(
+                    file_count=Count('pk'),
+                    total_size_bytes=Sum('size_bytes'),
+                )
+                dip.file_count = aggregates['file_count']
+                dip.total_size_bytes = aggregates['total_size_bytes'] or 0
+                dip.format_counts = dict(
+                    files.order_by().values_list('fileformat').annotate(
+                        count=Count('pk')))
+            else:
+                dip.file_count += delta.file_count
+                dip.total_size_bytes += delta.total_size_bytes
+                format_counts = Counter(dip.format_counts)
+                format_counts.update(delta.format_counts)
+                dip.format_counts = {
+                    name: count for name, count in format_counts.items()
+                    if count > 0
+                }
+            removed = delta.removed_dates if delta else None
+            # The dates range only needs to be obtained from the DigitalFiles
+            # when one of its limits may have been removed.
+            if delta is None or (removed and (
+                    dip.earliest_datemodified is None or
+                    removed[0] <= dip.earliest_datemodified or
+                    removed[1] >= dip.latest_datemodified)):
+                aggregates = files.aggregate(
+                    earliest=Min('datemodified'), latest=Max('datemodified'))
+                dip.earliest_datemodified = aggregates['earliest']
+                dip.latest_datemodified = aggregates['latest']
+            elif delta.added_dates:
+                added = delta.added_dates
+                if dip.earliest_datemodified is not None:
+                    added = (min(added[0], dip.earliest_datemodified),
+                             max(added[1], dip.latest_datemodified))
+                dip.earliest_datemodified, dip.latest_datemodified = added
+            self._save_file_stats(dip)
+            if update_collection:
+                dip.collection.update_file_stats()
+
+    def delete(self, *args, **kwargs):
+        """Extended delete to update the Collection statistics."""
+        with transaction.atomic():
+            super().delete(*args, **kwargs)
+            self.collection.update_file_stats()
+
     def get_es_data_for_files(self):
         data = {'id': self.pk}
         add_if_not_empty(data, 'import_status', self.import_status)
@@ -336,7 +778,7 @@ class DIP(AbstractEsModel):
         return data
 
     def requires_es_descendants_update(self):
-        return self.digital_files.count() > 0
+        return self.digital_files.exists()
 
     def requires_es_descendants_delete(self):
         return self.requires_es_descendants_update()
@@ -387,12 +829,27 @@ class DigitalFile(AbstractEsModel):
         on_delete=models.CASCADE,
     )
 
+    class Meta:
+        # The statistics of each DIP are grouped by format and obtain the
+        # dates range from its DigitalFiles, using only these indexes.
+        indexes = [
+            models.Index(
+                fields=['dip', 'fileformat'], name='dips_file_dip_format_idx'),
+            models.Index(
+                fields=['dip', 'datemodified'], name='dips_file_dip_date_idx'),
+        ]
+
     def __str__(self):
         return self.uuid
 
     es_doc = DigitalFileDoc
 
-    def get_es_data(self):
+    def get_es_data(self, ancestors=None):
+        """
+        Get the ES data, with the ancestors data from the map returned by
+        `get_es_ancestors` if it's given, to avoid the DIP and Collection
+        queries per DigitalFile.
+        """
         data = {
             '_id': self.pk,
             'uuid': self.uuid,
@@ -405,19 +862,51 @@ class DigitalFile(AbstractEsModel):
         add_if_not_empty(data, 'datemodified', self.datemodified)
 
         # Ancestors data
-        if self.dip:
-            data['dip'] = self.dip.get_es_data_for_files()
-            if self.dip.collection:
-                data['collection'] = self.dip.collection.get_es_data_for_files()
+        if ancestors is not None and self.dip_id in ancestors:
+            data.update(ancestors[self.dip_id])
+        elif self.dip:
+            data.update(self.get_es_ancestors_data(self.dip))
+
+        return data
 
+    @staticmethod
+    def get_es_ancestors_data(dip):
+        """Get the DIP and Collection data added to the DigitalFiles."""
+        data = {'dip': dip.get_es_data_for_files()}
+        if dip.collection:
+            data['collection'] = dip.collection.get_es_data_for_files()
         return data
 
+    @classmethod
+    def get_es_ancestors(cls, dip_ids):
+        """
+        Get a map with the ancestors data by DIP id for the given DIPs,
+        obtained in a single query.
+        """
+        dips = DIP.objects.filter(pk__in=set(dip_ids)).select_related(
+            'dc', 'collection__dc')
+        return {dip.pk: cls.get_es_ancestors_data(dip) for dip in dips}
+
+    @classmethod
+    def get_es_data_in_bulk(cls, instances):
+        ancestors = cls.get_es_ancestors(
+            instance.dip_id for instance in instances)
+        return [instance.get_es_data(ancestors) for instance in instances]
+
     def requires_es_descendants_update(self):
         return False
 
     def requires_es_descendants_delete(self):
         return False
 
+    def delete(self, *args, **kwargs):
+        """Extended delete to update the DIP and Collection statistics."""
+        with transaction.atomic():
+            super().delete(*args, **kwargs)
+            delta = FileStatsDelta()
+            delta.remove(self.size_bytes, self.fileformat, self.datemodified)
+            self.dip.update_file_stats(delta)
+
 
 class PREMISEvent(models.Model):
     uuid = models.CharField(max_length=36, primary_key=True)
@@ -432,6 +921,14 @@ class PREMISEvent(models.Model):
         on_delete=models.CASCADE,
     )
 
+    class Meta:
+        # The events are displayed sorted by datetime for each DigitalFile
+        indexes = [
+            models.Index(
+                fields=['digitalfile', 'datetime'],
+                name='dips_premis_file_date_idx'),
+        ]
+
     def __str__(self):
         return self.uuid
 
@@ -452,3 +949,20 @@ class Setting(models.Model):
 
     def __str__(self):
         return self.name
+
+    @classmethod
+    def load_values(cls):
+        """Returns a dictionary with all the settings name > value."""
+        return dict(cls.objects.values_list('name', 'value'))
+
+    @classmethod
+    def get_value(cls, name):
+        """
+        Returns a copy of a setting value from the settings cache, which
+        avoids the database queries.
+        """
+        values = get_settings_values(cls.load_values)
+        if name not in values:
+            raise cls.DoesNotExist(
+                'Setting matching query does not exist: %s.' % name)
+        return copy.deepcopy(values[name])
@@ -1,12 +1,18 @@
 from datetime import datetime, timezone
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl.connections import connections
 from lxml import etree, objectify
 
 import logging
 import os
 
-from .helpers import convert_size, update_instance_from_dict
-from .models import DIP, DigitalFile, PREMISEvent
+from .helpers import (bulk_update, chunks, convert_size,
+                      update_instance_from_dict)
+from .models import DIP, DigitalFile, EsOutbox, FileStatsDelta, PREMISEvent
+from search.cache import bump_search_generation
 
 logger = logging.getLogger('dips.parsemets')
 
@@ -41,138 +47,264 @@ class METS(object):
         ('detailnote', './xmlData/event/eventOutcomeInformation/eventOutcomeDetail/eventOutcomeDetailNote'),
     ]
 
-    def __init__(self, path, dip_id):
-        self.path = os.path.abspath(path)
+    def __init__(self, source, dip_id, streaming=False, batch_size=None,
+                 incremental=False):
+        # The METS file can be a path or a file-like object, for example,
+        # the one returned by `ZipFile.open` to read it from the DIP zip file.
+        if isinstance(source, str):
+            self.path = os.path.abspath(source)
+            self.source = self.path
+        else:
+            self.path = getattr(source, 'name', repr(source))
+            self.source = source
         self.dip_id = dip_id
-        self.mets_root = self._get_mets_root()
+        # Amount of original files saved to the database per batch,
+        # it defaults to the `METS_BATCH_SIZE` setting.
+        self.batch_size = batch_size or settings.METS_BATCH_SIZE
+        # In incremental mode only the changed DigitalFiles are saved and
+        # indexed, and the ones missing in the METS file are removed.
+        self.incremental = incremental
+        # In streaming mode the METS file is parsed incrementally with
+        # `iterparse` when `parse_mets` is called, clearing the processed
+        # elements to keep the memory usage bounded. Otherwise, the entire
+        # tree is loaded in memory on initialization.
+        self.streaming = streaming
+        if self.streaming and not self._is_rewindable():
+            raise METSError(
+                'The METS file must be seekable to be parsed in streaming '
+                'mode (%s).' % self.path
+            )
+        if not self.streaming:
+            self.mets_root = self._get_mets_root()
+            self.sections = self._get_sections()
 
     def __str__(self):
         return self.path
 
+    def _is_rewindable(self):
+        """Check if the METS file can be parsed more than once."""
+        return isinstance(self.source, str) or self.source.seekable()
+
+    def _rewind(self):
+        """Move file-like sources to the start to parse them again."""
+        if not isinstance(self.source, str):
+            self.source.seek(0)
+
     def _get_mets_root(self):
         """
         Open XML and return the root element with all namespaces stripped.
         """
-        tree = etree.parse(self.path)
+        tree = etree.parse(self.source)
         root = tree.getroot()
-        for elem in root.getiterator():
+        self._strip_namespaces(root)
+        objectify.deannotate(root, cleanup_namespaces=True)
+        return root
+
+    @staticmethod
+    def _strip_namespaces(element):
+        """Strip namespaces from the tags of an element and its descendants."""
+        for elem in element.iter():
             if not hasattr(elem.tag, 'find'):
                 continue
             i = elem.tag.find('}')
             if i >= 0:
                 elem.tag = elem.tag[i + 1:]
-        objectify.deannotate(root, cleanup_namespaces=True)
-        return root
+
+    @staticmethod
+    def _clear_element(element):
+        """
+        Clear a processed element and its preceding siblings to free the
+        memory used by them during `iterparse`.
+        """
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    def _get_sections(self):
+        """
+        Return a dictionary with the amdSec and dmdSec elements by ID, built
+        in a single pass over the METS root, to avoid searching the entire
+        tree each time an ADMID or DMDID needs to be resolved.
+        """
+        sections = {}
+        for section in self.mets_root.iter('amdSec', 'dmdSec'):
+            sections[section.get('ID')] = section
+        return sections
 
     def parse_mets(self):
         """
         Parse METS and save data to DIP, DigitalFile, and PremisEvent models.
+        All the changes are made in a single transaction and the DigitalFiles
+        are indexed in ES once it's committed. Returns a dictionary with the
+        amount of created, updated, unchanged and removed DigitalFiles.
         """
         # Get DIP object
         dip = DIP.objects.get(pk=self.dip_id)
         logger.info('Starting METS parsing process for DIP [Identifier: %s]' % dip.dc.identifier)
 
-        # Gather info for each file in filegroup "original"
-        for file_ in self.mets_root.findall(".//fileGrp[@USE='original']/file"):
-            amdsec_id = file_.attrib['ADMID']
+        importer = DigitalFileImporter(
+            dip, batch_size=self.batch_size, incremental=self.incremental)
+        with transaction.atomic():
+            # Gather info for each file in filegroup "original"
+            importer.save(self.get_original_files())
+            if self.incremental:
+                importer.remove_missing()
+            importer.update_file_stats()
+            # Gather Dublin Core metadata from most recent
+            # dmdSec and update DIP DublinCore object.
+            importer.update_dc(self.parse_dc())
+        importer.index()
+        logger.info(
+            'DigitalFiles created: %(created)d, updated: %(updated)d, '
+            'unchanged: %(unchanged)d, removed: %(removed)d' % importer.counts)
+        return importer.counts
+
+    def get_original_admids(self):
+        """
+        List with the ADMIDs of the files in filegroup "original", in the
+        fileSec order. In streaming mode, it requires a pass over the METS
+        file, which also gathers the SIP Dublin Core metadata.
+        """
+        if self.streaming:
+            return self._iterparse_original_admids()
+        return [
+            self._get_admid(file_) for file_ in
+            self.mets_root.findall(".//fileGrp[@USE='original']/file")
+        ]
+
+    @staticmethod
+    def _get_admid(file_):
+        """Get the ADMID of a file element, which is required."""
+        admid = file_.get('ADMID')
+        if not admid:
+            raise METSError(
+                'An original file in this METS file is missing its ADMID.'
+            )
+        return admid
+
+    def get_original_files(self, admids=None):
+        """
+        Generator with the file metadata and events list of each file in
+        filegroup "original", or only of the files with the given `admids`.
+        The metadata is not transformed to allow its serialization.
+        """
+        if self.streaming:
+            return self._iterparse_original_files(admids)
+        return self._get_original_files(admids)
+
+    def _get_original_files(self, admids=None):
+        """
+        Generator with the file metadata and events list of each file in
+        filegroup "original", or with the given `admids`, from the METS root.
+        """
+        if admids is None:
+            admids = self.get_original_admids()
+        for amdsec_id in admids:
             logger.info('Parsing original file metadata from AMD section [ADMID: %s]' % amdsec_id)
-            file_data, premis_events = self._parse_file_metadata(amdsec_id)
-            file_data = self._transform_file_metadata(file_data)
+            yield self._parse_file_metadata(amdsec_id)
 
-            # Check mandatory UUID field
-            uuid = file_data.pop('uuid', None)
-            if not uuid:
-                raise METSError(
-                    'An original file in this METS file is missing its UUID.'
-                )
-            # Get existing DigitalFile by UUID
-            try:
-                digitalfile = DigitalFile.objects.get(uuid=uuid)
-                # Don't update DigitalFile from other DIP
-                if digitalfile.dip.pk != dip.pk:
-                    raise METSError(
-                        'An original file in this METS file has the same UUID '
-                        'as an existing one from another DIP '
-                        '(%s).' % uuid
-                    )
-                logger.info('Updating DigitalFile [UUID: %s]' % uuid)
-            except DigitalFile.DoesNotExist:
-                # Create DigitalFIle if it doesn't exist
-                digitalfile = DigitalFile(uuid=uuid)
-                logger.info('Creating DigitalFile [UUID: %s]' % uuid)
-            # Add/update instance fields with file_data values
-            digitalfile = update_instance_from_dict(digitalfile, file_data)
-            digitalfile.dip = dip
-            # Validate
-            try:
-                digitalfile.full_clean()
-            except ValidationError as e:
-                message = 'A DigitalFile could not be created:'
-                for field, errors in e.message_dict.items():
-                    message += '\n- %s: %s' % (field, ' '.join(errors))
-                raise METSError(message)
-            digitalfile.save()
-
-            # Add premis events data to PREMISEvent model
-            for event in premis_events:
-                # Check mandatory UUID field
-                uuid = event.pop('uuid', None)
-                if not uuid:
-                    raise METSError(
-                        'A PREMISEvent in this METS file is missing its UUID.'
-                    )
-                # Get existing PREMISEvent by UUID
-                try:
-                    premisevent = PREMISEvent.objects.get(uuid=uuid)
-                    # Don't update PREMISEvent from other DigitalFile
-                    if premisevent.digitalfile.uuid != digitalfile.uuid:
-                        raise METSError(
-                            'A PREMISEvent in this METS file has the same '
-                            'UUID as an existing one from another DIP '
-                            '(%s).' % uuid
-                        )
-                        logger.info('Updating PREMISEvent [UUID: %s]' % uuid)
-                except PREMISEvent.DoesNotExist:
-                    # Create PREMISEvent if it doesn't exist
-                    premisevent = PREMISEvent(uuid=uuid)
-                    logger.info('Creating PREMISEvent [UUID: %s]' % uuid)
-                # Add/update instance fields with event values
-                premisevent = update_instance_from_dict(premisevent, event)
-                premisevent.digitalfile = digitalfile
-                # Validate
-                try:
-                    premisevent.full_clean()
-                except ValidationError as e:
-                    message = 'A PREMISEvent could not be created:'
-                    for field, errors in e.message_dict.items():
-                        message += '\n- %s: %s' % (field, ' '.join(errors))
-                    raise METSError(message)
-                premisevent.save()
-
-        # Gather Dublin Core metadata from most recent
-        # dmdSec and update DIP DublinCore object.
-        dc_data = self._parse_dc()
-        if dc_data:
-            logger.info('Updating DIP Dublin Core metadata')
-            # No validation is needed as all the fields are non
-            # required string fields initiated with empty strings.
-            dip.dc = update_instance_from_dict(dip.dc, dc_data)
-            dip.dc.save()
-        else:
-            logger.info('No DIP Dublin Core metadata found')
+    def _iterparse_original_admids(self):
+        """
+        List with the ADMIDs of the files in filegroup "original", parsing
+        the METS file incrementally. The SIP Dublin Core metadata is also
+        gathered, as the dmdSec and structMap elements are visited.
+        """
+        admids = []
+        self.dc_dmds = {}
+        self.dc_dmdids = None
+        file_use = None
+        # The amdSec elements are only included to clear them
+        tags = ('{*}dmdSec', '{*}amdSec', '{*}fileGrp', '{*}file', '{*}div')
+        for event, elem in etree.iterparse(
+                self.source, events=('start', 'end'), tag=tags):
+            localname = etree.QName(elem).localname
+            if localname == 'fileGrp':
+                file_use = elem.get('USE') if event == 'start' else None
+            if event == 'start':
+                continue
+            if localname == 'file' and file_use == 'original':
+                admids.append(self._get_admid(elem))
+            elif localname == 'dmdSec':
+                self._strip_namespaces(elem)
+                dc_xml = elem.find('mdWrap[@MDTYPE="DC"]/xmlData/dublincore')
+                if dc_xml is not None:
+                    self.dc_dmds[elem.get('ID')] = (
+                        elem.get('CREATED', ''), self._parse_dc_xml(dc_xml))
+            elif (localname == 'div' and self.dc_dmdids is None and
+                    elem.get('TYPE') == 'Directory' and
+                    elem.get('LABEL') == 'objects'):
+                # Match 'structMap/div/div' without clearing the ancestors
+                parent = elem.getparent()
+                if (etree.QName(parent).localname == 'div' and
+                        etree.QName(parent.getparent()).localname == 'structMap'):
+                    self.dc_dmdids = elem.get('DMDID', '')
+            self._clear_element(elem)
+        return admids
+
+    def _iterparse_original_files(self, admids=None):
+        """
+        Generator with the file metadata and events list of each file in
+        filegroup "original", or with the given `admids`, parsing the METS
+        file incrementally. As the amdSec elements come before the fileSec
+        in the METS file, without `admids` it's parsed in two passes: the
+        first one gathers the original files ADMIDs and the second one
+        parses the related amdSec elements.
+        """
+        if admids is None:
+            admids = self._iterparse_original_admids()
+        admids = set(admids)
+        self._rewind()
+        # The other top level sections are only included to clear them
+        tags = ('{*}metsHdr', '{*}dmdSec', '{*}amdSec', '{*}fileSec',
+                '{*}structMap')
+        for _, elem in etree.iterparse(
+                self.source, events=('end',), tag=tags):
+            amdsec_id = elem.get('ID')
+            if etree.QName(elem).localname == 'amdSec' and amdsec_id in admids:
+                logger.info('Parsing original file metadata from AMD section [ADMID: %s]' % amdsec_id)
+                self._strip_namespaces(elem)
+                yield self._parse_amdsec(amdsec_id, elem)
+                admids.remove(amdsec_id)
+            self._clear_element(elem)
+            # Avoid parsing the rest of the file when all the
+            # original files have been processed.
+            if not admids:
+                break
+
+        # Like in the non streaming mode, the files without amdSec
+        # can't be saved as they are missing their UUID.
+        if admids:
+            raise METSError(
+                'The AMD sections of some original files are missing in '
+                'this METS file: %s.' % ', '.join(sorted(admids))
+            )
 
     def _parse_file_metadata(self, amdsec_id):
         """
         Parse file metadata into a dict and an events list.
         """
+        amdsec = self.sections.get(amdsec_id)
+        # Like in the streaming mode, the files without amdSec can't
+        # be saved as they are missing their UUID.
+        if amdsec is None:
+            raise METSError(
+                'The AMD section of an original file is missing in this '
+                'METS file: %s.' % amdsec_id
+            )
+        return self._parse_amdsec(amdsec_id, amdsec)
+
+    def _parse_amdsec(self, amdsec_id, amdsec):
+        """
+        Parse file metadata from an amdSec element (with the namespaces
+        stripped) into a dict and an events list.
+        """
         # Create new dictionary for this item's info, including
         # the amdSec id, and new list of dicts for premis events.
         data = {'amdsec': amdsec_id}
         events = list()
 
         # Parse amdSec
-        amdsec_xpath = ".//amdSec[@ID='{}']".format(amdsec_id)
-        for amdsec in self.mets_root.findall(amdsec_xpath):
+        if amdsec is not None:
             # Iterate over elements and write key, value
             # for each to data dictionary.
             for key, xpath in self.FILE_ELEMENTS:
@@ -196,7 +328,399 @@ class METS(object):
 
         return (data, events)
 
-    def _transform_file_metadata(self, data):
+    def parse_dc(self):
+        """
+        Parse SIP-level Dublin Core metadata into dc_model dictionary.
+        Based on `parse_dc` from Archivematica parse_mets_to_db.py script
+        (src/MCPClient/lib/clientScripts/parse_mets_to_db.py).
+        """
+        # In streaming mode, the SIP DMD ids and the DMD sections with
+        # DC metadata have been gathered while parsing the original files.
+        if self.streaming:
+            if not self.dc_dmdids:
+                return
+            dmds = [
+                self.dc_dmds[dmdid] for dmdid in self.dc_dmdids.split()
+                if dmdid in self.dc_dmds
+            ]
+            if len(dmds) == 0:
+                return
+            # Get the last updated SIP's Dublin Core metadata
+            return max(dmds, key=lambda dmd: dmd[0])[1]
+
+        # Find SIP DMD ids, not file, and return if none is found
+        xpath = 'structMap/div/div[@TYPE="Directory"][@LABEL="objects"]'
+        divs = self.mets_root.find(xpath)
+        dmdids = divs.get('DMDID')
+        if dmdids is None:
+            return
+
+        # Get the SIP DMD sections with DC metadata from the sections
+        # lookup table and return if none is found.
+        dmds = []
+        for dmdid in dmdids.split():
+            dmd = self.sections.get(dmdid)
+            if dmd is not None and dmd.find('mdWrap[@MDTYPE="DC"]') is not None:
+                dmds.append(dmd)
+        if len(dmds) == 0:
+            return
+
+        # Get the last updated SIP's Dublin Core metadata
+        dmd = max(dmds, key=lambda e: e.get('CREATED', ''))
+        return self._parse_dc_xml(dmd.find('mdWrap/xmlData/dublincore'))
+
+    def _parse_dc_xml(self, dc_xml):
+        """
+        Parse all DC elements to a dictionary. Ignore identifier and
+        initiate all fields with empty strings as no one can be null.
+        """
+        dc_model = {
+            'title': '', 'creator': '', 'subject': '', 'description': '',
+            'publisher': '', 'contributor': '', 'date': '', 'type': '',
+            'format': '', 'source': '', 'language': '', 'coverage': '',
+            'rights': '',
+        }
+        for elem in dc_xml:
+            key = str(elem.tag)
+            value = str(elem.text)
+            if key in dc_model and value:
+                dc_model[key] = value
+
+        return dc_model
+
+
+class DigitalFileImporter(object):
+    """
+    Class to create or update the DigitalFiles and PREMISEvents of a DIP
+    from the file metadata and events parsed from a METS file.
+    """
+    # DigitalFile fields parsed from the METS file, compared with
+    # the stored values in incremental mode to find the changes.
+    COMPARED_FIELDS = [
+        'filepath', 'fileformat', 'formatversion', 'size_bytes',
+        'datemodified', 'puid', 'amdsec', 'hashtype', 'hashvalue',
+    ]
+    # DigitalFile fields used in the DIP and Collection statistics
+    STATS_FIELDS = ['size_bytes', 'fileformat', 'datemodified']
+    # PREMISEvent fields parsed from the METS file
+    EVENT_FIELDS = ['eventtype', 'datetime', 'detail', 'outcome', 'detailnote']
+
+    def __init__(self, dip, batch_size=None, prefetch=True, incremental=False):
+        self.dip = dip
+        # Amount of original files saved to the database per batch,
+        # it defaults to the `METS_BATCH_SIZE` setting.
+        self.batch_size = batch_size or settings.METS_BATCH_SIZE
+        # In incremental mode, the DigitalFiles with the same metadata and
+        # PREMISEvent UUIDs as the stored ones are not saved or indexed.
+        # The DigitalFiles not saved by `save` can be removed afterwards
+        # with `remove_missing`, which requires all the DIP files.
+        self.incremental = incremental
+        # Get the existing DigitalFiles and PREMISEvents from the DIP to
+        # check UUID collisions and to know which ones to update. When
+        # saving only a part of the DIP files, it's done on each batch.
+        self.prefetch = prefetch or incremental
+        self.dip_files = set()
+        self.dip_events = {}
+        if self.prefetch:
+            self.dip_files.update(DigitalFile.objects.filter(
+                dip=dip).values_list('uuid', flat=True))
+            self.dip_events.update(PREMISEvent.objects.filter(
+                digitalfile__dip=dip).values_list('uuid', 'digitalfile_id'))
+        # Stored metadata and PREMISEvent UUIDs of the DIP files
+        self.stored_files = {}
+        self.stored_events = {}
+        if self.incremental:
+            for values in DigitalFile.objects.filter(dip=dip).values_list(
+                    'uuid', *self.COMPARED_FIELDS).iterator():
+                self.stored_files[values[0]] = values[1:]
+            for uuid, file_uuid in self.dip_events.items():
+                self.stored_events.setdefault(file_uuid, set()).add(uuid)
+        # UUIDs of the parsed, saved and removed DigitalFiles
+        self.parsed_files = set()
+        self.saved_files = []
+        self.removed_files = []
+        self.counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+        # Changes in the DIP statistics not applied yet
+        self.stats_delta = FileStatsDelta()
+
+    def save(self, files):
+        """
+        Save the DigitalFiles and PREMISEvents from an iterable of file
+        metadata and events lists in batches. It should be called within
+        a transaction to avoid partial imports.
+        """
+        for batch in chunks(files, self.batch_size):
+            self._save_batch(batch)
+
+    def _fetch_existing(self, file_uuids, event_uuids):
+        """Get the existing DigitalFiles and PREMISEvents from a batch."""
+        for uuids in chunks(file_uuids, self.batch_size):
+            self.dip_files.update(DigitalFile.objects.filter(
+                dip=self.dip, uuid__in=uuids).values_list('uuid', flat=True))
+        for uuids in chunks(event_uuids, self.batch_size):
+            self.dip_events.update(PREMISEvent.objects.filter(
+                digitalfile__dip=self.dip, uuid__in=uuids,
+            ).values_list('uuid', 'digitalfile_id'))
+
+    def _save_batch(self, files):
+        """
+        Create or update the DigitalFiles and PREMISEvents from a list of
+        parsed file metadata and events lists. The rows are validated in
+        memory and saved in bulk: the new ones are created and the existing
+        ones are only updated in place when their values have changed. The
+        stored PREMISEvents missing in the parsed events are kept.
+        """
+        digitalfiles = {}
+        premisevents = {}
+        for file_data, premis_events in files:
+            digitalfile = self._build_digital_file(file_data)
+            digitalfiles[digitalfile.uuid] = digitalfile
+            for event in premis_events:
+                premisevent = self._build_premis_event(digitalfile, event)
+                premisevents[premisevent.uuid] = premisevent
+
+        if self.incremental:
+            self.parsed_files.update(digitalfiles.keys())
+            self._skip_unchanged(digitalfiles, premisevents)
+
+        if not self.prefetch:
+            self._fetch_existing(digitalfiles.keys(), premisevents.keys())
+
+        # Don't update DigitalFiles from other DIPs
+        new_uuids = [uuid for uuid in digitalfiles if uuid not in self.dip_files]
+        for uuids in chunks(new_uuids, self.batch_size):
+            uuid = DigitalFile.objects.filter(uuid__in=uuids).values_list(
+                'uuid', flat=True).first()
+            if uuid:
+                raise METSError(
+                    'An original file in this METS file has the same UUID '
+                    'as an existing one from another DIP '
+                    '(%s).' % uuid
+                )
+
+        # Don't update PREMISEvents from other DigitalFiles
+        new_uuids = []
+        for uuid, premisevent in premisevents.items():
+            if uuid not in self.dip_events:
+                new_uuids.append(uuid)
+            elif self.dip_events[uuid] != premisevent.digitalfile_id:
+                new_uuids.append(uuid)
+        for uuids in chunks(new_uuids, self.batch_size):
+            uuid = PREMISEvent.objects.filter(uuid__in=uuids).values_list(
+                'uuid', flat=True).first()
+            if uuid:
+                raise METSError(
+                    'A PREMISEvent in this METS file has the same '
+                    'UUID as an existing one from another DIP '
+                    '(%s).' % uuid
+                )
+
+        new_files = []
+        changed_files = []
+        file_values = self._get_stored_values(
+            DigitalFile,
+            [uuid for uuid in digitalfiles if uuid in self.dip_files],
+            self.COMPARED_FIELDS,
+        )
+        for uuid, digitalfile in digitalfiles.items():
+            values = tuple(
+                getattr(digitalfile, field) for field in self.COMPARED_FIELDS)
+            stored = file_values.get(uuid)
+            if stored == values:
+                continue
+            if stored is None:
+                new_files.append(digitalfile)
+            else:
+                changed_files.append(digitalfile)
+                stored = dict(zip(self.COMPARED_FIELDS, stored))
+                self.stats_delta.remove(*(
+                    stored[field] for field in self.STATS_FIELDS))
+            self.stats_delta.add(*(
+                getattr(digitalfile, field) for field in self.STATS_FIELDS))
+
+        new_events = []
+        changed_events = []
+        event_values = self._get_stored_values(
+            PREMISEvent,
+            [
+                uuid for uuid, premisevent in premisevents.items()
+                if self.dip_events.get(uuid) == premisevent.digitalfile_id
+            ],
+            self.EVENT_FIELDS,
+        )
+        for uuid, premisevent in premisevents.items():
+            values = tuple(
+                getattr(premisevent, field) for field in self.EVENT_FIELDS)
+            stored = event_values.get(uuid)
+            if stored is None:
+                new_events.append(premisevent)
+            elif stored != values:
+                changed_events.append(premisevent)
+
+        self.counts['updated'] += len(file_values)
+        self.counts['created'] += len(new_files)
+        logger.info(
+            'Creating %d DigitalFiles and %d PREMISEvents, updating %d '
+            'DigitalFiles and %d PREMISEvents' % (
+                len(new_files), len(new_events), len(changed_files),
+                len(changed_events)))
+        DigitalFile.objects.bulk_create(new_files, batch_size=self.batch_size)
+        # The `auto_now` field is not set by the UPDATE queries
+        modified = datetime.now(tz=timezone.utc)
+        for digitalfile in changed_files:
+            digitalfile.modified = modified
+        bulk_update(
+            changed_files, self.COMPARED_FIELDS + ['size_human', 'modified'],
+            self.batch_size)
+        PREMISEvent.objects.bulk_create(new_events, batch_size=self.batch_size)
+        bulk_update(changed_events, self.EVENT_FIELDS, self.batch_size)
+        if settings.ES_OUTBOX:
+            EsOutbox.add_in_bulk(
+                DigitalFile, digitalfiles.keys(), EsOutbox.OP_INDEX,
+                self.batch_size)
+        self.saved_files.extend(digitalfiles.keys())
+        self.dip_files.update(digitalfiles.keys())
+        self.dip_events.update(
+            (uuid, event.digitalfile_id) for uuid, event in premisevents.items())
+
+    def _get_stored_values(self, model, uuids, fields):
+        """
+        Get a dict with the values of the given fields from the
+        stored rows with the given UUIDs, by UUID.
+        """
+        stored = {}
+        for chunk in chunks(uuids, self.batch_size):
+            for values in model.objects.filter(uuid__in=chunk).values_list(
+                    'uuid', *fields):
+                stored[values[0]] = values[1:]
+        return stored
+
+    def _skip_unchanged(self, digitalfiles, premisevents):
+        """
+        Remove the DigitalFiles, and their PREMISEvents, from a batch when
+        their metadata matches the stored one and they don't have new
+        PREMISEvent UUIDs.
+        """
+        file_events = {}
+        for uuid, premisevent in premisevents.items():
+            file_events.setdefault(premisevent.digitalfile_id, set()).add(uuid)
+        for uuid, digitalfile in list(digitalfiles.items()):
+            stored = self.stored_files.get(uuid)
+            if stored is None:
+                continue
+            values = tuple(
+                getattr(digitalfile, field) for field in self.COMPARED_FIELDS)
+            events = file_events.get(uuid, set())
+            if values != stored or not events <= self.stored_events.get(uuid, set()):
+                continue
+            del digitalfiles[uuid]
+            for event_uuid in events:
+                del premisevents[event_uuid]
+            self.counts['unchanged'] += 1
+
+    def remove_missing(self):
+        """
+        Delete the stored DigitalFiles of the DIP, and their PREMISEvents,
+        which have not been parsed in incremental mode. It should be called
+        after `save`, within the same transaction.
+        """
+        if not self.incremental:
+            raise METSError(
+                'The missing DigitalFiles can only be removed in '
+                'incremental mode.'
+            )
+        self.removed_files = [
+            uuid for uuid in self.stored_files if uuid not in self.parsed_files
+        ]
+        if self.removed_files:
+            logger.info('Removing %d DigitalFiles' % len(self.removed_files))
+        for uuids in chunks(self.removed_files, self.batch_size):
+            self._delete_files(uuids)
+        if settings.ES_OUTBOX:
+            EsOutbox.add_in_bulk(
+                DigitalFile, self.removed_files, EsOutbox.OP_DELETE,
+                self.batch_size)
+        self.counts['removed'] = len(self.removed_files)
+
+    def _delete_files(self, uuids):
+        """
+        Delete DigitalFiles, cascading their PREMISEvents, and remove their
+        values from the statistics changes.
+        """
+        digitalfiles = DigitalFile.objects.filter(uuid__in=uuids)
+        for values in digitalfiles.values_list(*self.STATS_FIELDS):
+            self.stats_delta.remove(*values)
+        digitalfiles.delete()
+
+    def update_file_stats(self):
+        """
+        Update the DIP and Collection statistics with the changes made by
+        `save` and `remove_missing`, within the same transaction.
+        """
+        if not self.stats_delta:
+            return
+        self.dip.update_file_stats(self.stats_delta)
+        self.stats_delta = FileStatsDelta()
+
+    def _build_digital_file(self, file_data):
+        """
+        Create a validated DigitalFile instance, without saving it,
+        from the parsed file metadata.
+        """
+        # Check mandatory UUID field before transforming the metadata
+        uuid = file_data.get('uuid')
+        if not uuid:
+            raise METSError(
+                'An original file in this METS file is missing its UUID.'
+            )
+        # Copy the metadata to not modify the task arguments on retries
+        file_data = self._transform_file_metadata(dict(file_data))
+        del file_data['uuid']
+        digitalfile = DigitalFile(uuid=uuid)
+        # Add instance fields with file_data values
+        digitalfile = update_instance_from_dict(digitalfile, file_data)
+        digitalfile.dip = self.dip
+        # Validate without hitting the database, the DIP relation and
+        # the UUID uniqueness are checked for the entire batch.
+        try:
+            digitalfile.full_clean(exclude=['dip'], validate_unique=False)
+        except ValidationError as e:
+            message = 'A DigitalFile could not be created:'
+            for field, errors in e.message_dict.items():
+                message += '\n- %s: %s' % (field, ' '.join(errors))
+            raise METSError(message)
+        return digitalfile
+
+    def _build_premis_event(self, digitalfile, event):
+        """
+        Create a validated PREMISEvent instance, without saving it,
+        from the parsed event metadata.
+        """
+        # Check mandatory UUID field
+        event = dict(event)
+        uuid = event.pop('uuid', None)
+        if not uuid:
+            raise METSError(
+                'A PREMISEvent in this METS file is missing its UUID.'
+            )
+        premisevent = PREMISEvent(uuid=uuid)
+        # Add instance fields with event values
+        premisevent = update_instance_from_dict(premisevent, event)
+        premisevent.digitalfile = digitalfile
+        # Validate without hitting the database, the DigitalFile relation
+        # and the UUID uniqueness are checked for the entire batch.
+        try:
+            premisevent.full_clean(
+                exclude=['digitalfile'], validate_unique=False)
+        except ValidationError as e:
+            message = 'A PREMISEvent could not be created:'
+            for field, errors in e.message_dict.items():
+                message += '\n- %s: %s' % (field, ' '.join(errors))
+            raise METSError(message)
+        return premisevent
+
+    @staticmethod
+    def _transform_file_metadata(data):
         """
         Transform file metadata to be saved in DigitalFile fields.
         """
@@ -221,46 +745,57 @@ class METS(object):
 
         return data
 
-    def _parse_dc(self):
+    def update_dc(self, dc_data):
+        """Update the DIP DublinCore object with the parsed metadata."""
+        if dc_data:
+            logger.info('Updating DIP Dublin Core metadata')
+            # No validation is needed as all the fields are non
+            # required string fields initiated with empty strings.
+            self.dip.dc = update_instance_from_dict(self.dip.dc, dc_data)
+            self.dip.dc.save()
+        else:
+            logger.info('No DIP Dublin Core metadata found')
+
+    def index(self):
         """
-        Parse SIP-level Dublin Core metadata into dc_model dictionary.
-        Based on `parse_dc` from Archivematica parse_mets_to_db.py script
-        (src/MCPClient/lib/clientScripts/parse_mets_to_db.py).
+        Index the saved DigitalFiles and delete the removed ones
+        in ES with bulk requests. When the `ES_OUTBOX` setting is
+        enabled, the changes have been recorded in the outbox instead.
         """
-        # Find DMD sections and return if none is found
-        xpath = 'dmdSec/mdWrap[@MDTYPE="DC"]/parent::*'
-        dmds = self.mets_root.xpath(xpath)
-        if len(dmds) == 0:
+        if settings.ES_OUTBOX:
             return
+        logger.info('Indexing DigitalFiles in Elasticsearch')
+        document = DigitalFile.es_doc
 
-        # Find SIP DMD ids, not file, and return if none is found
-        xpath = 'structMap/div/div[@TYPE="Directory"][@LABEL="objects"]'
-        divs = self.mets_root.find(xpath)
-        dmdids = divs.get('DMDID')
-        if dmdids is None:
-            return
+        # Avoid the DIP and Collection queries per DigitalFile
+        ancestors = {self.dip.pk: DigitalFile.get_es_ancestors_data(self.dip)}
 
-        # Sort by date and loop over reversed DMD sections, check SIP
-        # DMD ids to get the last updated SIP's Dublin Core metadata.
-        dmdids = dmdids.split()
-        dmds = sorted(dmds, key=lambda e: e.get('CREATED'))
-        for dmd in dmds[::-1]:
-            if dmd.get('ID') in dmdids:
-                dc_xml = dmd.find('mdWrap/xmlData/dublincore')
-                break
+        def get_es_data():
+            for uuids in chunks(self.saved_files, self.batch_size):
+                for digitalfile in DigitalFile.objects.filter(uuid__in=uuids):
+                    yield digitalfile.get_es_data(ancestors)
 
-        # Parse all DC elements to a dictionary. Ignore identifier and
-        # initiate all fields with empty strings as no one can be null.
-        dc_model = {
-            'title': '', 'creator': '', 'subject': '', 'description': '',
-            'publisher': '', 'contributor': '', 'date': '', 'type': '',
-            'format': '', 'source': '', 'language': '', 'coverage': '',
-            'rights': '',
-        }
-        for elem in dc_xml:
-            key = str(elem.tag)
-            value = str(elem.text)
-            if key in dc_model and value:
-                dc_model[key] = value
+        bulk(
+            connections.get_connection(),
+            get_es_data(),
+            index=document._index._name,
+            doc_type=document._doc_type.name,
+            chunk_size=self.batch_size,
+        )
+        bump_search_generation(document._index._name)
 
-        return dc_model
+        if not self.removed_files:
+            return
+        logger.info('Deleting DigitalFiles from Elasticsearch')
+        # Ignore the errors from documents missing in the index
+        success_count, errors = bulk(
+            connections.get_connection(),
+            ({'_op_type': 'delete', '_id': uuid} for uuid in self.removed_files),
+            index=document._index._name,
+            doc_type=document._doc_type.name,
+            chunk_size=self.batch_size,
+            raise_on_error=False,
+        )
+        bump_search_generation(document._index._name)
+        logger.info('%d/%d DigitalFiles deleted.' % (
+            success_count, len(self.removed_files)))
@@ -0,0 +1,106 @@
+from django.conf import settings
+
+import logging
+import redis
+import time
+
+logger = logging.getLogger('dips.settings_cache')
+
+# Redis key with the version of the settings values
+VERSION_KEY = 'scope:settings:version'
+
+
+class SettingsCache(object):
+    """
+    Process-local cache of the application settings values. The values are
+    loaded in a single query and kept for `timeout` seconds. When a Redis
+    `url` is given, the version saved in Redis, increased with each change
+    made to the settings, is checked once the timeout expires and the
+    values are only reloaded when it doesn't match the one of the loaded
+    values. The changes made in the same process clear the loaded values.
+    """
+
+    def __init__(self, timeout, url=None):
+        self.timeout = timeout
+        self.redis = redis.StrictRedis.from_url(url) if url else None
+        self.version = None
+        self.values = None
+        self.checked = None
+
+    def get_values(self, load):
+        """
+        Get the settings values, obtained with the `load` function when
+        they are not loaded or they are outdated.
+        """
+        now = time.monotonic()
+        if self.values is not None and now - self.checked < self.timeout:
+            return self.values
+        # Get the version before loading the values, so a change made
+        # in between reloads them again in the next check.
+        version = self._get_version()
+        if self.values is None or version is None or version != self.version:
+            self.values = load()
+        self.version = version
+        self.checked = now
+        return self.values
+
+    def _get_version(self):
+        """
+        Get the settings version from Redis, `None` when it's not used,
+        not available or the settings have not been changed yet.
+        """
+        if self.redis is None:
+            return None
+        try:
+            return self.redis.get(VERSION_KEY)
+        except redis.RedisError as e:
+            logger.warning('Settings cache version not available: %s' % e)
+            return None
+
+    def clear(self):
+        """Reload the values in this process on the next use."""
+        self.values = None
+
+    def bump(self):
+        """Clear the values and increase the settings version."""
+        self.clear()
+        if self.redis is not None:
+            self.redis.incr(VERSION_KEY)
+
+
+_cache = None
+
+
+def get_settings_cache():
+    """Get the settings cache of this process."""
+    global _cache
+    if _cache is None:
+        _cache = SettingsCache(
+            settings.SETTINGS_CACHE_TIMEOUT,
+            settings.SETTINGS_CACHE_URL,
+        )
+    return _cache
+
+
+def get_settings_values(load):
+    """Get the settings values from the settings cache."""
+    return get_settings_cache().get_values(load)
+
+
+def clear_settings_cache():
+    """
+    Reload the settings values in this process on the next use, called
+    when the settings are saved or deleted.
+    """
+    get_settings_cache().clear()
+
+
+def bump_settings_version():
+    """
+    Invalidate the cached settings values in all processes. It must be
+    called after each change made to the settings is committed.
+    """
+    try:
+        get_settings_cache().bump()
+    except redis.RedisError as e:
+        logger.warning('Settings cache not available: %s' % e)
@@ -1,10 +1,20 @@
-from celery import shared_task, states, Task
+from celery import chord, shared_task, states, Task
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
 from django.db.utils import DatabaseError
-from elasticsearch.exceptions import TransportError
-from elasticsearch.helpers import bulk
+from elasticsearch.exceptions import (ConflictError, ConnectionTimeout,
+                                      NotFoundError, RequestError,
+                                      TransportError)
+from elasticsearch.helpers import bulk, BulkIndexError
 from elasticsearch_dsl.connections import connections
-from .parsemets import METS
-from .models import Collection, DIP, DigitalFile
+from .helpers import chunks
+from .parsemets import DigitalFileImporter, METS
+from .models import Collection, DIP, DigitalFile, EsDescendantsUpdate, EsOutbox
+from search.cache import bump_search_generation
+from search.helpers import deferred_indexing
 
 import logging
 import os
@@ -17,77 +27,239 @@ import zipfile
 # the default `CELERY_REDIRECT_STDOUTS_LEVEL` when using `print`.
 logger = logging.getLogger('dips.tasks')
 
+METS_RE = re.compile(r'.*METS.[0-9a-f\-]{36}.*$')
+
+
+def find_mets_file(zip_, hint=None):
+    """
+    Return the ZipInfo of the METS file from a given zip file or `None` if
+    it's not found. The zip file central directory is only read once, when
+    the ZipFile is created. The `hint` filename is checked first, to avoid
+    going over the zip file entries, which otherwise are checked in order
+    until the first match is found.
+    """
+    if hint:
+        try:
+            return zip_.getinfo(hint)
+        except KeyError:
+            logger.info('METS file not found in hint location [Filename: %s]' % hint)
+    for info in zip_.infolist():
+        # Avoid the regex for the entries that can't match
+        if 'METS' in info.filename and METS_RE.match(info.filename):
+            return info
+    return None
+
+
+def update_import_status(dip_id, status):
+    """
+    Update DIP `import_status` from a Celery task status, setting it
+    to 'FAILURE' for all possible non 'SUCCESS' states.
+    """
+    dip = DIP.objects.get(pk=dip_id)
+    logger.info('Updating DIP import status [Identifier: %s]' % dip.dc.identifier)
+    if status == states.SUCCESS:
+        dip.import_status = DIP.IMPORT_SUCCESS
+    else:
+        dip.import_status = DIP.IMPORT_FAILURE
+    # This save is triggering another Celery task (update_es_descendants),
+    # TODO: consider the use of task chains. The DIP is indexed without
+    # refresh, as it's not needed to read it in the same request.
+    with deferred_indexing():
+        dip.save()
+
 
 class MetsTask(Task):
 
     def after_return(self, status, retval, task_id, args, kwargs, einfo):
         """
         Update DIP `import_status` when the task ends. Make sure it's one
-        of Celery's READY_STATES and set it to 'FAILURE' for all possible
-        non 'SUCCESS' states.
+        of Celery's READY_STATES.
         """
         if status not in states.READY_STATES:
             return
-        dip = DIP.objects.get(pk=args[0])
-        logger.info('Updating DIP import status [Identifier: %s]' % dip.dc.identifier)
+        update_import_status(args[0], status)
+
+
+class ChunkedMetsTask(MetsTask):
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        """
+        Only update DIP `import_status` when the task doesn't succeed. On
+        success, the import is still in progress in the chunk subtasks and
+        the status is updated from the chord callback or error callback.
+        """
         if status == states.SUCCESS:
-            dip.import_status = DIP.IMPORT_SUCCESS
-        else:
-            dip.import_status = DIP.IMPORT_FAILURE
-        # This save is triggering another Celery task (update_es_descendants),
-        # TODO: consider the use of task chains.
-        dip.save()
+            return
+        super().after_return(status, retval, task_id, args, kwargs, einfo)
+
+
+@contextmanager
+def open_mets(dip_id, zip_path, streaming=None, extract=None, incremental=False):
+    """
+    Context manager that extracts a METS file from a given DIP zip file and
+    returns a METS class instance to parse its content. The METS file
+    location stored in the DIP when it's uploaded is used to open it.
+    The METS file is read directly from the zip file stream unless `extract`
+    is `True`, which defaults to the `METS_EXTRACT` setting, where a
+    temporary directory is created to hold the METS file during its parsing.
+    The METS file is parsed incrementally when `streaming` is `True`, it
+    defaults to the `METS_STREAMING` setting. Only the changed DigitalFiles
+    are saved when `incremental` is `True`.
+    """
+    if streaming is None:
+        streaming = settings.METS_STREAMING
+    if extract is None:
+        extract = settings.METS_EXTRACT
+    logger.info('Extracting METS file from ZIP [Path: %s]' % zip_path)
+    dip = DIP.objects.get(pk=dip_id)
+    with zipfile.ZipFile(zip_path) as zip_:
+        # Use the METS file location found on upload. The zip file entries
+        # are only searched for the DIPs uploaded before it was stored.
+        metsinfo = find_mets_file(zip_, hint=dip.mets_path)
+        if not metsinfo:
+            raise Exception('METS file not found in ZIP file.')
+        if not extract:
+            with zip_.open(metsinfo) as metsfile:
+                # The streaming mode parses the METS file twice and the zip
+                # file streams are only seekable from Python 3.7.
+                if not streaming or metsfile.seekable():
+                    logger.info('Parsing METS file from ZIP [Filename: %s]' % metsinfo.filename)
+                    yield METS(
+                        metsfile, dip_id, streaming=streaming,
+                        incremental=incremental)
+                    return
+        with tempfile.TemporaryDirectory() as dir_:
+            # Extract METS file
+            metsfile = zip_.extract(metsinfo, dir_)
+            path = os.path.abspath(metsfile)
+            logger.info('METS file extracted [Path: %s]' % path)
+            yield METS(
+                path, dip_id, streaming=streaming, incremental=incremental)
 
 
 @shared_task(
     base=MetsTask, autoretry_for=(TransportError, DatabaseError,),
     max_retries=10, default_retry_delay=30,
 )
-def extract_and_parse_mets(dip_id, zip_path):
+def extract_and_parse_mets(dip_id, zip_path, streaming=None, extract=None,
+                           incremental=None):
     """
     Extracts a METS file from a given DIP zip file and uses the METS class
     to parse its content, create the related DigitalFiles and update the DIP
-    DC metadata. Creates and deletes a temporary directory to hold the METS
-    file during its parsing. This function is meant to be called with
-    `.delay()` to be executed asynchronously by the Celery worker.
+    DC metadata. When `incremental` is `True`, which defaults to the
+    `METS_INCREMENTAL` setting, only the changed DigitalFiles are saved and
+    indexed, and the ones missing in the METS file are removed. Check
+    `open_mets` for the `streaming` and `extract` parameters. Returns the
+    amount of created, updated, unchanged and removed DigitalFiles. This
+    function is meant to be called with `.delay()` to be executed
+    asynchronously by the Celery worker.
     """
-    logger.info('Extracting METS file from ZIP [Path: %s]' % zip_path)
-    with tempfile.TemporaryDirectory() as dir_:
-        with zipfile.ZipFile(zip_path) as zip_:
-            # Extract METS file
-            metsfile = None
-            mets_re = re.compile(r'.*METS.[0-9a-f\-]{36}.*$')
-            for info in zip_.infolist():
-                if mets_re.match(info.filename):
-                    metsfile = zip_.extract(info, dir_)
-            if not metsfile:
-                raise Exception('METS file not found in ZIP file.')
-            # Parse METS file
-            path = os.path.abspath(metsfile)
-            logger.info('METS file extracted [Path: %s]' % path)
-            mets = METS(path, dip_id)
-            mets.parse_mets()
+    if incremental is None:
+        incremental = settings.METS_INCREMENTAL
+    with open_mets(dip_id, zip_path, streaming, extract, incremental) as mets:
+        return mets.parse_mets()
+
+
+@shared_task(
+    base=ChunkedMetsTask, autoretry_for=(TransportError, DatabaseError,),
+    max_retries=10, default_retry_delay=30,
+)
+def extract_and_parse_mets_in_chunks(dip_id, zip_path, chunk_size=None,
+                                     streaming=None, extract=None):
+    """
+    Extracts a METS file from a given DIP zip file and uses the METS class
+    to get the ADMIDs of its original files, which are split in chunks of up
+    to `chunk_size` files, which defaults to the `METS_CHUNK_SIZE` setting,
+    and parsed and saved in parallel from a Celery chord. Only the ADMIDs
+    are sent to the subtasks, to keep the files metadata out of memory and
+    the task messages. The chord callback updates the DIP DC metadata and
+    import status. Check `open_mets` for the `streaming` and `extract`
+    parameters. This function is meant to be called with `.delay()` to be
+    executed asynchronously by the Celery worker.
+    """
+    chunk_size = chunk_size or settings.METS_CHUNK_SIZE
+    with open_mets(dip_id, zip_path, streaming, extract) as mets:
+        admids_chunks = list(chunks(mets.get_original_admids(), chunk_size))
+        dc_data = mets.parse_dc()
+    callback = finish_mets_import.s(dip_id, dc_data).on_error(
+        fail_mets_import.s(dip_id=dip_id))
+    if not admids_chunks:
+        callback.delay([])
+        return
+    logger.info('Saving original files in %d chunks' % len(admids_chunks))
+    chord(
+        save_mets_files.s(dip_id, zip_path, admids, streaming, extract)
+        for admids in admids_chunks
+    )(callback)
 
 
 @shared_task(
     autoretry_for=(TransportError, DatabaseError,),
+    max_retries=10, default_retry_delay=30,
+)
+def save_mets_files(dip_id, zip_path, admids, streaming=None, extract=None):
+    """
+    Extracts a METS file from a given DIP zip file and parses the original
+    files with the given ADMIDs, saving their metadata and events in a
+    single transaction and indexing them in ES. Check `open_mets` for the
+    `streaming` and `extract` parameters. Returns the amount of files saved.
+    """
+    with open_mets(dip_id, zip_path, streaming, extract) as mets:
+        dip = DIP.objects.get(pk=dip_id)
+        # Do not get all the existing DigitalFiles from the DIP on each chunk
+        importer = DigitalFileImporter(dip, prefetch=False)
+        with transaction.atomic():
+            importer.save(mets.get_original_files(admids))
+            importer.update_file_stats()
+    importer.index()
+    return len(importer.saved_files)
+
+
+@shared_task(
+    autoretry_for=(DatabaseError,),
+    max_retries=10, default_retry_delay=30,
+)
+def finish_mets_import(results, dip_id, dc_data):
+    """
+    Chord callback from `extract_and_parse_mets_in_chunks`, it updates the
+    DIP DC metadata and sets the DIP `import_status` to 'SUCCESS'.
+    """
+    logger.info('%d original files saved.' % sum(results))
+    dip = DIP.objects.get(pk=dip_id)
+    DigitalFileImporter(dip, prefetch=False).update_dc(dc_data)
+    update_import_status(dip_id, states.SUCCESS)
+
+
+@shared_task(
+    autoretry_for=(DatabaseError,),
     max_retries=10, default_retry_delay=30, ignore_result=True
 )
-def update_es_descendants(class_name, pk):
+def fail_mets_import(*args, dip_id):
     """
-    Updates the related DigitalFiles documents in ES with the partial data from
-    the ancestor Collection or DIP.
+    Error callback from `extract_and_parse_mets_in_chunks` chord, called
+    with the id of the chord callback when a chunk fails, or with the
+    callback request, exception and traceback when the callback itself
+    fails. The callback result contains the error in both cases. Relates
+    the DIP with that result to display the error and sets the DIP
+    `import_status` to 'FAILURE'.
+    """
+    task_id = getattr(args[0], 'id', args[0])
+    DIP.objects.filter(pk=dip_id).update(import_task_id=task_id)
+    update_import_status(dip_id, states.FAILURE)
+
+
+def get_es_descendants_script(class_name, pk):
+    """
+    Returns the Painless script to update the related DigitalFiles documents
+    in ES with the partial data from the ancestor Collection or DIP.
     """
-    if class_name not in ['Collection', 'DIP']:
-        raise Exception('Can not update descendants of %s.' % class_name)
-    logger.info('Updating DigitalFiles of %s [id: %s] ' % (class_name, pk))
     if class_name == 'Collection':
         ancestor = Collection.objects.get(pk=pk)
         # Partial update with `doc` doesn't remove the fields missing in data,
         # they have to be removed via script to clear the existing value,
         # `script` and `doc` can't be combined in update actions, therefore
         # it's required to generate a Painless script to perform the update.
-        script = {
+        return {
             'source': """
                 if (params.containsKey('identifier')) {
                   ctx._source.collection.identifier = params.identifier;
@@ -103,48 +275,227 @@ def update_es_descendants(class_name, pk):
             'lang': 'painless',
             'params': ancestor.get_es_data_for_files(),
         }
+    ancestor = DIP.objects.get(pk=pk)
+    return {
+        'source': """
+            if (params.containsKey('identifier')) {
+              ctx._source.dip.identifier = params.identifier;
+            } else {
+              ctx._source.dip.remove('identifier');
+            }
+            if (params.containsKey('title')) {
+              ctx._source.dip.title = params.title;
+            } else {
+              ctx._source.dip.remove('title');
+            }
+            if (params.containsKey('import_status')) {
+              ctx._source.dip.import_status = params.import_status;
+            } else {
+              ctx._source.dip.remove('import_status');
+            }
+        """,
+        'lang': 'painless',
+        'params': ancestor.get_es_data_for_files(),
+    }
+
+
+def bulk_update_es_descendants(class_name, pk, script):
+    """
+    Updates the related DigitalFiles documents in ES with a scripted update
+    action per DigitalFile sent in bulk requests.
+    """
+    if class_name == 'Collection':
         files = DigitalFile.objects.filter(dip__collection__pk=pk).all()
     else:
-        ancestor = DIP.objects.get(pk=pk)
-        script = {
-            'source': """
-                if (params.containsKey('identifier')) {
-                  ctx._source.dip.identifier = params.identifier;
-                } else {
-                  ctx._source.dip.remove('identifier');
-                }
-                if (params.containsKey('title')) {
-                  ctx._source.dip.title = params.title;
-                } else {
-                  ctx._source.dip.remove('title');
-                }
-                if (params.containsKey('import_status')) {
-                  ctx._source.dip.import_status = params.import_status;
-                } else {
-                  ctx._source.dip.remove('import_status');
-                }
-            """,
-            'lang': 'painless',
-            'params': ancestor.get_es_data_for_files(),
-        }
         files = DigitalFile.objects.filter(dip__pk=pk).all()
+    total = 0
+
+    def get_actions():
+        nonlocal total
+        for file in files.iterator():
+            total += 1
+            yield {
+                '_op_type': 'update',
+                '_index': DigitalFile.es_doc._index._name,
+                '_type': DigitalFile.es_doc._doc_type.name,
+                '_id': file.pk,
+                'script': script,
+            }
+
     # Get connection to ES
     es = connections.get_connection()
     # Bulk update with partial data
-    success_count, errors = bulk(es, ({
-        '_op_type': 'update',
-        '_index': DigitalFile.es_doc._index._name,
-        '_type': DigitalFile.es_doc._doc_type.name,
-        '_id': file.pk,
-        'script': script,
-    } for file in files.iterator()))
-    logger.info('%d/%d DigitalFiles updated.' % (success_count, files.count()))
+    success_count, errors = bulk(es, get_actions())
+    bump_search_generation(DigitalFile.es_doc._index._name)
+    logger.info('%d/%d DigitalFiles updated.' % (success_count, total))
     if len(errors) > 0:
         logger.info('The following errors were encountered:')
         for error in errors:
             logger.info('- %s' % error)
 
 
+@shared_task(
+    autoretry_for=(TransportError, DatabaseError,),
+    max_retries=10, default_retry_delay=30, ignore_result=True
+)
+def update_es_descendants(class_name, pk, version=None):
+    """
+    Updates the related DigitalFiles documents in ES with the partial data from
+    the ancestor Collection or DIP. When the `ES_UPDATE_BY_QUERY` setting is
+    enabled, the documents are updated with a single sliced update by query
+    request, which is tracked by `wait_es_update_by_query`. Otherwise, or if
+    the request is rejected, conflicts or times out, a scripted update per
+    document is sent in bulk.
+    When the update `version` from `EsDescendantsUpdate` is given, it's
+    skipped if a later update has been requested for the same ancestor.
+    """
+    if class_name not in ['Collection', 'DIP']:
+        raise Exception('Can not update descendants of %s.' % class_name)
+    if version is not None and not EsDescendantsUpdate.start(
+            class_name, pk, version):
+        logger.info('Skipping superseded update of DigitalFiles of %s [id: %s]' % (class_name, pk))
+        return
+    logger.info('Updating DigitalFiles of %s [id: %s] ' % (class_name, pk))
+    script = get_es_descendants_script(class_name, pk)
+    if settings.ES_UPDATE_BY_QUERY:
+        # Ancestor id field in the DigitalFile documents
+        field = 'collection.id' if class_name == 'Collection' else 'dip.id'
+        es = connections.get_connection()
+        try:
+            response = es.update_by_query(
+                index=DigitalFile.es_doc._index._name,
+                body={'query': {'match': {field: pk}}, 'script': script},
+                conflicts='proceed',
+                slices='auto',
+                wait_for_completion=False,
+            )
+        except (RequestError, ConflictError, ConnectionTimeout) as e:
+            logger.info('Update by query request failed: %s' % e)
+        else:
+            wait_es_update_by_query.apply_async(
+                (response['task'], class_name, pk),
+                countdown=settings.ES_TASK_POLL_INTERVAL,
+            )
+            return
+    bulk_update_es_descendants(class_name, pk, script)
+
+
+@shared_task(
+    bind=True, autoretry_for=(TransportError, DatabaseError,),
+    max_retries=720, default_retry_delay=5, ignore_result=True
+)
+def wait_es_update_by_query(self, es_task_id, class_name, pk):
+    """
+    Waits for an ES update by query task from `update_es_descendants`,
+    checking its status without blocking the worker between checks. If the
+    ES task fails or some documents couldn't be updated, the DigitalFiles
+    are updated again in bulk.
+    """
+    es = connections.get_connection()
+    try:
+        result = es.tasks.get(task_id=es_task_id)
+    except NotFoundError:
+        result = {'completed': True, 'error': 'ES task not found.'}
+    if not result['completed']:
+        raise self.retry(countdown=settings.ES_TASK_POLL_INTERVAL)
+    response = result.get('response', {})
+    if (result.get('error') or response.get('failures') or
+            response.get('version_conflicts')):
+        logger.info(
+            'Update by query task %s failed, updating DigitalFiles of %s '
+            '[id: %s] in bulk' % (es_task_id, class_name, pk))
+        script = get_es_descendants_script(class_name, pk)
+        bulk_update_es_descendants(class_name, pk, script)
+        return
+    bump_search_generation(DigitalFile.es_doc._index._name)
+    logger.info('%d/%d DigitalFiles updated.' % (
+        response['updated'], response['total']))
+
+
+@shared_task(
+    autoretry_for=(TransportError, DatabaseError, BulkIndexError),
+    max_retries=10, default_retry_delay=30, ignore_result=True
+)
+def drain_es_outbox(batch_size=None):
+    """
+    Applies the ES operations recorded in the outbox with a bulk request per
+    batch of up to `batch_size` entries, which defaults to the
+    `ES_OUTBOX_BATCH_SIZE` setting. The entries from the same instance are
+    coalesced in a single operation, based on the instance current state:
+    the existing instances are indexed and the missing ones are deleted.
+    The processed entries are removed and the failed ones are kept to be
+    retried.
+    """
+    batch_size = batch_size or settings.ES_OUTBOX_BATCH_SIZE
+    es = connections.get_connection()
+    last_id = 0
+    errors = []
+    while True:
+        entries = list(EsOutbox.objects.filter(
+            id__gt=last_id).order_by('id')[:batch_size])
+        if not entries:
+            break
+        last_id = entries[-1].id
+        # Entry ids by model and object id
+        ops = OrderedDict()
+        for entry in entries:
+            ops.setdefault(entry.model, OrderedDict()).setdefault(
+                entry.object_id, []).append(entry.id)
+        actions = []
+        # Entry ids by ES index and document id to relate the errors
+        docs = {}
+        for model_name, objects in ops.items():
+            model = apps.get_model('dips', model_name)
+            index = model.es_doc._index._name
+            instances = list(model.get_es_queryset().in_bulk(
+                list(objects.keys())).values())
+            # Build the ES data in bulk to avoid the related objects queries
+            instances = {
+                str(instance.pk): (instance, data) for instance, data
+                in zip(instances, model.get_es_data_in_bulk(instances))
+            }
+            for object_id, entry_ids in objects.items():
+                docs[(index, object_id)] = entry_ids
+                if object_id in instances:
+                    instance, data = instances[object_id]
+                    actions.append(instance.to_es_doc(data).to_dict(
+                        include_meta=True))
+                else:
+                    actions.append({
+                        '_op_type': 'delete',
+                        '_index': index,
+                        '_type': model.es_doc._doc_type.name,
+                        '_id': object_id,
+                    })
+        logger.info('Applying %d ES operations from the outbox' % len(actions))
+        _, batch_errors = bulk(
+            es, actions, chunk_size=batch_size, raise_on_error=False)
+        aliases = set(index for index, _ in docs)
+        bump_search_generation(*aliases)
+        unmatched = False
+        for error in batch_errors:
+            op_type, info = next(iter(error.items()))
+            # Ignore the documents already missing in the index
+            if op_type == 'delete' and info.get('status') == 404:
+                continue
+            errors.append(error)
+            # The errors include the index behind the alias, named with
+            # the alias and a timestamp by `index_data`.
+            index = info['_index']
+            if index not in aliases:
+                index = index.rsplit('-', 1)[0]
+            if docs.pop((index, str(info['_id'])), None) is None:
+                unmatched = True
+        # Keep all the entries when a failed one can't be identified
+        if unmatched:
+            continue
+        processed_ids = [id_ for ids in docs.values() for id_ in ids]
+        EsOutbox.objects.filter(id__in=processed_ids).delete()
+    if errors:
+        raise BulkIndexError(
+            '%d ES operations from the outbox failed.' % len(errors), errors)
+
+
 @shared_task(
     autoretry_for=(TransportError,),
     max_retries=10, default_retry_delay=30, ignore_result=True
@@ -165,6 +516,7 @@ def delete_es_descendants(class_name, pk):
         body = {'query': {'match': {'dip.id': pk}}}
     es = connections.get_connection()
     response = es.delete_by_query(index=indexes, body=body)
+    bump_search_generation(*indexes.split(','))
     logger.info('%d/%d descendants deleted.' % (
         response['deleted'], response['total']))
     if response['failures'] and len(response['failures']) > 0:
@@ -1,10 +1,19 @@
+from django.db import connection
 from django.test import TestCase
 from django.utils.translation import gettext_lazy as _
+from unittest.mock import patch
 
+from dips.forms import DublinCoreSettingsForm
 from dips.models import DublinCore, Setting
+from dips.settings_cache import clear_settings_cache, SettingsCache
 
 
 class DublinCoreSettingsTests(TestCase):
+    def setUp(self):
+        # The cached values are not rolled back with the test changes
+        clear_settings_cache()
+        self.addCleanup(clear_settings_cache)
+
     def test_dc_optional_fields(self):
         optional_fields = {
             'title': _('title'), 'creator': _('creator'),
@@ -34,6 +43,8 @@ class DublinCoreSettingsTests(TestCase):
         Setting.objects.filter(name='enabled_optional_dc_fields').update(
             value=enabled_optional_fields,
         )
+        # Queryset updates don't send the signals clearing the cache
+        clear_settings_cache()
         self.assertEqual(
             DublinCore.enabled_fields(),
             DublinCore.REQUIRED_FIELDS + enabled_optional_fields,
@@ -41,6 +52,7 @@ class DublinCoreSettingsTests(TestCase):
         Setting.objects.filter(name='hide_empty_dc_fields').update(
             value=False
         )
+        clear_settings_cache()
         self.assertFalse(DublinCore.hide_empty_fields())
 
     def test_dc_settings_errors(self):
@@ -55,3 +67,68 @@ class DublinCoreSettingsTests(TestCase):
         hide_empty.delete()
         self.assertRaises(Setting.DoesNotExist, DublinCore.enabled_fields)
         self.assertRaises(Setting.DoesNotExist, DublinCore.hide_empty_fields)
+
+    @patch('dips.settings_cache.time')
+    def test_dc_settings_cache(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        cache = SettingsCache(10)
+        with patch('dips.settings_cache.get_settings_cache', return_value=cache):
+            # All settings are loaded in a single query
+            with self.assertNumQueries(1):
+                DublinCore.enabled_fields()
+                DublinCore.hide_empty_fields()
+                DublinCore.get_display_data(DublinCore(identifier='1'))
+            Setting.objects.filter(name='hide_empty_dc_fields').update(
+                value=False
+            )
+            with self.assertNumQueries(0):
+                self.assertTrue(DublinCore.hide_empty_fields())
+            # The values are reloaded when the timeout expires
+            mock_time.monotonic.return_value = 110
+            self.assertFalse(DublinCore.hide_empty_fields())
+
+    @patch('dips.settings_cache.time')
+    @patch('redis.StrictRedis.get', return_value=b'1')
+    def test_dc_settings_cache_version(self, mock, mock_time):
+        mock_time.monotonic.return_value = 100
+        cache = SettingsCache(10, 'redis://localhost:6379/1')
+        with patch('dips.settings_cache.get_settings_cache', return_value=cache):
+            DublinCore.hide_empty_fields()
+            Setting.objects.filter(name='hide_empty_dc_fields').update(
+                value=False
+            )
+            # The version is only checked when the timeout expires
+            mock_time.monotonic.return_value = 105
+            self.assertTrue(DublinCore.hide_empty_fields())
+            self.assertEqual(mock.call_count, 1)
+            mock_time.monotonic.return_value = 110
+            with self.assertNumQueries(0):
+                self.assertTrue(DublinCore.hide_empty_fields())
+            self.assertEqual(mock.call_count, 2)
+            # A new version reloads the values
+            mock.return_value = b'2'
+            mock_time.monotonic.return_value = 120
+            self.assertFalse(DublinCore.hide_empty_fields())
+
+    def test_dc_settings_cache_cleared_on_save(self):
+        self.assertTrue(DublinCore.hide_empty_fields())
+        setting = Setting.objects.get(name='hide_empty_dc_fields')
+        setting.value = False
+        setting.save()
+        self.assertFalse(DublinCore.hide_empty_fields())
+
+    @patch('dips.forms.bump_settings_version')
+    def test_dc_settings_form_save(self, mock):
+        with self.assertNumQueries(1):
+            form = DublinCoreSettingsForm({
+                'enabled_optional_dc_fields': ['title'],
+                'hide_empty_dc_fields': False,
+            })
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(DublinCore.enabled_fields(), ['identifier', 'title'])
+        # The cached values are invalidated on commit
+        mock.assert_not_called()
+        self.assertEqual(len(connection.run_on_commit), 1)
+        connection.run_on_commit[0][1]()
+        mock.assert_called_once_with()
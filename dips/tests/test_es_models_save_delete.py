@@ -1,8 +1,11 @@
-from django.test import TestCase
+from django.conf import settings
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
 from unittest.mock import patch
 
-from dips.models import Collection, DIP, DigitalFile, DublinCore
+from dips.models import Collection, DIP, DigitalFile, DublinCore, EsOutbox
 from search.documents import CollectionDoc, DIPDoc, DigitalFileDoc
+from search.helpers import deferred_indexing
 
 
 class EsModelsSaveDeleteTests(TestCase):
@@ -28,11 +31,15 @@ class EsModelsSaveDeleteTests(TestCase):
         self.collection.save(update_es=False)
         mock.assert_not_called()
         mock_2.assert_not_called()
+        self.assertFalse(self.collection.es_descendants_updated)
         self.collection.save()
+        self.assertTrue(self.collection.es_descendants_updated)
         mock.assert_called()
         mock_2.assert_called_with(
             'dips.tasks.update_es_descendants',
-            args=('Collection', 1))
+            args=('Collection', 1),
+            kwargs={'version': 1},
+            countdown=settings.ES_DESCENDANTS_UPDATE_DELAY)
 
     @patch('dips.models.celery_app.send_task')
     @patch.object(DIPDoc, 'save')
@@ -44,7 +51,9 @@ class EsModelsSaveDeleteTests(TestCase):
         mock.assert_called()
         mock_2.assert_called_with(
             'dips.tasks.update_es_descendants',
-            args=('DIP', 1))
+            args=('DIP', 1),
+            kwargs={'version': 1},
+            countdown=settings.ES_DESCENDANTS_UPDATE_DELAY)
 
     @patch('dips.models.celery_app.send_task')
     @patch.object(DigitalFileDoc, 'save')
@@ -53,9 +62,96 @@ class EsModelsSaveDeleteTests(TestCase):
         mock.assert_not_called()
         mock_2.assert_not_called()
         self.digital_file.save()
+        self.assertFalse(self.digital_file.es_descendants_updated)
         mock.assert_called()
         mock_2.assert_not_called()
 
+    @patch('dips.models.celery_app.send_task')
+    @patch('search.helpers.bulk')
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_deferred_indexing(self, mock, mock_2, mock_3):
+        with deferred_indexing():
+            self.collection.save()
+            self.dip.save()
+            self.digital_file.save()
+            self.dip.save()
+            with deferred_indexing():
+                self.digital_file.save()
+        # The documents should not be indexed until the test transaction,
+        # which is never committed, ends.
+        mock.assert_not_called()
+        mock_2.assert_not_called()
+        self.assertEqual(len(connection.run_on_commit), 1)
+        # Simulate the commit of the test transaction
+        connection.run_on_commit[0][1]()
+        mock_2.assert_called_once()
+        self.assertNotIn('refresh', mock_2.call_args[1])
+        docs = list(mock_2.call_args[0][1])
+        self.assertEqual(
+            [(doc['_index'], doc['_id']) for doc in docs],
+            [
+                ('scope_collections', 1),
+                ('scope_dips', 1),
+                ('scope_digital_files', 'fake-uuid'),
+            ],
+        )
+        # Saves without the context manager should refresh the index
+        self.dip.save()
+        mock.assert_called_once_with(refresh=True)
+
+    @patch('dips.models.celery_app.send_task')
+    @patch('search.helpers.bulk')
+    @patch('dips.models.delete_document')
+    def test_deferred_indexing_rollback_and_delete(self, mock, mock_2, mock_3):
+        with deferred_indexing():
+            try:
+                with transaction.atomic():
+                    self.collection.save()
+                    raise Exception
+            except Exception:
+                pass
+            self.dip.save()
+            self.digital_file.save()
+            self.digital_file.delete()
+        # Only the DIP and the Collection, with the statistics updated
+        # by the delete, should be indexed. The rolled back changes and
+        # the deleted instances should be discarded.
+        self.assertEqual(len(connection.run_on_commit), 1)
+        connection.run_on_commit[0][1]()
+        docs = list(mock_2.call_args[0][1])
+        self.assertEqual(
+            [(doc['_index'], doc['_id']) for doc in docs],
+            [('scope_dips', 1), ('scope_collections', 1)],
+        )
+        mock.assert_called_once()
+
+    @override_settings(ES_OUTBOX=True)
+    @patch('dips.models.celery_app.send_task')
+    @patch('dips.models.delete_document')
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_es_outbox(self, mock, mock_2, mock_3):
+        self.collection.save(update_es=False)
+        self.collection.save()
+        self.digital_file.save()
+        self.digital_file.delete()
+        # The ES operations should be recorded instead of applied
+        mock.assert_not_called()
+        mock_2.assert_not_called()
+        self.assertEqual(
+            list(EsOutbox.objects.values_list('model', 'object_id', 'op')),
+            [
+                ('Collection', '1', 'index'),
+                ('DigitalFile', 'fake-uuid', 'index'),
+                ('DigitalFile', 'fake-uuid', 'delete'),
+                ('DIP', '1', 'index'),
+                ('Collection', '1', 'index'),
+            ],
+        )
+        # The outbox task should be launched once on commit
+        self.assertEqual(len(connection.run_on_commit), 1)
+        connection.run_on_commit[0][1]()
+        mock_3.assert_called_with('dips.tasks.drain_es_outbox')
+
     @patch('dips.models.celery_app.send_task')
     @patch('dips.models.delete_document')
     def test_digital_file_delete(self, mock, mock_2):
@@ -73,6 +169,7 @@ class EsModelsSaveDeleteTests(TestCase):
     def test_dip_delete(self, mock, mock_2):
         pk = self.dip.pk
         self.dip.delete()
+        self.assertTrue(self.dip.es_descendants_deleted)
         mock.assert_called_with(
             index=DIP.es_doc._index._name,
             doc_type=DIP.es_doc._doc_type.name,
@@ -95,3 +192,16 @@ class EsModelsSaveDeleteTests(TestCase):
         mock_2.assert_called_with(
             'dips.tasks.delete_es_descendants',
             args=('Collection', 1))
+
+    @patch('dips.models.delete_document')
+    def test_descendants_checks(self, patch):
+        # Each check is a single existence query
+        for instance in [self.collection, self.dip]:
+            with self.assertNumQueries(1):
+                self.assertTrue(instance.requires_es_descendants_update())
+            with self.assertNumQueries(1):
+                self.assertTrue(instance.requires_es_descendants_delete())
+        self.digital_file.delete()
+        self.assertFalse(self.collection.requires_es_descendants_update())
+        self.assertFalse(self.dip.requires_es_descendants_update())
+        self.assertTrue(self.collection.requires_es_descendants_delete())
@@ -0,0 +1,109 @@
+from datetime import datetime, timezone
+from django.test import TestCase
+from unittest.mock import patch
+
+from dips.models import (Collection, DIP, DigitalFile, DublinCore,
+                         FileStatsDelta)
+
+
+def date(day):
+    return datetime(2019, 1, day, tzinfo=timezone.utc)
+
+
+class FileStatsTests(TestCase):
+    @patch('elasticsearch_dsl.DocType.save')
+    def setUp(self, mock):
+        dc = DublinCore.objects.create(identifier='1')
+        self.collection = Collection.objects.create(dc=dc)
+        self.dips = []
+        for identifier in ['A', 'B']:
+            dc = DublinCore.objects.create(identifier=identifier)
+            self.dips.append(DIP.objects.create(
+                dc=dc,
+                collection=self.collection,
+                objectszip='/path/to/fake.zip',
+            ))
+        self.files = [
+            ('1', 'PDF', 10, date(2)),
+            ('2', 'PDF', 20, date(1)),
+            ('3', 'JPEG', 30, date(3)),
+            ('4', 'TIFF', 40, None),
+        ]
+        DigitalFile.objects.bulk_create([
+            DigitalFile(
+                uuid=uuid, dip=self.dips[0], fileformat=fileformat,
+                size_bytes=size_bytes, datemodified=datemodified)
+            for uuid, fileformat, size_bytes, datemodified in self.files
+        ])
+        self.delta = FileStatsDelta()
+        for _, fileformat, size_bytes, datemodified in self.files:
+            self.delta.add(size_bytes, fileformat, datemodified)
+
+    def assertStats(self, instance, file_count, total_size_bytes,
+                    earliest, latest, format_counts):
+        instance.refresh_from_db()
+        self.assertEqual(instance.file_count, file_count)
+        self.assertEqual(instance.total_size_bytes, total_size_bytes)
+        self.assertEqual(instance.earliest_datemodified, earliest)
+        self.assertEqual(instance.latest_datemodified, latest)
+        self.assertEqual(instance.format_counts, format_counts)
+
+    def test_update_from_delta_and_recompute(self):
+        format_counts = {'PDF': 2, 'JPEG': 1, 'TIFF': 1}
+        self.dips[0].update_file_stats(self.delta)
+        self.assertStats(
+            self.dips[0], 4, 100, date(1), date(3), format_counts)
+        self.assertStats(
+            self.collection, 4, 100, date(1), date(3), format_counts)
+        self.assertEqual(self.dips[0].top_formats, [
+            ('PDF', 2), ('JPEG', 1), ('TIFF', 1)])
+        # The full recompute gets the same statistics
+        DIP.objects.filter(pk=self.dips[0].pk).update(
+            file_count=0, total_size_bytes=0, format_counts={})
+        self.dips[0].update_file_stats()
+        self.assertStats(
+            self.dips[0], 4, 100, date(1), date(3), format_counts)
+
+    @patch('dips.models.celery_app.send_task')
+    @patch('dips.models.delete_document')
+    def test_update_on_deletions(self, mock, mock_2):
+        self.dips[0].update_file_stats(self.delta)
+        # The earliest date is obtained again when its file is removed
+        DigitalFile.objects.get(uuid='2').delete()
+        self.assertStats(
+            self.dips[0], 3, 80, date(2), date(3),
+            {'PDF': 1, 'JPEG': 1, 'TIFF': 1})
+        DigitalFile.objects.get(uuid='4').delete()
+        self.assertStats(
+            self.collection, 2, 40, date(2), date(3), {'PDF': 1, 'JPEG': 1})
+        self.dips[0].delete()
+        self.assertStats(self.collection, 0, 0, None, None, {})
+
+    def test_es_data(self):
+        self.dips[0].update_file_stats(self.delta)
+        file_stats = {
+            'file_count': 4,
+            'total_size_bytes': 100,
+            'earliest_datemodified': date(1),
+            'latest_datemodified': date(3),
+            'top_formats': [
+                {'name': 'PDF', 'count': 2},
+                {'name': 'JPEG', 'count': 1},
+                {'name': 'TIFF', 'count': 1},
+            ],
+        }
+        self.assertEqual(self.dips[0].get_es_data()['file_stats'], file_stats)
+        self.collection.refresh_from_db()
+        self.assertEqual(
+            self.collection.get_es_data()['file_stats'], file_stats)
+
+    @patch('dips.models.celery_app.send_task')
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_save_keeps_stats(self, mock, mock_2):
+        # Saving an outdated instance doesn't overwrite the statistics
+        dip = DIP.objects.get(pk=self.dips[0].pk)
+        self.dips[0].update_file_stats(self.delta)
+        dip.save()
+        self.assertStats(
+            dip, 4, 100, date(1), date(3),
+            {'PDF': 2, 'JPEG': 1, 'TIFF': 1})
@@ -1,8 +1,8 @@
 from django.test import TestCase
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 from dips import helpers
-from dips.models import DigitalFile
+from dips.models import DigitalFile, DublinCore
 
 
 class HelpersTests(TestCase):
@@ -33,6 +33,10 @@ class HelpersTests(TestCase):
         helpers.add_if_not_empty(data, 'f', 0)
         self.assertEqual(data, {'a': 'value'})
 
+    def test_chunks(self):
+        self.assertEqual(list(helpers.chunks(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(helpers.chunks(iter([]), 2)), [])
+
     def test_convert_size(self):
         SIZES_SUCCESS = [
             (2947251846, '3 GB'),
@@ -69,6 +73,23 @@ class HelpersTests(TestCase):
         self.assertEqual(digitalfile.formatversion, 'fake_version')
         self.assertEqual(digitalfile.size_bytes, 'fake_size')
 
+    def test_bulk_update(self):
+        dcs = [
+            DublinCore.objects.create(identifier=str(i)) for i in range(3)]
+        for dc in dcs:
+            dc.title = 'Title %s' % dc.identifier
+            dc.date = '2019'
+        dcs[0].date = ''
+        # A query per batch, only updating the given fields
+        with self.assertNumQueries(2):
+            helpers.bulk_update(dcs, ['title'], batch_size=2)
+        self.assertEqual(
+            list(DublinCore.objects.order_by('pk').values_list('title', 'date')),
+            [('Title 0', ''), ('Title 1', ''), ('Title 2', '')])
+        # Nothing to update
+        with self.assertNumQueries(0):
+            helpers.bulk_update([], ['title'])
+
     def test_get_sort_params_default_values(self):
         sort_option, sort_dir = helpers.get_sort_params(
             {}, self.sort_options, self.sort_default)
@@ -177,3 +198,142 @@ class HelpersTests(TestCase):
             self.assertEqual(page.number, 1)
             self.assertEqual(page.object_list.query.low_mark, 0)
             self.assertEqual(page.object_list.query.high_mark, 10)
+
+    def test_encode_decode_cursor(self):
+        data = {'sort': ['size_bytes', 'asc'], 'after': [1, 'a'], 'start': 10}
+        cursor = helpers.encode_cursor(data)
+        self.assertEqual(helpers.decode_cursor(cursor), data)
+        for cursor in ['', 'not-base64!', helpers.encode_cursor([1, 2])]:
+            self.assertIsNone(helpers.decode_cursor(cursor))
+
+    def get_fake_response(self, sort_values, total=100):
+        hits = []
+        for value in sort_values:
+            hit = MagicMock()
+            hit.meta.sort = [value, str(value)]
+            hits.append(hit)
+        response = MagicMock()
+        response.hits.__iter__.return_value = hits
+        response.hits.total = total
+        return response
+
+    @patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_get_cursor_page_from_search_first_page(self, mock):
+        mock.return_value = self.get_fake_response(range(11))
+        page = helpers.get_cursor_page_from_search(
+            self.es_search, {}, 'size_bytes', 'asc')
+        self.assertEqual(mock.call_args[0][0].to_dict(), {
+            'sort': [
+                {'size_bytes': {'order': 'asc', 'missing': '_last'}},
+                {'_id': {'order': 'asc'}},
+            ],
+            'from': 0,
+            'size': 11,
+        })
+        self.assertEqual(page.paginator.count, 100)
+        self.assertEqual(len(page), 10)
+        self.assertEqual((page.start_index(), page.end_index()), (1, 10))
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+        self.assertEqual(helpers.decode_cursor(page.next_cursor), {
+            'sort': ['size_bytes', 'asc'],
+            'after': [9, '9'],
+            'start': 10,
+            'prev': False,
+        })
+
+    @patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_get_cursor_page_from_search_next_page(self, mock):
+        mock.return_value = self.get_fake_response(range(10, 15), total=15)
+        cursor = helpers.encode_cursor({
+            'sort': ['size_bytes', 'asc'],
+            'after': [9, '9'],
+            'start': 10,
+            'prev': False,
+        })
+        page = helpers.get_cursor_page_from_search(
+            self.es_search, {'cursor': cursor}, 'size_bytes', 'asc')
+        self.assertEqual(
+            mock.call_args[0][0].to_dict()['search_after'], [9, '9'])
+        self.assertEqual((page.start_index(), page.end_index()), (11, 15))
+        self.assertTrue(page.has_previous())
+        self.assertFalse(page.has_next())
+        self.assertEqual(helpers.decode_cursor(page.previous_cursor), {
+            'sort': ['size_bytes', 'asc'],
+            'after': [10, '10'],
+            'start': 10,
+            'prev': True,
+        })
+
+    @patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_get_cursor_page_from_search_previous_page(self, mock):
+        # Hits come in reversed order for previous pages
+        mock.return_value = self.get_fake_response(range(19, 8, -1))
+        cursor = helpers.encode_cursor({
+            'sort': ['size_bytes', 'desc'],
+            'after': [20, '20'],
+            'start': 20,
+            'prev': True,
+        })
+        page = helpers.get_cursor_page_from_search(
+            self.es_search, {'cursor': cursor}, 'size_bytes', 'desc')
+        self.assertEqual(mock.call_args[0][0].to_dict()['sort'], [
+            {'size_bytes': {'order': 'asc', 'missing': '_first'}},
+            {'_id': {'order': 'asc'}},
+        ])
+        self.assertEqual(
+            [hit.meta.sort[0] for hit in page.object_list],
+            list(range(10, 20)))
+        self.assertEqual((page.start_index(), page.end_index()), (11, 20))
+        self.assertTrue(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    @patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_get_cursor_page_from_search_other_sort(self, mock):
+        mock.return_value = self.get_fake_response([])
+        cursor = helpers.encode_cursor({
+            'sort': ['filepath.raw', 'asc'],
+            'after': ['a', 'a'],
+            'start': 10,
+            'prev': False,
+        })
+        page = helpers.get_cursor_page_from_search(
+            self.es_search, {'cursor': cursor}, 'size_bytes', 'asc')
+        # The cursor is ignored and the first page is requested
+        self.assertNotIn('search_after', mock.call_args[0][0].to_dict())
+        self.assertEqual((page.start_index(), page.end_index()), (0, 0))
+        self.assertFalse(page.has_other_pages())
+
+    @patch('elasticsearch_dsl.Search.count')
+    @patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_execute_page_from_search(self, mock, mock_2):
+        mock.return_value.hits.total = 100
+        page, response = helpers.execute_page_from_search(
+            self.es_search, {'page': '2', 'limit': '20'})
+        self.assertEqual(response, mock.return_value)
+        # The count is taken from the response of the page search
+        mock.assert_called_once()
+        mock_2.assert_not_called()
+        self.assertEqual(
+            mock.call_args[0][0].to_dict(), {'from': 20, 'size': 20})
+        self.assertEqual(page.paginator.count, 100)
+        self.assertEqual(page.paginator.num_pages, 5)
+        self.assertEqual(page.number, 2)
+
+    @patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_execute_page_from_search_wrong_page(self, mock):
+        mock.return_value.hits.total = 100
+        # Not an integer
+        page, _ = helpers.execute_page_from_search(
+            self.es_search, {'page': 'text'})
+        self.assertEqual(page.number, 1)
+        self.assertEqual(
+            mock.call_args[0][0].to_dict(), {'from': 0, 'size': 10})
+        # Empty page, the last page is requested again
+        mock.reset_mock()
+        page, _ = helpers.execute_page_from_search(
+            self.es_search, {'page': '11'})
+        self.assertEqual(page.number, 10)
+        self.assertEqual(mock.call_count, 2)
+        self.assertEqual(
+            mock.call_args[0][0].to_dict(), {'from': 90, 'size': 10})
@@ -19,6 +19,11 @@ class ModelsToDocsTests(TestCase):
                 'date': 'Example date',
                 'description': 'Example description',
             },
+            'file_stats': {
+                'file_count': 0,
+                'total_size_bytes': 0,
+                'top_formats': [],
+            },
         }
         self.assertEqual(doc_dict, collection.get_es_data())
 
@@ -45,6 +50,11 @@ class ModelsToDocsTests(TestCase):
                 'description': 'Example description',
             },
             'collection': {'id': 1},
+            'file_stats': {
+                'file_count': 0,
+                'total_size_bytes': 0,
+                'top_formats': [],
+            },
         }
         self.assertEqual(doc_dict, dip.get_es_data())
 
@@ -92,3 +102,14 @@ class ModelsToDocsTests(TestCase):
                 repr(doc),
                 "DigitalFileDoc(id='07263cdf-d11f-4d24-9e16-ef46f002d037')"
             )
+
+    def test_get_es_data_in_bulk(self):
+        for model in [Collection, DIP, DigitalFile]:
+            expected = [
+                instance.get_es_data() for instance in model.objects.all()]
+            # One query to get the instances and, for DigitalFiles,
+            # another one to get the ancestors data.
+            with self.assertNumQueries(2 if model == DigitalFile else 1):
+                instances = list(model.get_es_queryset().all())
+                self.assertEqual(
+                    model.get_es_data_in_bulk(instances), expected)
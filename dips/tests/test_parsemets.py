@@ -0,0 +1,396 @@
+from django.test import TestCase, override_settings
+from unittest.mock import patch
+
+import io
+import os
+import tempfile
+
+from dips.models import (Collection, DIP, DigitalFile, DublinCore, EsOutbox,
+                         PREMISEvent)
+from dips.parsemets import METS, METSError
+
+
+METS_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<mets:mets xmlns:mets="http://www.loc.gov/METS/"
+           xmlns:premis="info:lc/xmlns/premis-v2"
+           xmlns:dcterms="http://purl.org/dc/terms/"
+           xmlns:dc="http://purl.org/dc/elements/1.1/">
+  <mets:dmdSec ID="dmdSec_1" CREATED="2018-01-01T00:00:00">
+    <mets:mdWrap MDTYPE="DC">
+      <mets:xmlData>
+        <dcterms:dublincore>
+          <dc:title>Old title</dc:title>
+        </dcterms:dublincore>
+      </mets:xmlData>
+    </mets:mdWrap>
+  </mets:dmdSec>
+  <mets:dmdSec ID="dmdSec_2" CREATED="2018-06-01T00:00:00">
+    <mets:mdWrap MDTYPE="DC">
+      <mets:xmlData>
+        <dcterms:dublincore>
+          <dc:title>Synthetic title</dc:title>
+          <dc:creator>Synthetic creator</dc:creator>
+        </dcterms:dublincore>
+      </mets:xmlData>
+    </mets:mdWrap>
+  </mets:dmdSec>
+{amdsecs}
+  <mets:fileSec>
+    <mets:fileGrp USE="original">
+{files}
+    </mets:fileGrp>
+    <mets:fileGrp USE="metadata">
+      <mets:file ID="file-metadata" ADMID="amdSec_metadata"/>
+    </mets:fileGrp>
+  </mets:fileSec>
+  <mets:structMap TYPE="physical">
+    <mets:div TYPE="Directory" LABEL="transfer">
+      <mets:div TYPE="Directory" LABEL="objects" DMDID="dmdSec_1 dmdSec_2"/>
+    </mets:div>
+  </mets:structMap>
+</mets:mets>
+"""
+
+AMDSEC_TEMPLATE = """  <mets:amdSec ID="amdSec_{index}">
+    <mets:techMD ID="techMD_{index}">
+      <mets:mdWrap MDTYPE="PREMIS:OBJECT">
+        <mets:xmlData>
+          <premis:object>
+            <premis:objectIdentifier>
+              <premis:objectIdentifierValue>{uuid}</premis:objectIdentifierValue>
+            </premis:objectIdentifier>
+            <premis:objectCharacteristics>
+              <premis:fixity>
+                <premis:messageDigestAlgorithm>sha256</premis:messageDigestAlgorithm>
+                <premis:messageDigest>{hashvalue}</premis:messageDigest>
+              </premis:fixity>
+              <premis:size>{size}</premis:size>
+              <premis:format>
+                <premis:formatDesignation>
+                  <premis:formatName>Plain Text</premis:formatName>
+                </premis:formatDesignation>
+              </premis:format>
+            </premis:objectCharacteristics>
+            <premis:originalName>%transferDirectory%objects/file_{index}.txt</premis:originalName>
+          </premis:object>
+        </mets:xmlData>
+      </mets:mdWrap>
+    </mets:techMD>
+{events}
+  </mets:amdSec>
+"""
+
+EVENT_TEMPLATE = """    <mets:digiprovMD ID="digiprovMD_{index}_{event}">
+      <mets:mdWrap MDTYPE="PREMIS:EVENT">
+        <mets:xmlData>
+          <premis:event>
+            <premis:eventIdentifier>
+              <premis:eventIdentifierValue>{uuid}</premis:eventIdentifierValue>
+            </premis:eventIdentifier>
+            <premis:eventType>ingestion</premis:eventType>
+            <premis:eventDateTime>2018-01-01T00:00:00</premis:eventDateTime>
+          </premis:event>
+        </mets:xmlData>
+      </mets:mdWrap>
+    </mets:digiprovMD>"""
+
+
+def file_uuid(index):
+    return '00000000-0000-0000-0000-%012d' % index
+
+
+def event_uuid(index, event):
+    return '00000000-0000-0000-%04d-%012d' % (event + 1, index)
+
+
+def build_mets(file_count, event_count=1):
+    """Return the content of a synthetic METS file with original files."""
+    amdsecs = []
+    files = []
+    for index in range(file_count):
+        events = [
+            EVENT_TEMPLATE.format(
+                index=index, event=event, uuid=event_uuid(index, event))
+            for event in range(event_count)
+        ]
+        amdsecs.append(AMDSEC_TEMPLATE.format(
+            index=index,
+            uuid=file_uuid(index),
+            hashvalue='%064d' % index,
+            size=index + 1,
+            events='\n'.join(events),
+        ))
+        files.append(
+            '      <mets:file ID="file-%d" ADMID="amdSec_%d"/>' % (index, index))
+    # Metadata file amdSec, not related to an original file
+    amdsecs.append(AMDSEC_TEMPLATE.format(
+        index='metadata',
+        uuid=file_uuid(file_count),
+        hashvalue='0',
+        size=1,
+        events='',
+    ))
+    return METS_TEMPLATE.format(
+        amdsecs='\n'.join(amdsecs), files='\n'.join(files))
+
+
+class ParseMetsTests(TestCase):
+    @patch('elasticsearch_dsl.DocType.save')
+    def setUp(self, patch):
+        dc = DublinCore.objects.create(identifier='1')
+        collection = Collection.objects.create(dc=dc)
+        dc = DublinCore.objects.create(identifier='A')
+        self.dip = DIP.objects.create(
+            dc=dc,
+            collection=collection,
+            objectszip='/path/to/fake.zip',
+        )
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_mets(self, file_count, event_count=1):
+        path = os.path.join(self.tmp_dir.name, 'METS.%d.xml' % file_count)
+        with open(path, 'w') as mets_file:
+            mets_file.write(build_mets(file_count, event_count))
+        return path
+
+    def test_sections_lookup_table(self):
+        mets = METS(self.write_mets(3), self.dip.pk)
+        self.assertEqual(sorted(mets.sections.keys()), [
+            'amdSec_0', 'amdSec_1', 'amdSec_2', 'amdSec_metadata',
+            'dmdSec_1', 'dmdSec_2',
+        ])
+        data, events = mets._parse_file_metadata('amdSec_1')
+        self.assertEqual(data['uuid'], file_uuid(1))
+        self.assertEqual(data['size_bytes'], '2')
+        self.assertEqual(events[0]['uuid'], event_uuid(1, 0))
+        # Missing sections can't be imported
+        with self.assertRaisesRegex(METSError, 'amdSec_missing'):
+            mets._parse_file_metadata('amdSec_missing')
+
+    @patch('dips.parsemets.bulk')
+    def test_parse_mets(self, patch):
+        mets = METS(self.write_mets(3, event_count=2), self.dip.pk)
+        mets.parse_mets()
+        # Only original files and their events should be created
+        self.assertEqual(DigitalFile.objects.count(), 3)
+        self.assertEqual(PREMISEvent.objects.count(), 6)
+        digital_file = DigitalFile.objects.get(uuid=file_uuid(2))
+        self.assertEqual(digital_file.dip, self.dip)
+        self.assertEqual(digital_file.filepath, 'objects/file_2.txt')
+        self.assertEqual(digital_file.size_bytes, 3)
+        self.assertEqual(digital_file.amdsec, 'amdSec_2')
+        # The most recent SIP dmdSec should be used
+        self.dip.dc.refresh_from_db()
+        self.assertEqual(self.dip.dc.title, 'Synthetic title')
+        self.assertEqual(self.dip.dc.creator, 'Synthetic creator')
+
+    @patch('dips.parsemets.bulk')
+    def test_parse_mets_streaming(self, patch):
+        path = self.write_mets(3, event_count=2)
+        mets = METS(path, self.dip.pk)
+        expected_files = list(mets._get_original_files())
+        expected_dc = mets.parse_dc()
+        mets = METS(path, self.dip.pk, streaming=True)
+        # The tree should not be loaded on initialization
+        self.assertFalse(hasattr(mets, 'mets_root'))
+        # Same files (in the amdSec order) and DC metadata should be parsed
+        self.assertEqual(list(mets._iterparse_original_files()), expected_files)
+        self.assertEqual(mets.parse_dc(), expected_dc)
+        mets.parse_mets()
+        self.assertEqual(DigitalFile.objects.count(), 3)
+        self.assertEqual(PREMISEvent.objects.count(), 6)
+        self.dip.dc.refresh_from_db()
+        self.assertEqual(self.dip.dc.title, 'Synthetic title')
+
+    @patch('dips.parsemets.bulk')
+    def test_parse_mets_batches(self, mock):
+        path = self.write_mets(5, event_count=2)
+        METS(path, self.dip.pk, batch_size=2).parse_mets()
+        self.assertEqual(DigitalFile.objects.count(), 5)
+        self.assertEqual(PREMISEvent.objects.count(), 10)
+        # All DigitalFiles should be indexed after the transaction
+        mock.assert_called_once()
+        self.assertEqual(len(list(mock.call_args[0][1])), 5)
+        # Parsing again should update the changed rows in place, keeping
+        # the unchanged ones and the stored events missing in the METS file.
+        DigitalFile.objects.filter(uuid=file_uuid(0)).update(size_bytes=0)
+        PREMISEvent.objects.filter(uuid=event_uuid(0, 0)).update(outcome='x')
+        PREMISEvent.objects.create(uuid='other', digitalfile_id=file_uuid(1))
+        modified = DigitalFile.objects.get(uuid=file_uuid(1)).modified
+        METS(path, self.dip.pk, batch_size=2).parse_mets()
+        self.assertEqual(DigitalFile.objects.count(), 5)
+        self.assertEqual(PREMISEvent.objects.count(), 11)
+        self.assertEqual(DigitalFile.objects.get(uuid=file_uuid(0)).size_bytes, 1)
+        self.assertEqual(PREMISEvent.objects.get(uuid=event_uuid(0, 0)).outcome, '')
+        self.assertTrue(PREMISEvent.objects.filter(uuid='other').exists())
+        self.assertGreater(
+            DigitalFile.objects.get(uuid=file_uuid(0)).modified, modified)
+        self.assertEqual(
+            DigitalFile.objects.get(uuid=file_uuid(1)).modified, modified)
+
+    @patch('dips.parsemets.bulk')
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_parse_mets_incremental(self, patch, mock):
+        path = self.write_mets(4, event_count=2)
+        counts = METS(path, self.dip.pk, incremental=True).parse_mets()
+        self.assertEqual(counts, {
+            'created': 4, 'updated': 0, 'unchanged': 0, 'removed': 0})
+        # Change a file, an event UUID and add a file not in the METS file
+        DigitalFile.objects.filter(uuid=file_uuid(0)).update(hashvalue='0')
+        PREMISEvent.objects.filter(uuid=event_uuid(1, 1)).update(uuid='other')
+        DigitalFile.objects.create(
+            uuid=file_uuid(9), dip=self.dip, size_bytes=1)
+        mock.reset_mock()
+        mock.return_value = (1, [])
+        counts = METS(path, self.dip.pk, incremental=True).parse_mets()
+        self.assertEqual(counts, {
+            'created': 0, 'updated': 2, 'unchanged': 2, 'removed': 1})
+        self.assertEqual(DigitalFile.objects.count(), 4)
+        # The stored event missing in the METS file is kept
+        self.assertEqual(PREMISEvent.objects.count(), 9)
+        self.assertTrue(PREMISEvent.objects.filter(uuid='other').exists())
+        self.assertEqual(
+            DigitalFile.objects.get(uuid=file_uuid(0)).hashvalue, '%064d' % 0)
+        # Only the changed files should be indexed and the removed deleted
+        indexed = [data['_id'] for data in mock.call_args_list[0][0][1]]
+        self.assertEqual(sorted(indexed), [file_uuid(0), file_uuid(1)])
+        deleted = [data['_id'] for data in mock.call_args_list[1][0][1]]
+        self.assertEqual(deleted, [file_uuid(9)])
+
+    @override_settings(ES_OUTBOX=True)
+    @patch('dips.parsemets.bulk')
+    def test_parse_mets_outbox(self, mock):
+        path = self.write_mets(3)
+        DigitalFile.objects.create(
+            uuid=file_uuid(9), dip=self.dip, size_bytes=1)
+        EsOutbox.objects.all().delete()
+        METS(path, self.dip.pk, batch_size=2, incremental=True).parse_mets()
+        # The saved and removed files are recorded in the outbox
+        # instead of being sent to ES.
+        mock.assert_not_called()
+        self.assertEqual(
+            sorted(EsOutbox.objects.filter(model='DigitalFile').values_list(
+                'object_id', 'op')),
+            [(file_uuid(i), 'index') for i in range(3)] +
+            [(file_uuid(9), 'delete')])
+
+    @patch('dips.parsemets.bulk', return_value=(0, []))
+    def test_parse_mets_file_stats(self, mock):
+        METS(self.write_mets(4), self.dip.pk, incremental=True).parse_mets()
+        self.dip.refresh_from_db()
+        self.assertEqual(self.dip.file_count, 4)
+        self.assertEqual(self.dip.total_size_bytes, 10)
+        self.assertEqual(self.dip.format_counts, {'Plain Text': 4})
+        # The updated files are counted once and the removed ones discounted
+        DigitalFile.objects.filter(uuid=file_uuid(0)).update(hashvalue='0')
+        METS(self.write_mets(3), self.dip.pk, incremental=True).parse_mets()
+        self.dip.refresh_from_db()
+        self.assertEqual(self.dip.file_count, 3)
+        self.assertEqual(self.dip.total_size_bytes, 6)
+        self.assertEqual(self.dip.format_counts, {'Plain Text': 3})
+        collection = Collection.objects.get(pk=self.dip.collection_id)
+        self.assertEqual(collection.file_count, 3)
+        self.assertEqual(collection.total_size_bytes, 6)
+
+    @patch('dips.parsemets.bulk')
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_parse_mets_uuid_collisions(self, patch, mock):
+        dc = DublinCore.objects.create(identifier='B')
+        other_dip = DIP.objects.create(
+            dc=dc,
+            collection=self.dip.collection,
+            objectszip='/path/to/fake_2.zip',
+        )
+        other_file = DigitalFile.objects.create(
+            uuid=file_uuid(3), dip=other_dip, size_bytes=1)
+        path = self.write_mets(5)
+        with self.assertRaisesRegex(METSError, file_uuid(3)):
+            METS(path, self.dip.pk, batch_size=2).parse_mets()
+        # The entire import should be rolled back and not indexed
+        self.assertEqual(DigitalFile.objects.filter(dip=self.dip).count(), 0)
+        mock.assert_not_called()
+        DigitalFile.objects.filter(uuid=file_uuid(3)).delete()
+        other_file = DigitalFile.objects.create(
+            uuid='other-uuid', dip=other_dip, size_bytes=1)
+        PREMISEvent.objects.create(uuid=event_uuid(4, 0), digitalfile=other_file)
+        with self.assertRaisesRegex(METSError, event_uuid(4, 0)):
+            METS(path, self.dip.pk, batch_size=2).parse_mets()
+        self.assertEqual(DigitalFile.objects.filter(dip=self.dip).count(), 0)
+
+    @patch('dips.parsemets.bulk')
+    def test_parse_mets_from_file_object(self, patch):
+        path = self.write_mets(3, event_count=2)
+        for streaming in [False, True]:
+            with open(path, 'rb') as mets_file:
+                METS(mets_file, self.dip.pk, streaming=streaming).parse_mets()
+            self.assertEqual(DigitalFile.objects.count(), 3)
+            self.assertEqual(PREMISEvent.objects.count(), 6)
+            self.dip.dc.refresh_from_db()
+            self.assertEqual(self.dip.dc.title, 'Synthetic title')
+            DigitalFile.objects.all().delete()
+
+    def test_original_files_by_admids(self):
+        path = self.write_mets(3)
+        for streaming in [False, True]:
+            mets = METS(path, self.dip.pk, streaming=streaming)
+            self.assertEqual(mets.get_original_admids(), [
+                'amdSec_0', 'amdSec_1', 'amdSec_2'])
+            files = list(mets.get_original_files(['amdSec_2', 'amdSec_1']))
+            self.assertEqual(
+                sorted(data['uuid'] for data, _ in files),
+                [file_uuid(1), file_uuid(2)])
+
+    @patch('dips.parsemets.bulk')
+    def test_parse_mets_missing_amdsec(self, mock):
+        path = os.path.join(self.tmp_dir.name, 'METS.missing.xml')
+        with open(path, 'w') as mets_file:
+            mets_file.write(build_mets(3).replace(
+                'ADMID="amdSec_1"', 'ADMID="amdSec_missing"'))
+        # Both modes should fail instead of importing different files
+        for streaming in [False, True]:
+            with self.assertRaises(METSError):
+                METS(path, self.dip.pk, streaming=streaming).parse_mets()
+            self.assertEqual(DigitalFile.objects.count(), 0)
+        mock.assert_not_called()
+
+    @patch('dips.parsemets.bulk')
+    def test_parse_mets_missing_admid(self, mock):
+        path = os.path.join(self.tmp_dir.name, 'METS.missing.xml')
+        with open(path, 'w') as mets_file:
+            mets_file.write(build_mets(3).replace(' ADMID="amdSec_1"', ''))
+        for streaming in [False, True]:
+            with self.assertRaisesRegex(METSError, 'missing its ADMID'):
+                METS(path, self.dip.pk, streaming=streaming).parse_mets()
+            self.assertEqual(DigitalFile.objects.count(), 0)
+        mock.assert_not_called()
+
+    def test_streaming_requires_seekable_file_object(self):
+        class NotSeekable(io.BytesIO):
+            def seekable(self):
+                return False
+
+        mets_file = NotSeekable(build_mets(1).encode())
+        with self.assertRaises(METSError):
+            METS(mets_file, self.dip.pk, streaming=True)
+        # It can be parsed at once otherwise
+        METS(mets_file, self.dip.pk)
+
+    def test_file_metadata_parsing_scales_linearly(self):
+        # Regression test for the amdSec lookups, which used to search the
+        # entire tree per original file. The sections are collected in a
+        # single pass over the tree, whatever the amount of files, and the
+        # file metadata is parsed without searching the tree again.
+        for file_count in [10, 40]:
+            with patch.object(
+                    METS, '_get_sections', autospec=True,
+                    side_effect=METS._get_sections) as mock:
+                mets = METS(self.write_mets(file_count), self.dip.pk)
+            mock.assert_called_once()
+            files = mets.mets_root.findall(".//fileGrp[@USE='original']/file")
+            self.assertEqual(len(files), file_count)
+            mets.mets_root = None
+            for file_ in files:
+                mets._parse_file_metadata(file_.attrib['ADMID'])
@@ -0,0 +1,37 @@
+from django.db.models import Count, Max, Min
+from django.test import TestCase
+
+from dips.models import DigitalFile, PREMISEvent
+
+
+class QueryPlansTests(TestCase):
+    """
+    Check that the hot ORM lookups use the indexes defined for them. The
+    database is empty, so the plans only depend on the available indexes.
+    """
+
+    def test_premis_events_by_datetime(self):
+        plan = PREMISEvent.objects.filter(
+            digitalfile_id='fake-uuid').order_by('datetime').explain()
+        self.assertIn('dips_premis_file_date_idx', plan)
+        # The events are obtained sorted from the index
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_dip_format_counts(self):
+        plan = DigitalFile.objects.filter(dip_id=1).order_by().values_list(
+            'fileformat').annotate(count=Count('pk')).explain()
+        self.assertIn('dips_file_dip_format_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_dip_dates_range(self):
+        plan = DigitalFile.objects.filter(dip_id=1).order_by().values(
+            'dip').annotate(
+            earliest=Min('datemodified'),
+            latest=Max('datemodified'),
+        ).explain()
+        self.assertIn('COVERING INDEX dips_file_dip_date_idx', plan)
+
+    def test_collection_digital_files(self):
+        plan = DigitalFile.objects.filter(dip__collection__pk=1).explain()
+        self.assertRegex(plan, r'SEARCH (TABLE )?dips_digitalfile USING')
+        self.assertNotRegex(plan, r'SCAN (TABLE )?dips_digitalfile\b')
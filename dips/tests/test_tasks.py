@@ -1,9 +1,23 @@
-from django.test import TestCase
+from celery.app.task import Context
+from django.test import TestCase, override_settings
+from elasticsearch.exceptions import (ConflictError, ConnectionTimeout,
+                                      RequestError)
+from elasticsearch.helpers import BulkIndexError
 from unittest.mock import patch, Mock
 
-from dips.models import DIP, DigitalFile
-from dips.tasks import (extract_and_parse_mets, MetsTask, update_es_descendants,
-                        delete_es_descendants)
+import os
+import tempfile
+import zipfile
+
+from dips.models import DIP, DigitalFile, EsDescendantsUpdate, EsOutbox
+from dips.tasks import (
+    ChunkedMetsTask, drain_es_outbox, extract_and_parse_mets,
+    extract_and_parse_mets_in_chunks, fail_mets_import, find_mets_file,
+    finish_mets_import, MetsTask, save_mets_files, update_es_descendants,
+    delete_es_descendants, wait_es_update_by_query,
+)
+from dips.parsemets import METSError
+from dips.tests.test_parsemets import build_mets, file_uuid
 
 
 class TasksTests(TestCase):
@@ -17,16 +31,99 @@ class TasksTests(TestCase):
 
     @patch('dips.tasks.METS.parse_mets')
     @patch('dips.tasks.METS.__init__', return_value=None)
-    @patch('dips.tasks.zipfile.ZipFile.extract', return_value='/mets.xml')
+    @patch('dips.tasks.zipfile.ZipFile.open')
     @patch('dips.tasks.zipfile.ZipFile.infolist', return_value=[
         Mock(filename='METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml'),
     ])
     @patch('dips.tasks.zipfile.ZipFile.__init__', return_value=None)
-    def test_extract_and_parse_mets_found(self, patch_1, patch_2, patch_3, mock_1, mock_2):
+    def test_extract_and_parse_mets_found(self, patch_1, patch_2, mock_1, mock_2, mock_3):
         extract_and_parse_mets(1, '/DIP.zip')
-        mock_1.assert_called_with('/mets.xml', 1)
+        # The METS file should be parsed from the zip file stream
+        metsfile = mock_1.return_value.__enter__.return_value
+        mock_2.assert_called_with(
+            metsfile, 1, streaming=False, incremental=False)
+        mock_3.assert_called()
+
+    @patch('dips.tasks.METS.parse_mets')
+    @patch('dips.tasks.METS.__init__', return_value=None)
+    @patch('dips.tasks.zipfile.ZipFile.extract', return_value='/mets.xml')
+    @patch('dips.tasks.zipfile.ZipFile.infolist', return_value=[
+        Mock(filename='METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml'),
+    ])
+    @patch('dips.tasks.zipfile.ZipFile.__init__', return_value=None)
+    def test_extract_and_parse_mets_extracted(self, patch_1, patch_2, patch_3, mock_1, mock_2):
+        extract_and_parse_mets(1, '/DIP.zip', extract=True)
+        mock_1.assert_called_with(
+            '/mets.xml', 1, streaming=False, incremental=False)
         mock_2.assert_called()
 
+    @patch('dips.tasks.METS.parse_mets')
+    @patch('dips.tasks.METS.__init__', return_value=None)
+    @patch('dips.tasks.zipfile.ZipFile.extract', return_value='/mets.xml')
+    @patch('dips.tasks.zipfile.ZipFile.open')
+    @patch('dips.tasks.zipfile.ZipFile.infolist', return_value=[
+        Mock(filename='METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml'),
+    ])
+    @patch('dips.tasks.zipfile.ZipFile.__init__', return_value=None)
+    def test_extract_and_parse_mets_streaming_not_seekable(
+            self, patch_1, patch_2, mock_1, patch_3, mock_2, mock_3):
+        metsfile = mock_1.return_value.__enter__.return_value
+        metsfile.seekable.return_value = False
+        extract_and_parse_mets(1, '/DIP.zip', streaming=True)
+        # The METS file should be extracted as it has to be parsed twice
+        mock_2.assert_called_once_with(
+            '/mets.xml', 1, streaming=True, incremental=False)
+        mock_3.assert_called_once()
+
+    def test_find_mets_file(self):
+        first = 'dip/METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml'
+        second = 'dip/objects/METS.cd028cb0-9942-4f26-a966-7197d7a2e15a.xml'
+        with tempfile.TemporaryDirectory() as dir_:
+            path = os.path.join(dir_, 'DIP.zip')
+            with zipfile.ZipFile(path, 'w') as zip_:
+                for index in range(5000):
+                    zip_.writestr('dip/objects/file_%d.txt' % index, '')
+                    if index == 1000:
+                        zip_.writestr(first, '')
+                    if index == 2000:
+                        zip_.writestr(second, '')
+            with zipfile.ZipFile(path) as zip_:
+                # The first match should be returned
+                self.assertEqual(find_mets_file(zip_).filename, first)
+                # The hint should be checked first without going over
+                # the zip file entries, even if it's not the first match.
+                with patch.object(zip_, 'infolist') as mock:
+                    self.assertEqual(
+                        find_mets_file(zip_, hint=second).filename, second)
+                    mock.assert_not_called()
+                # Wrong hints should fall back to the entries lookup
+                self.assertEqual(
+                    find_mets_file(zip_, hint='dip/METS.xml').filename, first)
+            with zipfile.ZipFile(path, 'w') as zip_:
+                zip_.writestr('dip/objects/file.txt', '')
+            with zipfile.ZipFile(path) as zip_:
+                self.assertIsNone(find_mets_file(zip_))
+
+    @patch('dips.tasks.METS.parse_mets')
+    @patch('dips.tasks.METS.__init__', return_value=None)
+    @patch('dips.tasks.zipfile.ZipFile.open')
+    @patch('dips.tasks.zipfile.ZipFile.__init__', return_value=None)
+    def test_extract_and_parse_mets_uses_hint(self, patch_1, patch_2, patch_3, patch_4):
+        filename = 'METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml'
+        DIP.objects.filter(pk=1).update(mets_path=filename)
+        with patch('dips.tasks.zipfile.ZipFile.getinfo',
+                   return_value=Mock(filename=filename)) as mock, \
+                patch('dips.tasks.zipfile.ZipFile.infolist') as mock_2:
+            extract_and_parse_mets(1, '/DIP.zip')
+            mock.assert_called_with(filename)
+            mock_2.assert_not_called()
+        # The task doesn't store the location found without hint
+        DIP.objects.filter(pk=1).update(mets_path='')
+        with patch('dips.tasks.zipfile.ZipFile.infolist',
+                   return_value=[Mock(filename=filename)]):
+            extract_and_parse_mets(1, '/DIP.zip')
+        self.assertEqual(DIP.objects.get(pk=1).mets_path, '')
+
     @patch('dips.models.celery_app.send_task')
     @patch('elasticsearch_dsl.DocType.save')
     def test_mets_task_after_return(self, patch, mock):
@@ -65,6 +162,100 @@ class TasksTests(TestCase):
         # All DigitalFile descendants should be saved
         self.assertEqual(mock.call_count, 2)
 
+    @patch('dips.models.celery_app.send_task')
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_chunked_mets_task_after_return(self, patch, mock):
+        task = ChunkedMetsTask()
+        # The import status should only be updated on failure
+        for pk, status in [(1, 'SUCCESS'), (2, 'FAILURE')]:
+            task.after_return(
+                status=status,
+                retval=None,
+                task_id=None,
+                args=(pk, '/mets.xml'),
+                kwargs=None,
+                einfo=None,
+            )
+        self.assertIsNone(DIP.objects.get(pk=1).import_status)
+        self.assertEqual(DIP.objects.get(pk=2).import_status, DIP.IMPORT_FAILURE)
+
+    @patch('dips.tasks.chord')
+    def test_extract_and_parse_mets_in_chunks(self, mock):
+        file_count = DigitalFile.objects.filter(dip_id=1).count()
+        with tempfile.TemporaryDirectory() as dir_:
+            path = os.path.join(dir_, 'DIP.zip')
+            with zipfile.ZipFile(path, 'w') as zip_:
+                zip_.writestr(
+                    'dip/METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml',
+                    build_mets(5),
+                )
+            extract_and_parse_mets_in_chunks(1, path, chunk_size=2)
+        # A chord should be created with a subtask per chunk
+        header = list(mock.call_args[0][0])
+        self.assertEqual(len(header), 3)
+        self.assertEqual(header[0].task, 'dips.tasks.save_mets_files')
+        # Only the ADMIDs should be sent to the subtasks
+        self.assertEqual(header[0].args[:3], (1, path, ['amdSec_0', 'amdSec_1']))
+        self.assertEqual(header[2].args[2], ['amdSec_4'])
+        # The callback should update the DC metadata and handle errors
+        callback = mock.return_value.call_args[0][0]
+        self.assertEqual(callback.task, 'dips.tasks.finish_mets_import')
+        self.assertEqual(callback.args[0], 1)
+        self.assertEqual(callback.args[1]['title'], 'Synthetic title')
+        errback = callback.options['link_error'][0]
+        self.assertEqual(errback['task'], 'dips.tasks.fail_mets_import')
+        self.assertEqual(errback['kwargs'], {'dip_id': 1})
+        # No DigitalFiles should be created from the parsing task
+        self.assertEqual(
+            DigitalFile.objects.filter(dip_id=1).count(), file_count)
+
+    @patch('dips.parsemets.bulk')
+    def test_save_mets_files(self, mock):
+        with tempfile.TemporaryDirectory() as dir_:
+            path = os.path.join(dir_, 'DIP.zip')
+            with zipfile.ZipFile(path, 'w') as zip_:
+                zip_.writestr(
+                    'dip/METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml',
+                    build_mets(3),
+                )
+            for streaming in [False, True]:
+                DigitalFile.objects.filter(dip_id=1).delete()
+                self.assertEqual(save_mets_files(
+                    1, path, ['amdSec_0', 'amdSec_1'], streaming), 2)
+                self.assertEqual(save_mets_files(
+                    1, path, ['amdSec_2'], streaming), 1)
+                self.assertEqual(DigitalFile.objects.filter(
+                    uuid__in=[file_uuid(i) for i in range(3)]).count(), 3)
+            self.assertEqual(mock.call_count, 4)
+            # Files from other DIPs should not be updated
+            with self.assertRaises(METSError):
+                save_mets_files(2, path, ['amdSec_0'])
+
+    @patch('dips.models.celery_app.send_task')
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_finish_and_fail_mets_import(self, patch, patch_2):
+        finish_mets_import([2, 1], 1, {'title': 'Chunked title'})
+        dip = DIP.objects.get(pk=1)
+        self.assertEqual(dip.import_status, DIP.IMPORT_SUCCESS)
+        self.assertEqual(dip.dc.title, 'Chunked title')
+        fail_mets_import('callback-task-id', dip_id=2)
+        dip = DIP.objects.get(pk=2)
+        self.assertEqual(dip.import_status, DIP.IMPORT_FAILURE)
+        self.assertEqual(dip.import_task_id, 'callback-task-id')
+
+    @patch('dips.models.celery_app.send_task')
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_fail_mets_import_from_failed_callback(self, patch, patch_2):
+        # Celery calls the errback with the request, exception and traceback
+        # when the chord callback raises, instead of with its id.
+        request = Context(
+            id='callback-task-id', errbacks=[fail_mets_import.s(dip_id=2)])
+        finish_mets_import.backend._call_task_errbacks(
+            request, Exception('Callback error'), None)
+        dip = DIP.objects.get(pk=2)
+        self.assertEqual(dip.import_status, DIP.IMPORT_FAILURE)
+        self.assertEqual(dip.import_task_id, 'callback-task-id')
+
     def test_update_es_descendants_wrong_class(self):
         with self.assertRaises(Exception):
             update_es_descendants('DigitalFile', 1)
@@ -103,6 +294,141 @@ class TasksTests(TestCase):
         update_es_descendants('DIP', 1)
         self.assertEqual(mock.call_count, 5)
 
+    @patch('dips.tasks.bulk_update_es_descendants')
+    @patch('dips.models.celery_app.send_task')
+    @patch('dips.models.delete_document')
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_update_es_descendants_coalesced(self, patch, patch_2, mock, mock_2):
+        dip = DIP.objects.get(pk=1)
+        for title in ['A', 'B', 'C']:
+            dip.dc.title = title
+            dip.dc.save()
+            dip.save()
+        self.assertEqual(
+            [call[1]['kwargs'] for call in mock.call_args_list],
+            [{'version': 1}, {'version': 2}, {'version': 3}],
+        )
+        self.assertEqual(EsDescendantsUpdate.get_stats(), {
+            'pending': 1, 'skipped': 0})
+        # Only the latest requested update should run
+        for version in [1, 2, 3]:
+            update_es_descendants('DIP', 1, version=version)
+        mock_2.assert_called_once()
+        self.assertEqual(mock_2.call_args[0][2]['params']['title'], 'C')
+        self.assertEqual(EsDescendantsUpdate.get_stats(), {
+            'pending': 0, 'skipped': 2})
+        # Deleted ancestors should not be updated
+        dip.save()
+        DIP.objects.get(pk=1).delete()
+        update_es_descendants('DIP', 1, version=4)
+        mock_2.assert_called_once()
+
+    @override_settings(ES_UPDATE_BY_QUERY=True)
+    @patch('dips.tasks.wait_es_update_by_query.apply_async')
+    @patch('dips.tasks.bulk', return_value=(0, []))
+    @patch('elasticsearch.client.Elasticsearch.update_by_query',
+           return_value={'task': 'node:1'})
+    def test_update_es_descendants_by_query(self, mock, mock_2, mock_3):
+        update_es_descendants('Collection', 1)
+        kwargs = mock.call_args[1]
+        self.assertEqual(
+            kwargs['body']['query'], {'match': {'collection.id': 1}})
+        self.assertEqual(kwargs['body']['script']['params']['id'], 1)
+        self.assertEqual(kwargs['slices'], 'auto')
+        self.assertFalse(kwargs['wait_for_completion'])
+        mock_2.assert_not_called()
+        self.assertEqual(mock_3.call_args[0][0], ('node:1', 'Collection', 1))
+        # Rejected, conflicting and timed out requests
+        # should fall back to the bulk updates.
+        for error in [RequestError(400, 'error', {}),
+                      ConflictError(409, 'error', {}),
+                      ConnectionTimeout('TIMEOUT', 'error', None)]:
+            mock_2.reset_mock()
+            mock.side_effect = error
+            update_es_descendants('DIP', 1)
+            mock_2.assert_called_once()
+        self.assertEqual(mock_3.call_count, 1)
+
+    @patch('dips.tasks.bulk_update_es_descendants')
+    @patch('elasticsearch.client.tasks.TasksClient.get')
+    def test_wait_es_update_by_query(self, mock, mock_2):
+        mock.return_value = {'completed': False}
+        with patch('dips.tasks.wait_es_update_by_query.retry',
+                   side_effect=Exception) as retry:
+            with self.assertRaises(Exception):
+                wait_es_update_by_query('node:1', 'DIP', 1)
+            retry.assert_called_once()
+        mock.return_value = {'completed': True, 'response': {
+            'total': 2, 'updated': 2, 'failures': [], 'version_conflicts': 0}}
+        wait_es_update_by_query('node:1', 'DIP', 1)
+        mock_2.assert_not_called()
+        # Failed tasks should fall back to the bulk updates
+        mock.return_value = {'completed': True, 'response': {
+            'total': 2, 'updated': 1, 'failures': [], 'version_conflicts': 1}}
+        wait_es_update_by_query('node:1', 'DIP', 1)
+        mock_2.assert_called_once()
+        self.assertEqual(mock_2.call_args[0][:2], ('DIP', 1))
+
+    @patch('dips.tasks.bulk', return_value=(2, []))
+    def test_drain_es_outbox(self, mock):
+        for model, object_id, op in [
+                ('DIP', '1', 'index'), ('DIP', '999', 'delete'),
+                ('DIP', '1', 'index'), ('Collection', '1', 'index')]:
+            EsOutbox.objects.create(model=model, object_id=object_id, op=op)
+        drain_es_outbox(batch_size=3)
+        self.assertEqual(mock.call_count, 2)
+        # The operations on the same instance should be coalesced
+        actions = mock.call_args_list[0][0][1]
+        self.assertEqual(len(actions), 2)
+        self.assertEqual(actions[0]['_index'], 'scope_dips')
+        self.assertEqual(actions[0]['_id'], 1)
+        self.assertEqual(actions[0]['_source']['dc']['identifier'], 'ABC')
+        # Missing instances should be deleted
+        self.assertEqual(actions[1], {
+            '_op_type': 'delete',
+            '_index': 'scope_dips',
+            '_type': DIP.es_doc._doc_type.name,
+            '_id': '999',
+        })
+        actions = mock.call_args_list[1][0][1]
+        self.assertEqual(actions[0]['_index'], 'scope_collections')
+        self.assertFalse(EsOutbox.objects.exists())
+
+    @patch('dips.tasks.bulk')
+    def test_drain_es_outbox_errors(self, mock):
+        mock.return_value = (0, [
+            {'delete': {'_index': 'scope_dips', '_id': '999', 'status': 404}},
+            {'index': {'_index': 'scope_dips', '_id': '1', 'status': 500}},
+        ])
+        EsOutbox.objects.create(model='DIP', object_id='1', op='index')
+        EsOutbox.objects.create(model='DIP', object_id='999', op='delete')
+        with self.assertRaises(BulkIndexError):
+            drain_es_outbox()
+        # Only the failed entries should be kept
+        self.assertEqual(
+            list(EsOutbox.objects.values_list('object_id', flat=True)), ['1'])
+
+    @patch('dips.tasks.bulk')
+    def test_drain_es_outbox_errors_behind_alias(self, mock):
+        # The errors report the index behind the alias
+        mock.return_value = (1, [{'index': {
+            '_index': 'scope_dips-20190131120000', '_id': '1', 'status': 500,
+        }}])
+        EsOutbox.objects.create(model='DIP', object_id='1', op='index')
+        EsOutbox.objects.create(model='Collection', object_id='1', op='index')
+        with self.assertRaises(BulkIndexError):
+            drain_es_outbox()
+        self.assertEqual(
+            list(EsOutbox.objects.values_list('model', flat=True)), ['DIP'])
+        # Unidentified errors should keep all the entries
+        mock.return_value = (1, [{'index': {
+            '_index': 'other', '_id': '1', 'status': 500,
+        }}])
+        EsOutbox.objects.create(model='Collection', object_id='1', op='index')
+        with self.assertRaises(BulkIndexError):
+            drain_es_outbox()
+        self.assertEqual(EsOutbox.objects.count(), 2)
+
     def test_delete_es_descendants_wrong_class(self):
         with self.assertRaises(Exception):
             delete_es_descendants('DigitalFile', 1)
@@ -79,3 +79,16 @@ class UserGroupsTests(TestCase):
         admin_user = User.objects.filter(username='admin').get()
         self.assertEqual(admin_user.group_names(), '')
         self.assertTrue(admin_user.is_editor())
+
+    def test_roles_cached_in_instance(self):
+        user = User.objects.create_user('test', password='test')
+        user.groups.add(self.editor)
+        # The group names are obtained once for all checks
+        with self.assertNumQueries(1):
+            self.assertTrue(user.is_editor())
+            self.assertFalse(user.is_manager())
+            self.assertTrue(user.is_editor())
+        user.groups.add(self.manager)
+        self.assertFalse(user.is_manager())
+        user.clear_group_names()
+        self.assertTrue(user.is_manager())
@@ -1,7 +1,24 @@
-from django.test import TestCase
-from unittest.mock import patch
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from unittest.mock import patch, Mock
 
-from dips.models import User
+import io
+import tempfile
+import zipfile
+
+from dips.models import Collection, DIP, DublinCore, User
+
+
+# Empty ES search response returned by the stub transport
+ES_SEARCH_RESPONSE = {
+    'took': 1,
+    'timed_out': False,
+    'hits': {'total': 0, 'max_score': None, 'hits': []},
+    'aggregations': {
+        'formats': {'buckets': []},
+        'collections': {'buckets': []},
+    },
+}
 
 
 class ViewsTests(TestCase):
@@ -26,3 +43,94 @@ class ViewsTests(TestCase):
         self.assertEqual(response.context['filters'], expected_filters)
         # But the errors should be added to the messages
         self.assertEqual(mock.call_count, 2)
+
+    @patch('elasticsearch.Transport.perform_request',
+           return_value=ES_SEARCH_RESPONSE)
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_pages_single_es_request(self, mock, mock_2):
+        dc = DublinCore.objects.create(identifier='1')
+        collection = Collection.objects.create(dc=dc)
+        dc = DublinCore.objects.create(identifier='A')
+        dip = DIP.objects.create(
+            dc=dc,
+            collection=collection,
+            objectszip='/path/to/fake.zip',
+        )
+        urls = [
+            '/',
+            '/collections/',
+            '/collection/%s/' % collection.pk,
+            '/folder/%s/' % dip.pk,
+            '/search/',
+        ]
+        for url in urls:
+            mock_2.reset_mock()
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            # Hits, total and aggregations come from a single search request
+            mock_2.assert_called_once()
+            self.assertEqual(mock_2.call_args[0][0], 'GET')
+            self.assertTrue(mock_2.call_args[0][1].endswith('/_search'))
+
+    @patch('dips.views.get_digital_file_facet_page',
+           return_value={'buckets': [], 'after': None})
+    def test_digital_file_facet(self, mock):
+        response = self.client.get('/facet/formats/', {
+            'for': 'format_a',
+            'col': 'collection_a',
+            'start_date': 'wrong',
+            'facet_query': 'query',
+            'after': 'format_b',
+        })
+        self.assertEqual(response.json(), {'buckets': [], 'after': None})
+        search = mock.call_args[0][0].to_dict()
+        # The other facet filters are applied, but not the facet own filter
+        # and the invalid dates.
+        self.assertEqual(search['query'], {'bool': {'filter': [
+            {'terms': {'collection.title.raw': ['collection_a']}},
+        ]}})
+        self.assertEqual(mock.call_args[0][1], 'formats')
+        self.assertEqual(
+            mock.call_args[1], {'query': 'query', 'after': 'format_b'})
+        # Unknown facet
+        response = self.client.get('/facet/unknown/')
+        self.assertEqual(response.status_code, 404)
+
+    @patch('dips.views.extract_and_parse_mets.delay',
+           return_value=Mock(id='task-id'))
+    @patch('dips.models.celery_app.send_task')
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_new_dip_stores_mets_path(self, patch, patch_2, mock):
+        dc = DublinCore.objects.create(identifier='1')
+        collection = Collection.objects.create(dc=dc)
+        filename = 'dip/METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml'
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, 'w') as zip_:
+            zip_.writestr('dip/objects/file.txt', '')
+            zip_.writestr(filename, '')
+        with tempfile.TemporaryDirectory() as dir_:
+            with override_settings(MEDIA_ROOT=dir_, METS_CHUNK_SIZE=0):
+                # Invalid zip file
+                response = self.client.post('/new_folder/', {
+                    'identifier': 'A',
+                    'collection': collection.pk,
+                    'objectszip': SimpleUploadedFile('dip.zip', b'zip'),
+                })
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(
+                    'objectszip', response.context['dip_form'].errors)
+                mock.assert_not_called()
+                # The METS file location is stored on upload
+                response = self.client.post('/new_folder/', {
+                    'identifier': 'A',
+                    'collection': collection.pk,
+                    'objectszip': SimpleUploadedFile(
+                        'dip.zip', content.getvalue()),
+                })
+                self.assertEqual(response.status_code, 302)
+                dip = DIP.objects.get(dc__identifier='A')
+                self.assertEqual(dip.mets_path, filename)
+                mock.assert_called_once_with(dip.pk, dip.objectszip.path)
+                # The whole zip file is saved
+                with zipfile.ZipFile(dip.objectszip.path) as zip_:
+                    self.assertEqual(len(zip_.infolist()), 2)
@@ -1,27 +1,31 @@
 from datetime import datetime
+from django.conf import settings as django_settings
 from django.contrib import messages
 from django.contrib.auth.models import Group
 from django.contrib.auth.decorators import login_required
 from django.forms import modelform_factory
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils.translation import gettext as _
-from .helpers import get_sort_params, get_page_from_search
+from .helpers import (get_sort_params, get_page_from_search,
+                      execute_page_from_search, paginate_search)
 from .models import User, Collection, DIP, DigitalFile, DublinCore
-from .forms import (DeleteByDublinCoreForm, UserCreationForm, UserChangeForm,
-                    DublinCoreSettingsForm)
-from .tasks import extract_and_parse_mets
+from .forms import (DeleteByDublinCoreForm, DIPForm, UserCreationForm,
+                    UserChangeForm, DublinCoreSettingsForm)
+from .tasks import extract_and_parse_mets, extract_and_parse_mets_in_chunks
 from search.helpers import (add_query_to_search, add_digital_file_aggs,
-                            add_digital_file_filters)
+                            add_digital_file_filters, DIGITAL_FILE_FACETS,
+                            get_digital_file_facet_page)
 
 
-def _get_and_validate_digital_file_filters(request):
+def _get_and_validate_digital_file_filters(request, add_messages=True):
     """
     Obtains the digital file filters from the request GET parameteres and
     validates the start and end dates. Returns two dics, the first one with
     all the filters set (to maintain their value in the templates) and the
     second one with only the valid filters (to be applied to the search).
-    Adds error messages to the request for invalid dates.
+    Adds error messages to the request for invalid dates, unless
+    `add_messages` is `False`.
     """
     filters = {
         'formats': request.GET.getlist('for', []),
@@ -34,24 +38,40 @@ def _get_and_validate_digital_file_filters(request):
         try:
             datetime.strptime(filters['start_date'], '%Y-%m-%d')
         except ValueError:
-            messages.error(request, _(
-                'Incorrect date format for start date (%(date)s). '
-                'Expected: yyyy-mm-dd.' % {'date': filters['start_date']}
-            ))
+            if add_messages:
+                messages.error(request, _(
+                    'Incorrect date format for start date (%(date)s). '
+                    'Expected: yyyy-mm-dd.' % {'date': filters['start_date']}
+                ))
             valid_filters.pop('start_date')
     if filters['end_date']:
         try:
             datetime.strptime(filters['end_date'], '%Y-%m-%d')
         except ValueError:
-            messages.error(request, _(
-                'Incorrect date format for end date (%(date)s). '
-                'Expected: yyyy-mm-dd.' % {'date': filters['end_date']}
-            ))
+            if add_messages:
+                messages.error(request, _(
+                    'Incorrect date format for end date (%(date)s). '
+                    'Expected: yyyy-mm-dd.' % {'date': filters['end_date']}
+                ))
             valid_filters.pop('end_date')
 
     return (filters, valid_filters)
 
 
+def _exclude_not_visible(search, user, field):
+    """
+    Exclude documents with 'PENDING' or 'FAILURE' import status in the given
+    field when the user is not an editor or an administrator. The exclusion
+    is added as a filter clause, which is not scored and can be cached.
+    """
+    if not user.is_editor():
+        search = search.exclude(
+            'terms',
+            **{field: [DIP.IMPORT_PENDING, DIP.IMPORT_FAILURE]},
+        )
+    return search
+
+
 @login_required(login_url='/login/')
 def collections(request, template):
     # Sort options
@@ -74,8 +94,7 @@ def collections(request, template):
     search = search.sort({sort_field: {'order': sort_dir}})
 
     # Pagination
-    page = get_page_from_search(search, request.GET)
-    collections = page.object_list.execute()
+    page, collections = execute_page_from_search(search, request.GET)
 
     table_headers = [
         {'label': _('Identifier'), 'sort_param': 'identifier'},
@@ -177,6 +196,7 @@ def new_user(request):
         for group_id in form.cleaned_data['groups']:
             group = Group.objects.get(id=group_id)
             user.groups.add(group)
+        user.clear_group_names()
 
         return redirect('users')
 
@@ -231,6 +251,11 @@ def edit_user(request, pk):
             if str(group_id) not in new_groups:
                 group = Group.objects.get(id=group_id)
                 user.groups.remove(group)
+        # Clear the cached roles, also from the request
+        # user when the managers change their own groups.
+        user.clear_group_names()
+        if request.user.pk == user.pk:
+            request.user.clear_group_names()
 
         return redirect('users')
 
@@ -253,11 +278,7 @@ def search(request):
     search = DigitalFile.es_doc.search()
     # Exclude DigitalFiles in DIPs with 'PENDING' or 'FAILURE' import
     # status when the user is not an editor or an administrator.
-    if not request.user.is_editor():
-        search = search.exclude(
-            'terms',
-            **{'dip.import_status': [DIP.IMPORT_PENDING, DIP.IMPORT_FAILURE]},
-        )
+    search = _exclude_not_visible(search, request.user, 'dip.import_status')
     fields = ['filepath', 'fileformat', 'collection.title']
     search = add_query_to_search(search, request.GET.get('query', ''), fields)
     search = search.sort({sort_field: {'order': sort_dir}})
@@ -268,8 +289,8 @@ def search(request):
     search = add_digital_file_filters(search, valid_filters)
 
     # Pagination
-    page = get_page_from_search(search, request.GET)
-    es_response = page.object_list.execute()
+    page, es_response, hits = paginate_search(
+        search, request.GET, sort_field, sort_dir)
 
     table_headers = [
         {'label': _('Filepath'), 'sort_param': 'path'},
@@ -281,7 +302,7 @@ def search(request):
     ]
 
     return render(request, 'search.html', {
-        'digital_files': es_response.hits,
+        'digital_files': hits,
         'aggs': es_response.aggregations,
         'filters': filters,
         'table_headers': table_headers,
@@ -306,23 +327,18 @@ def collection(request, pk):
     sort_field = sort_options.get(sort_option)
 
     # Search
-    search = DIP.es_doc.search().query(
-        'match',
+    search = DIP.es_doc.search().filter(
+        'term',
         **{'collection.id': pk},
     )
     # Exclude DIPs with 'PENDING' or 'FAILURE' import status
     # when the user is not an editor or an administrator.
-    if not request.user.is_editor():
-        search = search.exclude(
-            'terms',
-            import_status=[DIP.IMPORT_PENDING, DIP.IMPORT_FAILURE],
-        )
+    search = _exclude_not_visible(search, request.user, 'import_status')
     search = add_query_to_search(search, request.GET.get('query', ''), ['dc.*'])
     search = search.sort({sort_field: {'order': sort_dir}})
 
     # Pagination
-    page = get_page_from_search(search, request.GET)
-    dips = page.object_list.execute()
+    page, es_response, dips = paginate_search(search, request.GET, sort_field, sort_dir)
 
     table_headers = [
         {'label': _('Identifier'), 'sort_param': 'identifier'},
@@ -366,8 +382,8 @@ def dip(request, pk):
     sort_field = sort_options.get(sort_option)
 
     # Search
-    search = DigitalFile.es_doc.search().query(
-        'match',
+    search = DigitalFile.es_doc.search().filter(
+        'term',
         **{'dip.id': pk},
     )
     fields = ['filepath', 'fileformat']
@@ -380,8 +396,8 @@ def dip(request, pk):
     search = add_digital_file_filters(search, valid_filters)
 
     # Pagination
-    page = get_page_from_search(search, request.GET)
-    es_response = page.object_list.execute()
+    page, es_response, hits = paginate_search(
+        search, request.GET, sort_field, sort_dir)
 
     table_headers = [
         {'label': _('Filepath'), 'sort_param': 'path'},
@@ -393,7 +409,7 @@ def dip(request, pk):
 
     return render(request, 'dip.html', {
         'dip': dip,
-        'digital_files': es_response.hits,
+        'digital_files': hits,
         'aggs': es_response.aggregations,
         'filters': filters,
         'table_headers': table_headers,
@@ -404,6 +420,49 @@ def dip(request, pk):
     })
 
 
+@login_required(login_url='/login/')
+def digital_file_facet(request, facet):
+    """
+    Return a JSON page of the values of a digital files facet, for the
+    search page or for a DIP page when the `dip` parameter is set. The
+    values are filtered by the `facet_query` parameter and the page starts
+    after the `after` parameter value. The query and the filters from the
+    other facets are applied to the search, but not the facet own filter.
+    """
+    if facet not in DIGITAL_FILE_FACETS:
+        raise Http404
+
+    # Search
+    search = DigitalFile.es_doc.search()
+    dip_pk = request.GET.get('dip')
+    if dip_pk:
+        dip = get_object_or_404(DIP, pk=dip_pk)
+        if not dip.is_visible_by_user(request.user):
+            raise Http404
+        search = search.filter('term', **{'dip.id': dip.pk})
+        fields = ['filepath', 'fileformat']
+    else:
+        # Exclude DigitalFiles in DIPs with 'PENDING' or 'FAILURE' import
+        # status when the user is not an editor or an administrator.
+        search = _exclude_not_visible(
+            search, request.user, 'dip.import_status')
+        fields = ['filepath', 'fileformat', 'collection.title']
+    search = add_query_to_search(search, request.GET.get('query', ''), fields)
+
+    # Filters, the messages for invalid dates are added in the page request
+    _, valid_filters = _get_and_validate_digital_file_filters(
+        request, add_messages=False)
+    valid_filters.pop(facet)
+    search = add_digital_file_filters(search, valid_filters)
+
+    return JsonResponse(get_digital_file_facet_page(
+        search,
+        facet,
+        query=request.GET.get('facet_query', ''),
+        after=request.GET.get('after'),
+    ))
+
+
 @login_required(login_url='/login/')
 def digital_file(request, pk):
     digitalfile = get_object_or_404(DigitalFile, pk=pk)
@@ -457,10 +516,6 @@ def new_dip(request):
     if not request.user.is_editor():
         return redirect('home')
 
-    DIPForm = modelform_factory(
-        DIP,
-        fields=('collection', 'objectszip',),
-    )
     dip_form = DIPForm(request.POST or None, request.FILES or None)
     DublinCoreForm = modelform_factory(DublinCore, fields=('identifier',))
     dc_form = DublinCoreForm(request.POST or None)
@@ -472,8 +527,13 @@ def new_dip(request):
         # as it will be made when the async_result id is added bellow.
         dip.save(update_es=False)
 
-        # Extract and parse METS file asynchronously
-        async_result = extract_and_parse_mets.delay(dip.pk, dip.objectszip.path)
+        # Extract and parse METS file asynchronously, saving
+        # the original files in parallel tasks if configured.
+        if django_settings.METS_CHUNK_SIZE > 0:
+            task = extract_and_parse_mets_in_chunks
+        else:
+            task = extract_and_parse_mets
+        async_result = task.delay(dip.pk, dip.objectszip.path)
         # Save the async_result id to relate later with the TaskResult
         # related object, which is not created on task call. Celery docs
         # recommend to call get() or forget() on AsyncResult to free the
@@ -523,7 +583,7 @@ def edit_collection(request, pk):
     if request.method == 'POST' and collection_form.is_valid() and dc_form.is_valid():
         dc_form.save()
         collection_form.save()
-        if collection.requires_es_descendants_update():
+        if collection.es_descendants_updated:
             messages.info(request, _(
                 'A background process has been launched to update the '
                 'Collection metadata in the Elasticsearch index for the '
@@ -556,7 +616,7 @@ def edit_dip(request, pk):
         dc_form.save()
         # Trigger ES update
         dip.save()
-        if dip.requires_es_descendants_update():
+        if dip.es_descendants_updated:
             messages.info(request, _(
                 'A background process has been launched to update the '
                 'Folder metadata in the Elasticsearch index for the '
@@ -581,13 +641,13 @@ def delete_collection(request, pk):
         initial={'identifier': ''},
     )
     if form.is_valid():
-        if collection.requires_es_descendants_delete():
+        collection.delete()
+        if collection.es_descendants_deleted:
             messages.info(request, _(
                 'A background process has been launched to delete the '
                 'descendant Folders and Digital Files from the Elasticsearch '
                 'indexes.'
             ))
-        collection.delete()
         return redirect('collections')
 
     return render(
@@ -612,12 +672,12 @@ def delete_dip(request, pk):
     )
     if form.is_valid():
         collection_pk = dip.collection.pk
-        if dip.requires_es_descendants_delete():
+        dip.delete()
+        if dip.es_descendants_deleted:
             messages.info(request, _(
                 'A background process has been launched to delete the '
                 'descendant Digital Files from the Elasticsearch index.'
             ))
-        dip.delete()
         return redirect('collection', pk=collection_pk)
 
     return render(request, 'delete_dip.html', {'form': form, 'dip': dip})
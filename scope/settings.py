@@ -182,6 +182,52 @@ ES_INDEXES_SETTINGS = {
     'number_of_replicas': env.int('ES_INDEXES_REPLICAS', default=0),
 }
 
+# Record the ES changes in an outbox table, processed by a Celery task
+ES_OUTBOX = env.bool('ES_OUTBOX', default=False)
+# Amount of outbox entries processed per bulk request
+ES_OUTBOX_BATCH_SIZE = env.int('ES_OUTBOX_BATCH_SIZE', default=500)
+# Update the descendant documents with update by query requests
+ES_UPDATE_BY_QUERY = env.bool('ES_UPDATE_BY_QUERY', default=False)
+# Seconds between the checks of the ES tasks status
+ES_TASK_POLL_INTERVAL = env.int('ES_TASK_POLL_INTERVAL', default=5)
+# Seconds to wait for later changes before updating the descendant documents
+ES_DESCENDANTS_UPDATE_DELAY = env.int('ES_DESCENDANTS_UPDATE_DELAY', default=5)
+# Paginate the search results with `search_after` cursors
+SEARCH_CURSOR_PAGINATION = env.bool('SEARCH_CURSOR_PAGINATION', default=False)
+# Amount of values per page in the search facets
+SEARCH_FACET_SIZE = env.int('SEARCH_FACET_SIZE', default=100)
+# Redis URL to cache the search responses, disabled if empty
+SEARCH_CACHE_URL = env('SEARCH_CACHE_URL', default='')
+# Seconds to keep the cached search responses
+SEARCH_CACHE_TIMEOUT = env.int('SEARCH_CACHE_TIMEOUT', default=300)
+# Maximum amount of cached search responses
+SEARCH_CACHE_MAX_ENTRIES = env.int('SEARCH_CACHE_MAX_ENTRIES', default=10000)
+# Seconds after a change in the indexes without caching their responses,
+# as the change may not be visible until the indexes are refreshed.
+SEARCH_CACHE_REFRESH_INTERVAL = env.int(
+    'SEARCH_CACHE_REFRESH_INTERVAL', default=2)
+# Seconds to keep the settings values cached in each process before
+# reloading them or checking their version in Redis.
+SETTINGS_CACHE_TIMEOUT = env.int('SETTINGS_CACHE_TIMEOUT', default=10)
+# Redis URL to invalidate the settings values cached in each process,
+# not used if empty.
+SETTINGS_CACHE_URL = env('SETTINGS_CACHE_URL', default='')
+
+# METS parsing
+
+# Parse the METS files incrementally to keep the memory usage bounded
+METS_STREAMING = env.bool('METS_STREAMING', default=False)
+# Extract the METS files to a temporary directory instead of
+# parsing them directly from the DIP zip files.
+METS_EXTRACT = env.bool('METS_EXTRACT', default=False)
+# Amount of original files saved to the database per batch
+METS_BATCH_SIZE = env.int('METS_BATCH_SIZE', default=500)
+# Amount of original files saved per parallel task,
+# zero to save all of them from the parsing task.
+METS_CHUNK_SIZE = env.int('METS_CHUNK_SIZE', default=0)
+# Only save the changed files when a METS file is parsed again
+METS_INCREMENTAL = env.bool('METS_INCREMENTAL', default=False)
+
 # Celery
 
 CELERY_BROKER_URL = env('CELERY_BROKER_URL')
@@ -46,36 +46,85 @@ $(document).ready(function() {
   });
 
   /*
-  Filter aggregation items based on `agg-query` input:
-  If a backend endpoint is implement to allow pagination in the
-  aggregation drop-downs, this query should also be passed to
-  perform the filtering in there.
+  Load a page of aggregation items from the facet endpoint:
+  The checked items are kept and the unchecked items are replaced by the
+  requested page, unless `append` is set. The `after` value for the next
+  page is stored in the drop-down and the "Load more" button is hidden in
+  the last page.
   */
-  $('body').on('keyup', '.aggs-query-input', function () {
-    var $this = $(this);
-    var query = $this.val().trim();
-    var $items = $($this.closest('.aggs-dropdown').find('.dropdown-item'));
-
-    // Show all items on empty query
-    if (!query.length) {
-      $items.removeClass('d-none');
-      return;
+  function loadAggItems($dropdown, append) {
+    var url = new URL($dropdown.data('facetUrl'), document.location);
+    var query = $dropdown.find('.aggs-query-input').val().trim();
+    if (query.length) {
+      url.searchParams.set('facet_query', query);
     }
-
-    // Show/hide based on query value, case insensitive
-    query = query.toLowerCase();
-    $items.each(function() {
-      var $item = $(this);
-      var $checkbox = $($item.find('input[type="checkbox"]')[0]);
-      var value = $checkbox.val().trim().toLowerCase();
-      if (value.indexOf(query) >= 0) {
-        $item.removeClass('d-none');
-      } else {
-        // Uncheck when hiding
-        $checkbox.prop('checked', false);
-        $item.addClass('d-none');
+    if (append && $dropdown.data('after')) {
+      url.searchParams.set('after', $dropdown.data('after'));
+    }
+    var requestId = ($dropdown.data('requestId') || 0) + 1;
+    $dropdown.data('requestId', requestId);
+    fetch(url.href, {credentials: 'same-origin'}).then(function(response) {
+      return response.json();
+    }).then(function(data) {
+      // Ignore the responses to outdated queries
+      if (requestId !== $dropdown.data('requestId')) {
+        return;
       }
+      var param = $dropdown.data('param');
+      var $loadMore = $($dropdown.find('.aggs-load-more')[0]);
+      var values = [];
+      $dropdown.find('.dropdown-item').each(function() {
+        var $item = $(this);
+        var $checkbox = $($item.find('input[type="checkbox"]')[0]);
+        if (append || $checkbox.prop('checked')) {
+          values.push($checkbox.val());
+        } else {
+          $item.remove();
+        }
+      });
+      data.buckets.forEach(function(bucket) {
+        var value = String(bucket.key);
+        if (values.indexOf(value) >= 0) {
+          return;
+        }
+        var counter = ($dropdown.data('counter') || 0) + 1;
+        $dropdown.data('counter', counter);
+        var id = param + '_loaded_' + counter;
+        var $checkbox = $('<input type="checkbox" class="custom-control-input">')
+          .attr({name: param, id: id}).val(value);
+        var $label = $('<label class="custom-control-label">')
+          .attr('for', id).text(value);
+        $('<li class="dropdown-item">').append(
+          $('<div class="custom-control custom-checkbox">').append($checkbox, $label)
+        ).insertBefore($loadMore);
+      });
+      $dropdown.data('after', data.after);
+      $dropdown.data('paged', true);
+      $loadMore.toggleClass('d-none', data.after === null);
     });
+  }
+
+  /*
+  Filter aggregation items based on `agg-query` input:
+  The query is sent to the facet endpoint, which filters and pages
+  all the aggregation values, after a short delay since the last key.
+  */
+  $('body').on('keyup', '.aggs-query-input', function () {
+    var $dropdown = $($(this).closest('.aggs-dropdown'));
+    clearTimeout($dropdown.data('timeout'));
+    $dropdown.data('timeout', setTimeout(function() {
+      loadAggItems($dropdown, false);
+    }, 300));
+  });
+
+  /*
+  Load the next page of aggregation items. The first page shown is
+  ordered by number of digital files, so it's replaced by the first
+  page ordered by value the first time.
+  */
+  $('body').on('click', '.aggs-load-more', function () {
+    var $dropdown = $($(this).closest('.aggs-dropdown'));
+    loadAggItems($dropdown, Boolean($dropdown.data('paged')));
   });
 
   /*
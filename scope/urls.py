@@ -36,6 +36,7 @@ urlpatterns = [
     url(r'^new_folder/', views.new_dip, name='new_dip'),
     url(r'^faq/', views.faq, name='faq'),
     url(r'^search/', views.search, name='search'),
+    url(r'^facet/(?P<facet>\w+)/$', views.digital_file_facet, name='digital_file_facet'),
     url(r'^user/(?P<pk>\d+)/edit$', views.edit_user, name='edit_user'),
     url(r'^new_user/', views.new_user, name='new_user'),
     url(r'^users/', views.users, name='users'),
@@ -0,0 +1,188 @@
+from django.conf import settings
+from elasticsearch_dsl.response import Response
+
+import hashlib
+import json
+import logging
+import redis
+import time
+
+logger = logging.getLogger('search.cache')
+
+# Prefix for all the keys saved in Redis
+PREFIX = 'scope:search:'
+# Sorted set with the entries keys scored by their last access time
+LRU_KEY = PREFIX + 'lru'
+HITS_KEY = PREFIX + 'hits'
+MISSES_KEY = PREFIX + 'misses'
+
+
+class SearchCache(object):
+    """
+    Cache of ES search responses saved in Redis, shared by all processes.
+    The entries keys are built from the search indexes and body, and from
+    the current generation of those indexes, which is increased with each
+    change made to them, so the outdated entries are not used anymore.
+    The entries expire after `timeout` seconds and the least recently used
+    ones are evicted when there are more than `max_entries`. The indexes
+    are flagged as changed for `refresh_interval` seconds after each change,
+    as it may not be visible in the searches until they are refreshed.
+    """
+
+    def __init__(self, url, timeout, max_entries, refresh_interval=0):
+        self.redis = redis.StrictRedis.from_url(url)
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.refresh_interval = refresh_interval
+
+    @staticmethod
+    def _generation_key(index):
+        return '%sgeneration:%s' % (PREFIX, index)
+
+    @staticmethod
+    def _changed_key(index):
+        return '%schanged:%s' % (PREFIX, index)
+
+    def get_key(self, indexes, body):
+        """
+        Build the entry key for a search body over the given indexes. Returns
+        the key and if any of the indexes is flagged as recently changed.
+        """
+        indexes = sorted(indexes)
+        generations = []
+        changed = False
+        if indexes:
+            values = self.redis.mget(
+                [self._generation_key(i) for i in indexes] +
+                [self._changed_key(i) for i in indexes])
+            generations = [
+                int(generation or 0) for generation in values[:len(indexes)]]
+            changed = any(values[len(indexes):])
+        data = json.dumps({
+            'indexes': indexes,
+            'generations': generations,
+            'body': body,
+        }, sort_keys=True)
+        key = '%sentry:%s' % (PREFIX, hashlib.sha1(data.encode()).hexdigest())
+        return key, changed
+
+    def get(self, key):
+        """Get the response data of an entry, `None` if it's missing."""
+        data = self.redis.get(key)
+        pipe = self.redis.pipeline()
+        if data is None:
+            pipe.incr(MISSES_KEY)
+        else:
+            pipe.incr(HITS_KEY)
+            pipe.zadd(LRU_KEY, time.time(), key)
+        pipe.execute()
+        if data is None:
+            return None
+        return json.loads(data.decode())
+
+    def set(self, key, data):
+        """Save the response data of an entry and evict the exceeding ones."""
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.setex(key, self.timeout, json.dumps(data))
+        pipe.zadd(LRU_KEY, now, key)
+        # Remove the expired entries from the LRU set
+        pipe.zremrangebyscore(LRU_KEY, '-inf', now - self.timeout)
+        pipe.zcard(LRU_KEY)
+        excess = pipe.execute()[-1] - self.max_entries
+        if excess <= 0:
+            return
+        keys = self.redis.zrange(LRU_KEY, 0, excess - 1)
+        pipe = self.redis.pipeline()
+        pipe.delete(*keys)
+        pipe.zrem(LRU_KEY, *keys)
+        pipe.execute()
+
+    def bump(self, indexes, refreshed=False):
+        """
+        Increase the generation of the given indexes and flag them as
+        recently changed, unless the changes have been `refreshed`.
+        """
+        pipe = self.redis.pipeline()
+        for index in indexes:
+            pipe.incr(self._generation_key(index))
+            if not refreshed and self.refresh_interval:
+                pipe.set(
+                    self._changed_key(index), 1, ex=self.refresh_interval)
+        pipe.execute()
+
+    def get_stats(self):
+        """Get the hits, misses and amount of entries of the cache."""
+        pipe = self.redis.pipeline()
+        pipe.get(HITS_KEY)
+        pipe.get(MISSES_KEY)
+        pipe.zcount(LRU_KEY, time.time() - self.timeout, '+inf')
+        hits, misses, entries = pipe.execute()
+        return {
+            'hits': int(hits or 0),
+            'misses': int(misses or 0),
+            'entries': entries,
+        }
+
+
+_cache = None
+
+
+def get_search_cache():
+    """Get the search cache, `None` if `SEARCH_CACHE_URL` is not set."""
+    global _cache
+    if not settings.SEARCH_CACHE_URL:
+        return None
+    if _cache is None:
+        _cache = SearchCache(
+            settings.SEARCH_CACHE_URL,
+            settings.SEARCH_CACHE_TIMEOUT,
+            settings.SEARCH_CACHE_MAX_ENTRIES,
+            settings.SEARCH_CACHE_REFRESH_INTERVAL,
+        )
+    return _cache
+
+
+def execute_search(search):
+    """
+    Execute an ES search, getting the response from the search cache when
+    it's enabled. If Redis is not available, the search is executed. The
+    responses from recently changed indexes are not cached, as they may
+    not include the changes until the indexes are refreshed.
+    """
+    cache = get_search_cache()
+    if cache is None:
+        return search.execute()
+    try:
+        key, changed = cache.get_key(search._index or [], search.to_dict())
+        data = cache.get(key)
+    except redis.RedisError as e:
+        logger.warning('Search cache not available: %s' % e)
+        return search.execute()
+    if data is not None:
+        return Response(search, data)
+    response = search.execute()
+    if changed:
+        return response
+    try:
+        cache.set(key, response.to_dict())
+    except redis.RedisError as e:
+        logger.warning('Search cache not available: %s' % e)
+    return response
+
+
+def bump_search_generation(*indexes, refreshed=False):
+    """
+    Invalidate the search cache entries of the given indexes. It must be
+    called after each change made to them. Unless the changes have been
+    `refreshed`, the indexes are flagged as recently changed, so a search
+    made before the changes are visible can't save its results under the
+    new generation.
+    """
+    cache = get_search_cache()
+    if cache is None:
+        return
+    try:
+        cache.bump(indexes, refreshed=refreshed)
+    except redis.RedisError as e:
+        logger.warning('Search cache not available: %s' % e)
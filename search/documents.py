@@ -15,8 +15,21 @@ class DublinCoreDoc(InnerDoc):
     description = Text()
 
 
+class FileStatsDoc(InnerDoc):
+    file_count = Integer()
+    total_size_bytes = Long()
+    # Always saved as UTC, not just the default.
+    earliest_datemodified = Date(default_timezone='UTC')
+    latest_datemodified = Date(default_timezone='UTC')
+    top_formats = Object(properties={
+        'name': Keyword(),
+        'count': Integer(),
+    })
+
+
 class CollectionDoc(BaseDoc):
     dc = Object(DublinCoreDoc)
+    file_stats = Object(FileStatsDoc)
 
     class Index:
         name = 'scope_collections'
@@ -27,6 +40,7 @@ class DIPDoc(BaseDoc):
     collection = Object(properties={'id': Integer()})
     import_task_id = Keyword()
     import_status = Keyword()
+    file_stats = Object(FileStatsDoc)
 
     class Index:
         name = 'scope_dips'
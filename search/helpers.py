@@ -1,5 +1,17 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection, transaction
+from elasticsearch.helpers import bulk
 from elasticsearch_dsl.connections import connections
 
+from search.cache import bump_search_generation, execute_search
+
+import threading
+
+# Thread local state of the `deferred_indexing` context manager
+_deferred = threading.local()
+
 
 def delete_document(index, doc_type, id):
     """
@@ -8,14 +20,121 @@ def delete_document(index, doc_type, id):
     """
     es = connections.get_connection()
     es.delete(index=index, doc_type=doc_type, id=id, refresh=True)
+    bump_search_generation(index, refreshed=True)
+
+
+class IndexingBuffer(object):
+    """
+    Collection of model instances, extending AbstractEsModel, to index their
+    related documents in ES with a single bulk request. Each instance is only
+    indexed once, with the data it has when the buffer is flushed.
+    """
+
+    def __init__(self):
+        self.instances = OrderedDict()
+
+    def add(self, instance):
+        self.instances[(instance.__class__, instance.pk)] = instance
+
+    def discard(self, instance):
+        self.instances.pop((instance.__class__, instance.pk), None)
+
+    def is_pending_on_commit(self):
+        """
+        Check if the flush is still registered to run on the commit of the
+        current transaction, it's discarded when the transaction is rolled
+        back and removed after it's executed.
+        """
+        return any(func == self.flush for _, func in connection.run_on_commit)
+
+    def flush(self):
+        """Index the collected instances without refreshing the indexes."""
+        if not self.instances:
+            return
+        instances = list(self.instances.values())
+        self.instances.clear()
+        # Build the ES data in bulk per model
+        models = OrderedDict()
+        for instance in instances:
+            models.setdefault(instance.__class__, []).append(instance)
+        bulk(
+            connections.get_connection(),
+            (instance.to_es_doc(data).to_dict(include_meta=True)
+             for model, model_instances in models.items()
+             for instance, data in zip(
+                 model_instances, model.get_es_data_in_bulk(model_instances))),
+        )
+        bump_search_generation(*set(
+            instance.es_doc._index._name for instance in instances))
+
+
+@contextmanager
+def deferred_indexing():
+    """
+    Context manager to collect the AbstractEsModel instances saved within
+    it, instead of indexing them one by one with an index refresh per save.
+    The instances saved in a transaction are indexed in bulk once it's
+    committed, and they are not indexed if it's rolled back. The instances
+    saved outside a transaction are indexed in bulk when the context ends.
+    Nested contexts are indexed when the outermost one ends.
+    """
+    if getattr(_deferred, 'depth', 0):
+        _deferred.depth += 1
+        try:
+            yield
+        finally:
+            _deferred.depth -= 1
+        return
+    _deferred.depth = 1
+    _deferred.buffer = IndexingBuffer()
+    try:
+        yield
+    finally:
+        buffer = _deferred.buffer
+        _deferred.depth = 0
+        _deferred.buffer = None
+        _deferred.commit_buffer = None
+        # The rows saved outside a transaction are already committed
+        buffer.flush()
+
+
+def is_indexing_deferred():
+    """Check if the code is running within `deferred_indexing`."""
+    return bool(getattr(_deferred, 'depth', 0))
+
+
+def defer_indexing(instance):
+    """
+    Add a saved AbstractEsModel instance to the buffer of the current
+    `deferred_indexing` context or, within a transaction, to the buffer
+    flushed when the transaction is committed.
+    """
+    if not connection.in_atomic_block:
+        _deferred.buffer.add(instance)
+        return
+    buffer = getattr(_deferred, 'commit_buffer', None)
+    if buffer is None or not buffer.is_pending_on_commit():
+        buffer = _deferred.commit_buffer = IndexingBuffer()
+        transaction.on_commit(buffer.flush)
+    buffer.add(instance)
+
+
+def discard_deferred_indexing(instance):
+    """Remove a deleted instance from the `deferred_indexing` buffers."""
+    for name in ['buffer', 'commit_buffer']:
+        buffer = getattr(_deferred, name, None)
+        if buffer is not None:
+            buffer.discard(instance)
 
 
 def add_query_to_search(search, query, fields):
     """
     Check if a query is not whitespace and add a `simple_query_string`
-    to the search over a given list of fields.
+    to the search over a given list of fields. The whitespace is normalized
+    to build the same request, and search cache key, for equivalent queries.
     """
-    if query.strip():
+    query = ' '.join(query.split())
+    if query:
         search = search.query(
             'simple_query_string',
             query=query,
@@ -26,31 +145,78 @@ def add_query_to_search(search, query, fields):
     return search
 
 
+# Digital file facets with their keyword field and the text field used
+# to filter the facet values.
+DIGITAL_FILE_FACETS = OrderedDict([
+    ('formats', ('fileformat.raw', 'fileformat')),
+    ('collections', ('collection.title.raw', 'collection.title')),
+])
+
+
 def add_digital_file_aggs(search, collections=True):
     """Add aggregations to DigitalFile search.
 
-    Set aggregations size to 10000 to get "all" buckets. Ideally, the aggs.
-    should allow pagination and filtering. That will require to:
-    - Use `composite` aggregations with `after_key`.
-    - Add JSON endpoint to get subsequent pages and filter query.
-    - Add Javascript/Typescript code to request new pages and query.
+    Only the `SEARCH_FACET_SIZE` buckets with more files are requested to
+    keep the search responses small. All the values can be paged and
+    filtered with `get_digital_file_facet_page`.
     """
-    search.aggs.bucket('formats', 'terms', field='fileformat.raw', size=10000)
+    field, _ = DIGITAL_FILE_FACETS['formats']
+    search.aggs.bucket(
+        'formats', 'terms', field=field, size=settings.SEARCH_FACET_SIZE)
     # The collections agg. is made directly over the title to avoid hitting
     # the ORM to get the title with the id or to use a composite agg. with
     # multiple sources. The biggest downside is that the titles are used as
     # value in the request parameters, which can create long URLs as multiple
     # selection is allowed. This agg. is optional and not added in DIP pages.
     if collections:
+        field, _ = DIGITAL_FILE_FACETS['collections']
         search.aggs.bucket(
-            'collections', 'terms', field='collection.title.raw', size=10000)
+            'collections', 'terms', field=field,
+            size=settings.SEARCH_FACET_SIZE)
 
     return search
 
 
+def get_digital_file_facet_page(search, facet, query='', after=None):
+    """
+    Get a page of values of a DigitalFile facet with a `composite`
+    aggregation, sorted by value and starting after the given value. The
+    values can be filtered by a prefix query over their words. Returns a
+    dict with the buckets and the value to get the next page, which is
+    `None` in the last page.
+    """
+    field, text_field = DIGITAL_FILE_FACETS[facet]
+    if query.strip():
+        search = search.filter(
+            'match_phrase_prefix', **{text_field: query.strip()})
+    agg = {
+        'sources': [{facet: {'terms': {'field': field}}}],
+        'size': settings.SEARCH_FACET_SIZE,
+    }
+    if after is not None:
+        agg['after'] = {facet: after}
+    # The `composite` aggregation is added as a raw dict, elasticsearch-dsl
+    # 6.2 can't build it from its `sources` list.
+    search = search.extra(size=0, aggs={facet: {'composite': agg}})
+    response = execute_search(search)
+
+    result = response.aggregations[facet]
+    buckets = [
+        {'key': bucket.key[facet], 'doc_count': bucket.doc_count}
+        for bucket in result.buckets
+    ]
+    # With a single source, the last bucket key is the `after_key`,
+    # which is not returned by all ES 6 versions.
+    next_after = None
+    if len(buckets) == settings.SEARCH_FACET_SIZE:
+        next_after = buckets[-1]['key']
+    return {'buckets': buckets, 'after': next_after}
+
+
 def add_digital_file_filters(search, filters):
     """
-    Forms boolean query with must clauses for digital file filters dict.
+    Forms boolean query with filter clauses for digital file filters dict,
+    which are not scored and can be cached by ES.
     Filters dict. must be already validated:
     - formats: list of strings.
     - collections: list of strings.
@@ -58,18 +224,18 @@ def add_digital_file_filters(search, filters):
     - end_date: string with `yyyy-MM-dd` date format.
     """
     if 'formats' in filters and filters['formats']:
-        search = search.query('terms', **{'fileformat.raw': filters['formats']})
+        search = search.filter('terms', **{'fileformat.raw': filters['formats']})
     if 'collections' in filters and filters['collections']:
-        search = search.query(
+        search = search.filter(
             'terms', **{'collection.title.raw': filters['collections']})
     if 'start_date' in filters and filters['start_date']:
-        search = search.query(
+        search = search.filter(
             'range', **{'datemodified': {
                 'gte': filters['start_date'],
                 'format': 'yyyy-MM-dd'
             }})
     if 'end_date' in filters and filters['end_date']:
-        search = search.query(
+        search = search.filter(
             'range', **{'datemodified': {
                 'lte': filters['end_date'],
                 'format': 'yyyy-MM-dd'
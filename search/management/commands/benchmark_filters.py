@@ -0,0 +1,149 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from elasticsearch.helpers import streaming_bulk
+from elasticsearch_dsl import analyzer
+from elasticsearch_dsl.connections import connections
+from tqdm import tqdm
+
+import datetime
+import random
+import statistics
+import time
+
+from dips.models import DIP, DigitalFile
+from search.helpers import (add_query_to_search, add_digital_file_aggs,
+                            add_digital_file_filters)
+
+# Temporary index for the synthetic digital files
+INDEX_NAME = 'scope_benchmark_digital_files'
+FORMATS = ['Format %d' % i for i in range(200)]
+COLLECTIONS = ['Collection %d' % i for i in range(500)]
+QUERIES = ['file', 'objects', 'dir', 'tif', 'pdf', 'jpg', 'wav', 'txt']
+# Filters repeated across the searches, like the user selections
+FILTERS = [
+    {'formats': FORMATS[:2]},
+    {'collections': COLLECTIONS[:3]},
+    {'start_date': '2010-01-01', 'end_date': '2015-12-31'},
+    {'formats': FORMATS[:1], 'collections': COLLECTIONS[:1]},
+]
+
+
+class Command(BaseCommand):
+    help = ('Compare the latency and query cache usage of the digital file '
+            'filters in query and filter context over a synthetic index.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--files', type=int, default=1000000,
+            help='Amount of synthetic digital files to index.')
+        parser.add_argument(
+            '--runs', type=int, default=200,
+            help='Amount of searches made for each context.')
+
+    def handle(self, *args, **options):
+        es = connections.get_connection()
+        index = DigitalFile.es_doc._index.clone(INDEX_NAME)
+        index.settings(**settings.ES_INDEXES_SETTINGS)
+        index.analyzer(analyzer('default', 'english'))
+        index.delete(ignore=404)
+        index.create()
+        try:
+            self.index_files(es, options['files'])
+            es.indices.refresh(index=INDEX_NAME)
+            for context in ['query', 'filter']:
+                self.run_searches(es, context, options['runs'])
+        finally:
+            index.delete(ignore=404)
+
+    def index_files(self, es, total):
+        rand = random.Random(0)
+        start = datetime.datetime(2000, 1, 1)
+        doc_type = DigitalFile.es_doc._doc_type.name
+        statuses = [DIP.IMPORT_SUCCESS] * 8 + [
+            DIP.IMPORT_PENDING, DIP.IMPORT_FAILURE]
+
+        def files():
+            for i in range(total):
+                fileformat = rand.choice(FORMATS)
+                collection = rand.randrange(len(COLLECTIONS))
+                yield {
+                    '_index': INDEX_NAME,
+                    '_type': doc_type,
+                    '_id': i,
+                    '_source': {
+                        'filepath': 'objects/dir%d/file%d.%s' % (
+                            i % 1000, i, rand.choice(QUERIES[3:])),
+                        'fileformat': fileformat,
+                        'size_bytes': rand.randrange(1, 10 ** 9),
+                        'datemodified': start + datetime.timedelta(
+                            seconds=rand.randrange(20 * 365 * 24 * 3600)),
+                        'dip': {
+                            'id': i % 5000,
+                            'import_status': rand.choice(statuses),
+                        },
+                        'collection': {
+                            'id': collection,
+                            'title': COLLECTIONS[collection],
+                        },
+                    },
+                }
+
+        progress_bar = tqdm(
+            total=total,
+            bar_format=' - Indexing: {n_fmt}/{total_fmt} [{elapsed} < {remaining}]',
+            ncols=1,  # required to show the custom bar_format
+        )
+        for _ in streaming_bulk(es, files()):
+            progress_bar.update(1)
+        progress_bar.close()
+
+    def get_body(self, context, run):
+        """
+        Build the search view request for a run, with a different query
+        and one of the repeated filters, added as `filter` clauses or as
+        scored `must` clauses in query context.
+        """
+        search = DigitalFile.es_doc.search(index=INDEX_NAME)
+        search = search.exclude(
+            'terms',
+            **{'dip.import_status': [DIP.IMPORT_PENDING, DIP.IMPORT_FAILURE]},
+        )
+        search = add_query_to_search(
+            search, QUERIES[run % len(QUERIES)], ['filepath', 'fileformat'])
+        search = search.sort({'filepath.raw': {'order': 'asc'}})
+        search = add_digital_file_aggs(search)
+        body = search[:10].to_dict()
+        filters = add_digital_file_filters(
+            DigitalFile.es_doc.search(), FILTERS[run % len(FILTERS)])
+        clauses = filters.to_dict()['query']['bool']['filter']
+        occur = 'must' if context == 'query' else 'filter'
+        body['query']['bool'].setdefault(occur, []).extend(clauses)
+        return body
+
+    def get_cache_stats(self, es):
+        stats = es.indices.stats(index=INDEX_NAME, metric='query_cache')
+        return stats['indices'][INDEX_NAME]['total']['query_cache']
+
+    def run_searches(self, es, context, runs):
+        es.indices.clear_cache(index=INDEX_NAME, query=True)
+        before = self.get_cache_stats(es)
+        took = []
+        for run in range(runs):
+            start = time.time()
+            response = es.search(
+                index=INDEX_NAME,
+                body=self.get_body(context, run),
+                request_cache=False,
+            )
+            took.append((response['took'], (time.time() - start) * 1000))
+        after = self.get_cache_stats(es)
+        es_times = sorted(es_time for es_time, _ in took)
+        p95 = es_times[max(int(len(es_times) * 0.95) - 1, 0)]
+        print('Filters in %s context:' % context)
+        print(' - ES time (median/p95): %.1f ms / %.1f ms' % (
+            statistics.median(es_times), p95))
+        print(' - Request time (median): %.1f ms' % statistics.median(
+            request_time for _, request_time in took))
+        print(' - Query cache hits/misses: %d / %d' % (
+            after['hit_count'] - before['hit_count'],
+            after['miss_count'] - before['miss_count']))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from dips.models import EsDescendantsUpdate
+
+
+class Command(BaseCommand):
+    help = 'Show the pending and skipped ES descendants updates.'
+
+    def handle(self, *args, **kwargs):
+        stats = EsDescendantsUpdate.get_stats()
+        print('Pending updates: %d' % stats['pending'])
+        print('Skipped updates: %d' % stats['skipped'])
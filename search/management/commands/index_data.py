@@ -1,11 +1,19 @@
 from django.conf import settings
-from django.core.management.base import BaseCommand
-from elasticsearch.helpers import streaming_bulk
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from elasticsearch.helpers import bulk, parallel_bulk, scan, streaming_bulk
 from elasticsearch_dsl import analyzer
 from elasticsearch_dsl.connections import connections
 from tqdm import tqdm
 
-from dips.models import Collection, DIP, DigitalFile
+from dips.helpers import chunks
+from dips.models import Collection, DIP, DigitalFile, EsIndexingCheckpoint
+from search.cache import bump_search_generation
+
+import datetime
+import time
 
 # Tuples with display name and models to index in ES.
 MODELS = [
@@ -14,36 +22,418 @@ MODELS = [
     ('digital files', DigitalFile),
 ]
 
+# Lookups from each model to the modified fields of the objects included
+# in its ES data and to the Collection and DIP containing it.
+LOOKUPS = {
+    Collection: {
+        'modified': ['modified'],
+        'collection': 'pk',
+        'dip': None,
+    },
+    DIP: {
+        'modified': ['modified'],
+        'collection': 'collection',
+        'dip': 'pk',
+    },
+    DigitalFile: {
+        'modified': ['modified', 'dip__modified', 'dip__collection__modified'],
+        'collection': 'dip__collection',
+        'dip': 'dip',
+    },
+}
+
+
+def get_es_data(queryset, batch_size):
+    """
+    Get lists with the ES data from the queryset objects, requested by
+    primary key ranges of `batch_size` objects to avoid long running
+    queries, and built in bulk per range to avoid the related objects
+    queries.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        batch = queryset
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        batch = list(batch[:batch_size])
+        if not batch:
+            return
+        last_pk = batch[-1].pk
+        yield queryset.model.get_es_data_in_bulk(batch)
+
+
+def get_scoped_queryset(model, since=None, collection=None, dip=None):
+    """
+    Get the queryset of the model objects changed since a datetime, which
+    includes the DigitalFiles with changes in their DIP or Collection, and
+    within a Collection or DIP.
+    """
+    queryset = model.get_es_queryset()
+    lookups = LOOKUPS[model]
+    if since is not None:
+        condition = Q()
+        for lookup in lookups['modified']:
+            condition |= Q(**{'%s__gte' % lookup: since})
+        queryset = queryset.filter(condition)
+    for scope, pk in [('collection', collection), ('dip', dip)]:
+        if pk is None:
+            continue
+        if lookups[scope] is None:
+            return queryset.none()
+        queryset = queryset.filter(**{lookups[scope]: pk})
+    return queryset
+
+
+def get_deleted_ids(es, model, index, batch_size):
+    """
+    Generator with the ids of the documents in an index from objects that
+    don't exist anymore, checked in batches of `batch_size` ids.
+    """
+    hits = scan(es, index=index, query={'_source': False}, size=batch_size)
+    for ids in chunks((hit['_id'] for hit in hits), batch_size):
+        existing = set(
+            str(pk) for pk in
+            model.objects.filter(pk__in=ids).values_list('pk', flat=True)
+        )
+        for id_ in ids:
+            if id_ not in existing:
+                yield id_
+
+
+def parse_since(value):
+    """
+    Parse an ISO 8601 date or datetime, considered in the current time
+    zone when it's not included.
+    """
+    try:
+        since = parse_datetime(value)
+        if since is None:
+            date = parse_date(value)
+            if date is not None:
+                since = datetime.datetime.combine(date, datetime.time())
+    except ValueError:
+        since = None
+    if since is None:
+        raise CommandError('Invalid --since date or datetime: %s.' % value)
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def get_generations(es, alias):
+    """
+    Get the physical indexes built for an alias, named with the alias and
+    a timestamp, sorted from oldest to newest.
+    """
+    indexes = es.indices.get(index='%s-*' % alias, ignore=404)
+    if 'error' in indexes:
+        return []
+    return sorted(indexes.keys())
+
 
 class Command(BaseCommand):
-    def handle(self, *args, **kwargs):
+    help = ('Index the collections, folders and digital files in new ES '
+            'indexes and swap the aliases used by the application to them '
+            'when all of them are indexed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep', type=int, default=1,
+            help='Amount of previous indexes to keep per alias.')
+        parser.add_argument(
+            '--cleanup', action='store_true',
+            help='Only remove the previous indexes over the keep amount.')
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Continue the last interrupted run from its checkpoints.')
+        parser.add_argument(
+            '--since',
+            help=('Only index the objects modified since an ISO 8601 date '
+                  'or datetime in the current indexes.'))
+        scope = parser.add_mutually_exclusive_group()
+        scope.add_argument(
+            '--collection', type=int,
+            help='Only index a collection and its descendants in the '
+                 'current indexes.')
+        scope.add_argument(
+            '--dip', type=int,
+            help='Only index a folder and its digital files in the '
+                 'current indexes.')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Amount of threads sending bulk requests in parallel.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=500,
+            help='Maximum amount of documents per bulk request.')
+        parser.add_argument(
+            '--max-chunk-bytes', type=int, default=100 * 1024 * 1024,
+            help='Maximum size in bytes of each bulk request.')
+        parser.add_argument(
+            '--batch-size', type=int, default=2000,
+            help='Amount of objects obtained per database query.')
+
+    def handle(self, *args, **options):
         es = connections.get_connection()
+        scoped = any(options[option] is not None for option in [
+            'since', 'collection', 'dip'])
+        if scoped and (options['resume'] or options['cleanup']):
+            raise CommandError(
+                'The --since, --collection and --dip options can not be '
+                'used with --resume or --cleanup.')
+        if scoped:
+            self.update(es, options)
+            return
+        if not options['cleanup']:
+            self.reindex(es, options)
+        self.cleanup(es, options['keep'])
+
+    def reindex(self, es, options):
+        """
+        Build a timestamped index per alias and swap all the aliases in a
+        single atomic request once they are filled, so the current indexes
+        are used until then. The new indexes are filled without refreshes
+        and replicas, which are restored before the swap. The progress is
+        saved per model in checkpoints, used to continue an interrupted run
+        with the `resume` option.
+
+        The changes made while the new indexes are built go to the current
+        ones. Before the swap, the objects modified since the run started
+        are indexed again in the new indexes, and after it, the ones
+        modified during that catch up. Then, the documents of the objects
+        deleted during the run are removed.
+        """
+        if options['resume']:
+            checkpoints = {
+                checkpoint.model: checkpoint for checkpoint
+                in EsIndexingCheckpoint.objects.all()
+            }
+            if not checkpoints:
+                raise CommandError('There is no interrupted run to resume.')
+            started = min(
+                checkpoint.started for checkpoint in checkpoints.values())
+        else:
+            EsIndexingCheckpoint.objects.all().delete()
+            checkpoints = {}
+            started = timezone.now()
+        suffix = timezone.now().strftime('%Y%m%d%H%M%S')
         for name, model in MODELS:
             print('Processing %s:' % name)
             document = model.es_doc
-            index = document._index
-            index.settings(**settings.ES_INDEXES_SETTINGS)
-            # Use English analizer by default, other analyzers may be
-            # defined in the documents declaration for specific fields.
-            index.analyzer(analyzer('default', 'english'))
-            print(' - Deleting index.')
-            index.delete(ignore=404)
-            print(' - Creating index.')
-            index.create()
-            total = model.objects.count()
+            checkpoint = checkpoints.get(model.__name__)
+            if checkpoint is None:
+                checkpoint = EsIndexingCheckpoint.objects.create(
+                    model=model.__name__,
+                    index=self.create_index(document, suffix),
+                    started=started,
+                )
+                checkpoints[model.__name__] = checkpoint
+            elif checkpoint.done:
+                print(' - Already indexed in: %s.' % checkpoint.index)
+                continue
+            elif not es.indices.exists(index=checkpoint.index):
+                raise CommandError(
+                    'The index to resume does not exist: %s.' %
+                    checkpoint.index)
+            else:
+                print(' - Resuming index: %s.' % checkpoint.index)
+            queryset = model.get_es_queryset()
+            if checkpoint.last_pk is not None:
+                queryset = queryset.filter(pk__gt=checkpoint.last_pk)
+            total = queryset.count()
             if total == 0:
                 print(' - No %s to index.' % name)
+            else:
+                self.index_objects(
+                    es, queryset, checkpoint.index, document._doc_type.name,
+                    total, options, checkpoint)
+            print(' - Restoring refresh and replicas.')
+            es.indices.put_settings(index=checkpoint.index, body={'index': {
+                'refresh_interval': None,
+                'number_of_replicas':
+                    settings.ES_INDEXES_SETTINGS['number_of_replicas'],
+            }})
+            es.indices.refresh(index=checkpoint.index)
+            checkpoint.done = True
+            checkpoint.save()
+        indexes = {
+            model: checkpoints[model.__name__].index for _, model in MODELS}
+        aliases = {model: model.es_doc._index._name for _, model in MODELS}
+        print('Catching up with the changes made during the run.')
+        catch_up_started = timezone.now()
+        self.catch_up(es, indexes, started, options)
+        es.indices.refresh(index=','.join(indexes.values()))
+        print('Swapping aliases.')
+        actions = []
+        for _, model in MODELS:
+            actions += self.get_alias_actions(
+                es, aliases[model], indexes[model])
+        es.indices.update_aliases(body={'actions': actions})
+        EsIndexingCheckpoint.objects.all().delete()
+        # The changes made during the catch up went to the previous indexes
+        print('Catching up with the changes made before the swap.')
+        self.catch_up(es, aliases, catch_up_started, options)
+        print('Removing the deleted objects.')
+        self.remove_deleted(es, aliases, options)
+        bump_search_generation(*aliases.values())
+
+    def create_index(self, document, suffix):
+        """
+        Create a timestamped index for a DocType without refreshes and
+        replicas and return its name.
+        """
+        alias = document._index._name
+        index = document._index.clone('%s-%s' % (alias, suffix))
+        index.settings(**dict(
+            settings.ES_INDEXES_SETTINGS,
+            refresh_interval='-1',
+            number_of_replicas=0,
+        ))
+        # Use English analizer by default, other analyzers may be
+        # defined in the documents declaration for specific fields.
+        index.analyzer(analyzer('default', 'english'))
+        print(' - Creating index: %s.' % index._name)
+        index.create()
+        return index._name
+
+    def catch_up(self, es, indexes, since, options):
+        """
+        Index the objects modified since a datetime in the given indexes
+        per model.
+        """
+        for name, model in MODELS:
+            queryset = get_scoped_queryset(model, since)
+            total = queryset.count()
+            if total == 0:
                 continue
-            progress_bar = tqdm(
-                total=total,
-                bar_format=' - Indexing: {n_fmt}/{total_fmt} [{elapsed} < {remaining}]',
-                ncols=1,  # required to show the custom bar_format
+            print(' - Modified %s: %d.' % (name, total))
+            self.index_objects(
+                es, queryset, indexes[model], model.es_doc._doc_type.name,
+                total, options)
+
+    def remove_deleted(self, es, indexes, options):
+        """
+        Remove the documents from the given indexes per model of the objects
+        that don't exist anymore.
+        """
+        for name, model in MODELS:
+            index = indexes[model]
+            actions = (
+                {
+                    '_op_type': 'delete',
+                    '_index': index,
+                    '_type': model.es_doc._doc_type.name,
+                    '_id': id_,
+                }
+                for id_ in get_deleted_ids(
+                    es, model, index, options['batch_size'])
             )
-            for _ in streaming_bulk(
-                es,
-                (obj.get_es_data() for obj in model.objects.all().iterator()),
-                index=index._name,
-                doc_type=document._doc_type.name,
-            ):
+            count, _ = bulk(
+                es, actions, chunk_size=options['chunk_size'],
+                raise_on_error=False)
+            if count:
+                print(' - Deleted %s: %d.' % (name, count))
+
+    def update(self, es, options):
+        """
+        Index the objects modified since the `since` option or within the
+        `collection` or `dip` options in the current indexes, without
+        building new ones. Removed objects are not considered, as their
+        documents are deleted with them.
+        """
+        since = None
+        if options['since'] is not None:
+            since = parse_since(options['since'])
+        for name, model in MODELS:
+            print('Processing %s:' % name)
+            document = model.es_doc
+            alias = document._index._name
+            if not es.indices.exists(index=alias):
+                raise CommandError(
+                    'The index does not exist: %s. Run the command without '
+                    'the --since, --collection and --dip options.' % alias)
+            queryset = get_scoped_queryset(
+                model, since, options['collection'], options['dip'])
+            total = queryset.count()
+            if total == 0:
+                print(' - No %s to index.' % name)
+                continue
+            self.index_objects(
+                es, queryset, alias, document._doc_type.name, total, options)
+            bump_search_generation(alias)
+
+    def index_objects(self, es, queryset, index, doc_type, total, options,
+                      checkpoint=None):
+        """
+        Index the queryset objects with bulk requests, sent in parallel when
+        more than one worker is set, and report the progress and rate. The
+        ES data is built in this thread, as the database connections are
+        not shared with the workers, and sent per batch of `batch_size`
+        objects. The results are obtained in order, so the checkpoint is
+        updated with the last indexed object after each batch.
+        """
+        kwargs = {
+            'index': index,
+            'doc_type': doc_type,
+            'chunk_size': options['chunk_size'],
+            'max_chunk_bytes': options['max_chunk_bytes'],
+        }
+        progress_bar = tqdm(
+            total=total,
+            bar_format=' - Indexing: {n_fmt}/{total_fmt} [{elapsed} < {remaining}, {rate_fmt}]',
+            unit='docs',
+            ncols=1,  # required to show the custom bar_format
+        )
+        start = time.time()
+        count = 0
+        for actions in get_es_data(queryset, options['batch_size']):
+            if options['workers'] > 1:
+                results = parallel_bulk(
+                    es, actions, thread_count=options['workers'],
+                    queue_size=options['workers'], **kwargs)
+            else:
+                results = streaming_bulk(es, actions, **kwargs)
+            result = None
+            for _, result in results:
+                count += 1
                 progress_bar.update(1)
-            progress_bar.close()
+            if checkpoint and result is not None:
+                checkpoint.last_pk = result['index']['_id']
+                checkpoint.save()
+        progress_bar.close()
+        elapsed = time.time() - start
+        print(' - Indexed %d documents in %.1f seconds (%.1f docs/sec).' % (
+            count, elapsed, count / elapsed if elapsed else 0))
+
+    def get_alias_actions(self, es, alias, index):
+        """
+        Get the actions to point an alias to a new index. An index with the
+        alias name, created before the aliases were used or automatically by
+        a write, is removed in the same request.
+        """
+        actions = [{'add': {'index': index, 'alias': alias}}]
+        if es.indices.exists_alias(name=alias):
+            current = es.indices.get_alias(name=alias)
+            actions += [
+                {'remove': {'index': name, 'alias': alias}}
+                for name in current.keys()
+            ]
+        elif es.indices.exists(index=alias):
+            actions.append({'remove_index': {'index': alias}})
+        return actions
+
+    def cleanup(self, es, keep):
+        """Remove the indexes not aliased over the keep amount per alias."""
+        for _, model in MODELS:
+            alias = model.es_doc._index._name
+            current = set()
+            if es.indices.exists_alias(name=alias):
+                current = set(es.indices.get_alias(name=alias).keys())
+            previous = [
+                index for index in get_generations(es, alias)
+                if index not in current
+            ]
+            remove = previous[:max(len(previous) - keep, 0)]
+            for index in remove:
+                print('Removing index: %s.' % index)
+                es.indices.delete(index=index)
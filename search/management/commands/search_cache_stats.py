@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from search.cache import get_search_cache
+
+
+class Command(BaseCommand):
+    help = 'Show the search cache hits, misses and entries.'
+
+    def handle(self, *args, **kwargs):
+        cache = get_search_cache()
+        if cache is None:
+            raise CommandError('The search cache is not enabled.')
+        stats = cache.get_stats()
+        requests = stats['hits'] + stats['misses']
+        print('Hits: %d' % stats['hits'])
+        print('Misses: %d' % stats['misses'])
+        print('Hit ratio: %.1f%%' % (
+            100 * stats['hits'] / requests if requests else 0))
+        print('Entries: %d' % stats['entries'])
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from tqdm import tqdm
+
+from dips.models import Collection, DIP
+
+
+class Command(BaseCommand):
+    help = ('Recompute the digital files statistics of all the folders and '
+            'collections from their digital files and update their '
+            'documents in ES.')
+
+    def handle(self, *args, **options):
+        dips = DIP.objects.order_by('pk')
+        dips_total = dips.count()
+        for dip in tqdm(dips.iterator(), total=dips_total, desc='Folders'):
+            dip.update_file_stats(update_collection=False)
+        collections = Collection.objects.order_by('pk')
+        collections_total = collections.count()
+        for collection in tqdm(collections.iterator(),
+                               total=collections_total, desc='Collections'):
+            collection.update_file_stats()
+        print('Updated the statistics of %d folders and %d collections.' % (
+            dips_total, collections_total))
@@ -0,0 +1,47 @@
+from django.core.management import call_command
+from django.test import TestCase
+from unittest.mock import patch
+
+from search.management.commands.benchmark_filters import Command
+
+
+class BenchmarkFiltersTests(TestCase):
+    def test_body_contexts(self):
+        command = Command()
+        query = command.get_body('query', 0)['query']['bool']
+        filter_ = command.get_body('filter', 0)['query']['bool']
+        facet_clause = {'terms': {'fileformat.raw': ['Format 0', 'Format 1']}}
+        # The import status exclusion is always a filter clause
+        self.assertEqual(len(query['filter']), 1)
+        self.assertIn(facet_clause, query['must'])
+        self.assertIn(facet_clause, filter_['filter'])
+        self.assertNotIn(facet_clause, filter_['must'])
+
+    # Patch tqdm and print to disable output
+    @patch('search.management.commands.benchmark_filters.print')
+    @patch('search.management.commands.benchmark_filters.tqdm')
+    @patch('search.management.commands.benchmark_filters.streaming_bulk',
+           return_value=[])
+    @patch('search.management.commands.benchmark_filters.connections')
+    @patch('elasticsearch_dsl.Index.create')
+    @patch('elasticsearch_dsl.Index.delete')
+    def test_output(self, mock_delete, mock_create, mock_connections,
+                    patch_a, patch_b, mock_print):
+        es = mock_connections.get_connection.return_value
+        es.search.return_value = {'took': 5}
+        es.indices.stats.side_effect = [
+            {'indices': {'scope_benchmark_digital_files': {'total': {
+                'query_cache': {'hit_count': hits, 'miss_count': 4},
+            }}}}
+            for hits in [0, 0, 0, 6]
+        ]
+        call_command('benchmark_filters', files=10, runs=4)
+        self.assertEqual(es.search.call_count, 8)
+        self.assertEqual(mock_delete.call_count, 2)
+        self.assertEqual(mock_create.call_count, 1)
+        output = [args[0] for args, _ in mock_print.call_args_list]
+        self.assertEqual(output[0], 'Filters in query context:')
+        self.assertEqual(output[3], ' - Query cache hits/misses: 0 / 0')
+        self.assertEqual(output[4], 'Filters in filter context:')
+        self.assertEqual(output[5], ' - ES time (median/p95): 5.0 ms / 5.0 ms')
+        self.assertEqual(output[7], ' - Query cache hits/misses: 6 / 0')
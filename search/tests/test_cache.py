@@ -0,0 +1,182 @@
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from elasticsearch_dsl.response import Response
+from unittest.mock import call, patch
+
+import json
+
+from dips.models import Collection, DigitalFile, DublinCore
+from search.cache import bump_search_generation, execute_search, SearchCache
+
+ES_RESPONSE = {
+    'took': 1,
+    'timed_out': False,
+    'hits': {'total': 1, 'max_score': None, 'hits': [{
+        '_index': 'scope_digital_files',
+        '_type': 'doc',
+        '_id': 'fake-uuid',
+        '_source': {'filepath': 'fake/path'},
+    }]},
+}
+
+
+class FakeSearchCache(object):
+    """In memory SearchCache to check the entries used by each search."""
+
+    def __init__(self):
+        self.generations = {}
+        self.entries = {}
+        # Indexes flagged as recently changed
+        self.changed = set()
+
+    def get_key(self, indexes, body):
+        key = json.dumps({
+            'generations': [self.generations.get(i, 0) for i in sorted(indexes)],
+            'body': body,
+        }, sort_keys=True)
+        return key, bool(self.changed.intersection(indexes))
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, data):
+        self.entries[key] = data
+
+    def bump(self, indexes, refreshed=False):
+        for index in indexes:
+            self.generations[index] = self.generations.get(index, 0) + 1
+            if not refreshed:
+                self.changed.add(index)
+
+
+class SearchCacheTests(TestCase):
+    def setUp(self):
+        self.search = DigitalFile.es_doc.search()
+
+    @patch('elasticsearch_dsl.Search.execute')
+    def test_execute_search_disabled(self, mock):
+        self.assertEqual(execute_search(self.search), mock.return_value)
+
+    @patch('search.cache.get_search_cache')
+    @patch('elasticsearch_dsl.Search.execute')
+    def test_execute_search_miss(self, mock, mock_2):
+        cache = mock_2.return_value
+        cache.get_key.return_value = ('key', False)
+        cache.get.return_value = None
+        mock.return_value.to_dict.return_value = ES_RESPONSE
+        self.assertEqual(execute_search(self.search), mock.return_value)
+        cache.get_key.assert_called_with(['scope_digital_files'], {})
+        cache.set.assert_called_with('key', ES_RESPONSE)
+
+    @patch('search.cache.get_search_cache')
+    @patch('elasticsearch_dsl.Search.execute')
+    def test_execute_search_hit(self, mock, mock_2):
+        mock_2.return_value.get_key.return_value = ('key', False)
+        mock_2.return_value.get.return_value = ES_RESPONSE
+        response = execute_search(self.search)
+        mock.assert_not_called()
+        mock_2.return_value.set.assert_not_called()
+        self.assertEqual(response.hits.total, 1)
+        self.assertEqual(response.hits[0].filepath, 'fake/path')
+
+    @patch('search.cache.get_search_cache')
+    def test_search_before_refresh(self, mock):
+        cache = mock.return_value = FakeSearchCache()
+        # Documents visible in the index, changed by the refresh
+        visible = {'filepath': 'old/path'}
+
+        def execute():
+            data = dict(ES_RESPONSE)
+            data['hits'] = dict(data['hits'], hits=[
+                dict(data['hits']['hits'][0], _source=dict(visible))])
+            return Response(self.search, data)
+
+        with patch('elasticsearch_dsl.Search.execute', side_effect=execute):
+            bump_search_generation('scope_digital_files')
+            # A search between the write and the refresh doesn't
+            # cache the previous results.
+            response = execute_search(self.search)
+            self.assertEqual(response.hits[0].filepath, 'old/path')
+            self.assertEqual(cache.entries, {})
+            visible['filepath'] = 'new/path'
+            response = execute_search(self.search)
+            self.assertEqual(response.hits[0].filepath, 'new/path')
+            # The results are cached once the changed flag expires
+            cache.changed.clear()
+            execute_search(self.search)
+            self.assertEqual(len(cache.entries), 1)
+            visible['filepath'] = 'other/path'
+            response = execute_search(self.search)
+            self.assertEqual(response.hits[0].filepath, 'new/path')
+        self.assertEqual(cache.generations, {'scope_digital_files': 1})
+
+    @patch('search.cache.get_search_cache')
+    def test_bump_refreshed(self, mock):
+        bump_search_generation('a', 'b')
+        mock.return_value.bump.assert_called_with(('a', 'b'), refreshed=False)
+        bump_search_generation('a', 'b', refreshed=True)
+        mock.return_value.bump.assert_called_with(('a', 'b'), refreshed=True)
+
+    @patch('redis.StrictRedis.pipeline')
+    def test_bump(self, mock):
+        cache = SearchCache('redis://localhost:6379/1', 300, 10, 2)
+        pipe = mock.return_value
+        cache.bump(['index'])
+        pipe.incr.assert_called_once_with('scope:search:generation:index')
+        pipe.set.assert_called_once_with(
+            'scope:search:changed:index', 1, ex=2)
+        # The refreshed changes are not flagged
+        pipe.reset_mock()
+        cache.bump(['index'], refreshed=True)
+        pipe.incr.assert_called_once_with('scope:search:generation:index')
+        pipe.set.assert_not_called()
+
+    @patch('redis.StrictRedis.mget')
+    def test_get_key(self, mock):
+        cache = SearchCache('redis://localhost:6379/1', 300, 10)
+        mock.return_value = [b'2', None]
+        key, changed = cache.get_key(['index'], {'a': 1, 'b': 2})
+        mock.assert_called_with([
+            'scope:search:generation:index', 'scope:search:changed:index'])
+        self.assertTrue(key.startswith('scope:search:entry:'))
+        self.assertFalse(changed)
+        # The same body with a different keys order uses the same entry
+        self.assertEqual(key, cache.get_key(['index'], {'b': 2, 'a': 1})[0])
+        # A different body or generation uses a different entry
+        self.assertNotEqual(key, cache.get_key(['index'], {'a': 1})[0])
+        mock.return_value = [b'3', b'1']
+        key_2, changed = cache.get_key(['index'], {'a': 1, 'b': 2})
+        self.assertNotEqual(key, key_2)
+        self.assertTrue(changed)
+
+    @patch('dips.models.bump_search_generation')
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_bump_on_save(self, mock, mock_2):
+        dc = DublinCore.objects.create(identifier='1')
+        Collection.objects.create(dc=dc)
+        # The document is saved with refresh
+        mock_2.assert_called_with('scope_collections', refreshed=True)
+
+    @patch('search.helpers.bump_search_generation')
+    @patch('elasticsearch.Elasticsearch.delete')
+    @patch('elasticsearch_dsl.DocType.save')
+    def test_bump_on_delete(self, mock, mock_2, mock_3):
+        dc = DublinCore.objects.create(identifier='1')
+        collection = Collection.objects.create(dc=dc)
+        with patch('dips.models.celery_app.send_task'):
+            collection.delete()
+        mock_3.assert_called_with('scope_collections', refreshed=True)
+
+    @override_settings(SEARCH_CACHE_URL='redis://localhost:6379/1')
+    @patch('search.management.commands.search_cache_stats.print')
+    @patch('search.management.commands.search_cache_stats.get_search_cache')
+    def test_stats_output(self, mock, mock_2):
+        mock.return_value.get_stats.return_value = {
+            'hits': 3, 'misses': 1, 'entries': 1}
+        call_command('search_cache_stats')
+        self.assertEqual(mock_2.call_args_list, [
+            call('Hits: 3'),
+            call('Misses: 1'),
+            call('Hit ratio: 75.0%'),
+            call('Entries: 1'),
+        ])
@@ -0,0 +1,19 @@
+from django.core.management import call_command
+from django.test import TestCase
+from unittest.mock import call, patch
+
+from dips.models import EsDescendantsUpdate
+
+
+class EsDescendantsUpdatesTests(TestCase):
+    @patch('search.management.commands.es_descendants_updates.print')
+    def test_stats_output(self, mock):
+        EsDescendantsUpdate.objects.create(
+            model='DIP', object_id=1, version=3, done_version=3, skipped=2)
+        EsDescendantsUpdate.objects.create(
+            model='DIP', object_id=2, version=2, done_version=1, skipped=1)
+        call_command('es_descendants_updates')
+        self.assertEqual(mock.call_args_list, [
+            call('Pending updates: 1'),
+            call('Skipped updates: 3'),
+        ])
@@ -1,8 +1,11 @@
-from django.test import TestCase
+from django.conf import settings
+from django.test import TestCase, override_settings
+from unittest.mock import patch
 
 from dips.models import DigitalFile
 from search.helpers import (add_query_to_search, add_digital_file_aggs,
-                            add_digital_file_filters)
+                            add_digital_file_filters,
+                            get_digital_file_facet_page)
 
 
 class FunctionsTests(TestCase):
@@ -42,13 +45,13 @@ class FunctionsTests(TestCase):
                 'formats': {
                     'terms': {
                         'field': 'fileformat.raw',
-                        'size': 10000
+                        'size': settings.SEARCH_FACET_SIZE
                     },
                 },
                 'collections': {
                     'terms': {
                         'field': 'collection.title.raw',
-                        'size': 10000
+                        'size': settings.SEARCH_FACET_SIZE
                     }
                 }
             }
@@ -62,7 +65,7 @@ class FunctionsTests(TestCase):
                 'formats': {
                     'terms': {
                         'field': 'fileformat.raw',
-                        'size': 10000
+                        'size': settings.SEARCH_FACET_SIZE
                     },
                 }
             }
@@ -84,7 +87,7 @@ class FunctionsTests(TestCase):
         expected_search = {
             'query': {
                 'bool': {
-                    'must': [
+                    'filter': [
                         {'terms': {'fileformat.raw': params['formats']}},
                         {'terms':
                             {'collection.title.raw': params['collections']}},
@@ -107,3 +110,59 @@ class FunctionsTests(TestCase):
         }
         modified_search = add_digital_file_filters(self.search, params)
         self.assertEqual(modified_search.to_dict(), {})
+
+    @override_settings(SEARCH_FACET_SIZE=2)
+    @patch('elasticsearch.Transport.perform_request')
+    def test_get_digital_file_facet_page(self, mock):
+        mock.return_value = {
+            'hits': {'total': 3, 'hits': []},
+            'aggregations': {'formats': {'buckets': [
+                {'key': {'formats': 'format_a'}, 'doc_count': 2},
+                {'key': {'formats': 'format_b'}, 'doc_count': 1},
+            ]}},
+        }
+        page = get_digital_file_facet_page(self.search, 'formats')
+        self.assertEqual(mock.call_args[1]['body'], {
+            'aggs': {
+                'formats': {
+                    'composite': {
+                        'sources': [
+                            {'formats': {'terms': {'field': 'fileformat.raw'}}},
+                        ],
+                        'size': 2,
+                    },
+                },
+            },
+            'size': 0,
+        })
+        self.assertEqual(page, {
+            'buckets': [
+                {'key': 'format_a', 'doc_count': 2},
+                {'key': 'format_b', 'doc_count': 1},
+            ],
+            'after': 'format_b',
+        })
+
+    @override_settings(SEARCH_FACET_SIZE=2)
+    @patch('elasticsearch.Transport.perform_request')
+    def test_get_digital_file_facet_page_query_and_after(self, mock):
+        mock.return_value = {
+            'hits': {'total': 1, 'hits': []},
+            'aggregations': {'collections': {'buckets': [
+                {'key': {'collections': 'Title c'}, 'doc_count': 1},
+            ]}},
+        }
+        page = get_digital_file_facet_page(
+            self.search, 'collections', query=' Tit ', after='Title b')
+        search = mock.call_args[1]['body']
+        self.assertEqual(search['query'], {'bool': {'filter': [
+            {'match_phrase_prefix': {'collection.title': 'Tit'}},
+        ]}})
+        self.assertEqual(
+            search['aggs']['collections']['composite']['after'],
+            {'collections': 'Title b'})
+        # Last page
+        self.assertEqual(page, {
+            'buckets': [{'key': 'Title c', 'doc_count': 1}],
+            'after': None,
+        })
@@ -1,8 +1,35 @@
+from datetime import datetime, timezone
 from django.core.management import call_command
 from django.test import TestCase
+from elasticsearch.exceptions import ConnectionError
 from unittest.mock import patch
 
-from dips.models import Collection, DIP, DigitalFile
+from dips.models import Collection, DIP, DigitalFile, EsIndexingCheckpoint
+
+import json
+import threading
+
+
+def bulk_response(body, **kwargs):
+    """Successful bulk response for the documents in the request body."""
+    actions = [json.loads(line) for line in body.splitlines()[::2]]
+    return {'errors': False, 'items': [
+        {'index': dict(action['index'], status=201)} for action in actions
+    ]}
+
+
+# Run start, after the last modification in the fixture
+NOW = datetime(2019, 4, 1, 12, 0, 0, tzinfo=timezone.utc)
+
+
+def indexed_ids(mock_bulk, index):
+    """Ids of the documents indexed with bulk requests in an index."""
+    return [
+        action['index']['_id']
+        for args, kwargs in mock_bulk.call_args_list
+        if kwargs['index'] == index
+        for action in map(json.loads, args[0].splitlines()[::2])
+    ]
 
 
 class IndexDataTests(TestCase):
@@ -12,21 +39,237 @@ class IndexDataTests(TestCase):
     # Patch tqdm and print to disable output
     @patch('search.management.commands.index_data.print')
     @patch('search.management.commands.index_data.tqdm')
-    # Patch bulk to avoid ES requests
+    # Patch scan and bulk to avoid ES requests
+    @patch('search.management.commands.index_data.scan', return_value=[])
     @patch('elasticsearch.Elasticsearch.bulk')
     # Mock models get_es_data to check call_counts
     @patch.object(Collection, 'get_es_data', return_value={})
     @patch.object(DIP, 'get_es_data', return_value={})
     @patch.object(DigitalFile, 'get_es_data', return_value={})
-    # Mock index create and delete to avoid ES requests and check call_counts
+    # Mock index create and the aliases requests to avoid ES requests
     @patch('elasticsearch_dsl.Index.create')
-    @patch('elasticsearch_dsl.Index.delete')
-    def test_index_recreation(self, mock_delete, mock_create,
-                              mock_dig, mock_dip, mock_col,
+    @patch('elasticsearch.client.IndicesClient.get', return_value={})
+    @patch('elasticsearch.client.IndicesClient.exists_alias', return_value=False)
+    @patch('elasticsearch.client.IndicesClient.exists', return_value=True)
+    @patch('elasticsearch.client.IndicesClient.update_aliases')
+    @patch('elasticsearch.client.IndicesClient.put_settings')
+    @patch('elasticsearch.client.IndicesClient.refresh')
+    @patch('django.utils.timezone.now', return_value=NOW)
+    def test_index_recreation(self, patch_now, patch_refresh,
+                              mock_put_settings, mock_update, patch_exists,
+                              patch_exists_alias, patch_get, mock_create,
+                              mock_dig, mock_dip, mock_col, mock_bulk,
                               patch_a, patch_b, patch_c):
-        call_command('index_data')
-        self.assertEqual(mock_delete.call_count, 3)
+        call_command('index_data', batch_size=5)
         self.assertEqual(mock_create.call_count, 3)
+        # The refresh and replicas are restored after the indexing
+        self.assertEqual(mock_put_settings.call_count, 3)
+        self.assertEqual(mock_put_settings.call_args[1], {
+            'index': 'scope_digital_files-20190401120000',
+            'body': {'index': {
+                'refresh_interval': None,
+                'number_of_replicas': 0,
+            }},
+        })
         self.assertEqual(mock_dig.call_count, 12)
         self.assertEqual(mock_dip.call_count, 2)
         self.assertEqual(mock_col.call_count, 2)
+        # The aliases are swapped in a single request, removing
+        # the indexes created without aliases.
+        actions = []
+        for alias in ['scope_collections', 'scope_dips', 'scope_digital_files']:
+            actions += [
+                {'add': {'index': '%s-20190401120000' % alias, 'alias': alias}},
+                {'remove_index': {'index': alias}},
+            ]
+        mock_update.assert_called_once_with(body={'actions': actions})
+        # Same documents indexed in parallel in smaller requests, built
+        # in the main thread, which owns the database connection.
+        mock_bulk.reset_mock()
+        mock_dig.reset_mock()
+        threads = set()
+        mock_dig.side_effect = lambda *args: threads.add(
+            threading.current_thread()) or {}
+        call_command('index_data', workers=2, chunk_size=5)
+        self.assertEqual(mock_dig.call_count, 12)
+        self.assertEqual(threads, {threading.main_thread()})
+        self.assertEqual(mock_bulk.call_count, 5)
+        # The checkpoints are removed after the swap
+        self.assertFalse(EsIndexingCheckpoint.objects.exists())
+
+    @patch('search.management.commands.index_data.print')
+    @patch('search.management.commands.index_data.tqdm')
+    @patch('search.management.commands.index_data.scan', return_value=[])
+    @patch('search.management.commands.index_data.bump_search_generation')
+    @patch('elasticsearch.Elasticsearch.bulk')
+    @patch('elasticsearch_dsl.Index.create')
+    @patch('elasticsearch.client.IndicesClient.get', return_value={})
+    @patch('elasticsearch.client.IndicesClient.exists_alias', return_value=False)
+    @patch('elasticsearch.client.IndicesClient.exists', return_value=True)
+    @patch('elasticsearch.client.IndicesClient.update_aliases')
+    @patch('elasticsearch.client.IndicesClient.put_settings')
+    @patch('elasticsearch.client.IndicesClient.refresh')
+    @patch('django.utils.timezone.now', return_value=NOW)
+    def test_resume(self, patch_now, patch_refresh, patch_put_settings,
+                    mock_update, patch_exists, patch_exists_alias, patch_get,
+                    mock_create, mock_bulk, patch_bump, patch_a, patch_b,
+                    patch_c):
+        uuids = list(DigitalFile.objects.order_by('pk').values_list(
+            'pk', flat=True))
+
+        def failing_bulk(body, **kwargs):
+            # Fail in the second digital files request
+            if mock_bulk.call_count == 4:
+                raise ConnectionError('N/A', 'Failed', None)
+            return bulk_response(body)
+
+        mock_bulk.side_effect = failing_bulk
+        with self.assertRaises(ConnectionError):
+            call_command('index_data', batch_size=5, chunk_size=5)
+        checkpoints = {
+            checkpoint.model: checkpoint for checkpoint
+            in EsIndexingCheckpoint.objects.all()
+        }
+        self.assertTrue(checkpoints['Collection'].done)
+        self.assertTrue(checkpoints['DIP'].done)
+        self.assertFalse(checkpoints['DigitalFile'].done)
+        self.assertEqual(checkpoints['DigitalFile'].started, NOW)
+        self.assertEqual(checkpoints['DigitalFile'].last_pk, uuids[4])
+        mock_update.assert_not_called()
+        # Continue with the digital files after the checkpoint
+        mock_create.reset_mock()
+        mock_bulk.reset_mock()
+        mock_bulk.side_effect = bulk_response
+        call_command('index_data', batch_size=5, chunk_size=5, resume=True)
+        mock_create.assert_not_called()
+        self.assertEqual(indexed_ids(
+            mock_bulk, 'scope_digital_files-20190401120000'), uuids[5:])
+        actions = []
+        for alias in ['scope_collections', 'scope_dips', 'scope_digital_files']:
+            actions += [
+                {'add': {'index': '%s-20190401120000' % alias, 'alias': alias}},
+                {'remove_index': {'index': alias}},
+            ]
+        mock_update.assert_called_once_with(body={'actions': actions})
+        self.assertFalse(EsIndexingCheckpoint.objects.exists())
+
+    @patch('search.management.commands.index_data.print')
+    @patch('search.management.commands.index_data.tqdm')
+    @patch('search.management.commands.index_data.bulk', return_value=(1, []))
+    @patch('search.management.commands.index_data.scan')
+    @patch('elasticsearch.Elasticsearch.bulk')
+    @patch('elasticsearch_dsl.Index.create')
+    @patch('elasticsearch.client.IndicesClient.get', return_value={})
+    @patch('elasticsearch.client.IndicesClient.exists_alias', return_value=False)
+    @patch('elasticsearch.client.IndicesClient.exists', return_value=True)
+    @patch('elasticsearch.client.IndicesClient.update_aliases')
+    @patch('elasticsearch.client.IndicesClient.put_settings')
+    @patch('elasticsearch.client.IndicesClient.refresh')
+    @patch('django.utils.timezone.now', return_value=NOW)
+    def test_catch_up(self, patch_now, patch_refresh, patch_put_settings,
+                      mock_update, patch_exists, patch_exists_alias,
+                      patch_get, patch_create, mock_bulk, mock_scan,
+                      mock_delete_bulk, patch_a, patch_b):
+        uuids = list(DigitalFile.objects.order_by('pk').values_list(
+            'pk', flat=True))
+        dip_uuids = list(DigitalFile.objects.filter(dip_id=2).order_by(
+            'pk').values_list('pk', flat=True))
+        deleted = DigitalFile.objects.filter(dip_id=1).order_by('pk')[0].pk
+
+        def changing_bulk(body, **kwargs):
+            # Modify and delete objects while the collections are indexed
+            if mock_bulk.call_count == 1:
+                DIP.objects.filter(pk=2).update(modified=NOW)
+                DigitalFile.objects.filter(pk=deleted).delete()
+            return bulk_response(body)
+
+        mock_bulk.side_effect = changing_bulk
+        mock_scan.side_effect = lambda es, index, **kwargs: [
+            {'_id': uuid} for uuid in uuids
+        ] if index == 'scope_digital_files' else []
+        call_command('index_data')
+        # The modified DIP and its files are indexed again in the new
+        # indexes before the swap and in the aliases after it.
+        self.assertEqual(
+            indexed_ids(mock_bulk, 'scope_dips-20190401120000'), [1, 2, 2])
+        self.assertEqual(indexed_ids(mock_bulk, 'scope_dips'), [2])
+        self.assertEqual(
+            indexed_ids(mock_bulk, 'scope_digital_files-20190401120000'),
+            [uuid for uuid in uuids if uuid != deleted] + dip_uuids)
+        self.assertEqual(
+            indexed_ids(mock_bulk, 'scope_digital_files'), dip_uuids)
+        # The deleted file is removed after the swap
+        actions = [
+            action for args, _ in mock_delete_bulk.call_args_list
+            for action in args[1]
+        ]
+        self.assertEqual(actions, [{
+            '_op_type': 'delete',
+            '_index': 'scope_digital_files',
+            '_type': DigitalFile.es_doc._doc_type.name,
+            '_id': deleted,
+        }])
+
+    @patch('search.management.commands.index_data.print')
+    @patch('search.management.commands.index_data.tqdm')
+    @patch('search.management.commands.index_data.bump_search_generation')
+    @patch('elasticsearch.Elasticsearch.bulk')
+    @patch.object(Collection, 'get_es_data', return_value={})
+    @patch.object(DIP, 'get_es_data', return_value={})
+    @patch.object(DigitalFile, 'get_es_data', return_value={})
+    @patch('elasticsearch_dsl.Index.create')
+    @patch('elasticsearch.client.IndicesClient.exists', return_value=True)
+    @patch('elasticsearch.client.IndicesClient.update_aliases')
+    def test_scoped_update(self, mock_update, patch_exists, mock_create,
+                           mock_dig, mock_dip, mock_col, mock_bulk,
+                           mock_bump, patch_a, patch_b):
+        def assert_indexed(counts, **options):
+            for mock in [mock_col, mock_dip, mock_dig, mock_bulk]:
+                mock.reset_mock()
+            call_command('index_data', **options)
+            self.assertEqual(
+                (mock_col.call_count, mock_dip.call_count, mock_dig.call_count),
+                counts)
+
+        # Only the second collection and the digital files
+        # within it have been modified after February.
+        assert_indexed((1, 0, 2), since='2019-02-01')
+        # The documents are indexed in the current indexes
+        self.assertEqual(
+            mock_bulk.call_args[1]['index'], 'scope_digital_files')
+        assert_indexed((1, 1, 10), collection=1)
+        assert_indexed((0, 1, 2), dip=2)
+        # Only the updated indexes are invalidated in the search cache
+        self.assertEqual(
+            [args for args, _ in mock_bump.call_args_list[-2:]],
+            [('scope_dips',), ('scope_digital_files',)])
+        assert_indexed((0, 0, 0), collection=1, since='2019-02-01')
+        mock_create.assert_not_called()
+        mock_update.assert_not_called()
+
+    @patch('search.management.commands.index_data.print')
+    @patch('elasticsearch.client.IndicesClient.delete')
+    @patch('elasticsearch.client.IndicesClient.exists_alias', return_value=True)
+    @patch('elasticsearch.client.IndicesClient.get_alias')
+    @patch('elasticsearch.client.IndicesClient.get')
+    def test_cleanup(self, mock_get, mock_get_alias, patch_exists_alias,
+                     mock_delete, patch_print):
+        mock_get.side_effect = lambda index, **kwargs: {
+            index.replace('*', suffix): {}
+            for suffix in ['20190101000000', '20190201000000', '20190301000000']
+        }
+        mock_get_alias.side_effect = lambda name: {
+            '%s-20190201000000' % name: {}}
+        call_command('index_data', cleanup=True)
+        # Only the oldest index, not aliased, is removed per alias
+        self.assertEqual(
+            [kwargs['index'] for _, kwargs in mock_delete.call_args_list],
+            [
+                'scope_collections-20190101000000',
+                'scope_dips-20190101000000',
+                'scope_digital_files-20190101000000',
+            ],
+        )
+        mock_delete.reset_mock()
+        call_command('index_data', cleanup=True, keep=0)
+        self.assertEqual(mock_delete.call_count, 6)
@@ -0,0 +1,27 @@
+from django.core.management import call_command
+from django.db.models import Sum
+from django.test import TestCase
+from unittest.mock import patch
+
+from dips.models import Collection, DIP, DigitalFile
+
+
+class UpdateFileStatsTests(TestCase):
+    # This fixture is located in the dips app to avoid duplication
+    fixtures = ['index_data']
+
+    @patch('search.management.commands.update_file_stats.print')
+    @patch('search.management.commands.update_file_stats.tqdm',
+           side_effect=lambda iterable, **kwargs: iterable)
+    def test_recompute(self, patch, mock):
+        call_command('update_file_stats')
+        for dip in DIP.objects.all():
+            files = DigitalFile.objects.filter(dip=dip)
+            self.assertEqual(dip.file_count, files.count())
+            self.assertEqual(
+                dip.total_size_bytes,
+                files.aggregate(total=Sum('size_bytes'))['total'])
+            collection = Collection.objects.get(pk=dip.collection_id)
+            self.assertEqual(collection.file_count, files.count())
+        mock.assert_called_with(
+            'Updated the statistics of 2 folders and 2 collections.')